@@ -0,0 +1,57 @@
+"""Benchmark of read_data_dictionary
+
+Run with: python benchmarks/bench_dictionary.py
+"""
+
+import sys
+import timeit
+import tempfile
+from pathlib import Path
+
+from arcmapper.dictionary import read_data_dictionary
+
+sys.path.insert(0, str(Path(__file__).parent))
+from synthetic import synthetic_dictionary  # noqa: E402
+
+CCPUK = (
+    Path(__file__).parent.parent
+    / "tests"
+    / "data"
+    / "CCPUKSARIEastMidlands_DataDictionary_2022-06-06.csv"
+)
+
+REDCAP_OPTIONS = dict(
+    description_field="Field Label",
+    response_field="Choices, Calculations, OR Slider Labels",
+    response_func="redcap",
+)
+
+
+def bench(name: str, func, number: int = 5):
+    best = min(timeit.repeat(func, number=1, repeat=number))
+    print(f"{name:<40} {best * 1000:10.1f} ms")
+
+
+def main():
+    bench("CCPUK", lambda: read_data_dictionary(str(CCPUK), **REDCAP_OPTIONS))
+    bench(
+        "CCPUK, inferred description",
+        lambda: read_data_dictionary(str(CCPUK)),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        file = str(Path(tmp) / "synthetic.csv")
+        synthetic_dictionary(100_000).to_csv(file, index=False)
+        bench(
+            "synthetic 100k rows",
+            lambda: read_data_dictionary(file, **REDCAP_OPTIONS),
+            number=3,
+        )
+        bench(
+            "synthetic 100k rows, chunks of 20k",
+            lambda: read_data_dictionary(file, chunksize=20_000, **REDCAP_OPTIONS),
+            number=3,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Benchmarks of the mapping pipeline, with results written as JSON
+
+Times each stage of the pipeline over the CCPUK data dictionary and
+synthetic REDCap dictionaries, see synthetic.py. The sentence transformer
+is replaced by a small local stand-in model, so that the benchmarks run
+offline and time arcmapper rather than the model.
+
+Run with: python benchmarks/bench_pipeline.py -o results.json
+
+Compare the JSON results between releases to track regressions.
+"""
+
+import sys
+import json
+import time
+import zlib
+import argparse
+import platform
+import tempfile
+import statistics
+from pathlib import Path
+from importlib.metadata import version, PackageNotFoundError
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+
+from arcmapper import cache, models
+from arcmapper.arc import read_arc_schema
+from arcmapper.dictionary import read_data_dictionary
+from arcmapper.fhir import FHIRMapping, merge
+from arcmapper.strategies import (
+    get_match_dataframe_from_similarity_matrix,
+    infer_response_mapping,
+    sbert,
+    tf_idf,
+)
+
+sys.path.insert(0, str(Path(__file__).parent))
+from synthetic import synthetic_dictionary  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+CCPUK = ROOT / "tests" / "data" / "CCPUKSARIEastMidlands_DataDictionary_2022-06-06.csv"
+ARC_FILE = ROOT / "tests" / "data" / "ARCH.csv"
+FHIR_MAPPING_FILE = ROOT / "arc-fhir" / "ARC_pre_1.0.0_preset_dengue.xlsx"
+
+SIZES = [1_000, 10_000, 100_000]
+
+REDCAP_OPTIONS = dict(
+    description_field="Field Label",
+    response_field="Choices, Calculations, OR Slider Labels",
+    response_func="redcap",
+)
+
+NUM_MATCHES = 5
+THRESHOLD = 0.3
+
+
+class Similarity:
+    "Similarity matrix with the numpy() method of the tensors returned by models"
+
+    def __init__(self, matrix: np.ndarray):
+        self.matrix = matrix
+
+    def numpy(self) -> np.ndarray:
+        return self.matrix
+
+
+class StandInModel:
+    "Sentence transformer stand-in that embeds text as hashed word counts"
+
+    def __init__(self, dimensions: int = 384):
+        self.dimensions = dimensions
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in str(text).lower().split():
+                embeddings[i, zlib.crc32(word.encode()) % self.dimensions] += 1
+        return embeddings
+
+    def similarity(self, a: np.ndarray, b: np.ndarray) -> Similarity:
+        a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+        b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+        return Similarity(a @ b.T)
+
+
+def timed(func: Callable[[], Any], repeat: int) -> tuple[dict[str, float], Any]:
+    """Times func, returning timings in seconds and the result of the first call
+
+    The first call is reported separately, as it includes building caches.
+    """
+    start = time.perf_counter()
+    result = func()
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        "first_s": first,
+        "min_s": min(times, default=first),
+        "median_s": statistics.median(times) if times else first,
+    }, result
+
+
+def environment() -> dict[str, str]:
+    packages = {}
+    for package in ["arcmapper", "numpy", "pandas", "scikit-learn", "scipy"]:
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = "not installed"
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        **packages,
+    }
+
+
+def dictionaries(sizes: list[int], directory: Path) -> dict[str, Path]:
+    "Returns data dictionary files to benchmark, writing synthetic dictionaries"
+    files = {"ccpuk": CCPUK}
+    for n in sizes:
+        files[f"synthetic-{n}"] = directory / f"synthetic-{n}.csv"
+        synthetic_dictionary(n).to_csv(files[f"synthetic-{n}"], index=False)
+    return files
+
+
+def run(sizes: list[int], repeat: int) -> list[dict[str, Any]]:
+    results = []
+
+    def record(benchmark: str, name: str, rows: int, timings: dict[str, float]):
+        results.append(
+            {"benchmark": benchmark, "dictionary": name, "rows": rows, **timings}
+        )
+        print(
+            f"{benchmark:<45} {name:<18} {rows:>8} "
+            f"{timings['median_s'] * 1000:10.1f} ms",
+            file=sys.stderr,
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache.ARCMAPPER_CACHE_DIR = Path(tmp) / "cache"
+        models.MODELS = models.ModelRegistry(loader=lambda name, device: StandInModel())
+
+        timings, arc = timed(lambda: read_arc_schema(str(ARC_FILE)), repeat)
+        record("read_arc_schema", "ARCH.csv", len(arc), timings)
+        fhir_mapping = FHIRMapping(FHIR_MAPPING_FILE)
+
+        for name, file in dictionaries(sizes, Path(tmp)).items():
+            timings, dictionary = timed(
+                lambda: read_data_dictionary(str(file), **REDCAP_OPTIONS), repeat
+            )
+            rows = len(dictionary)
+            record("read_data_dictionary", name, rows, timings)
+
+            timings, mapping = timed(
+                lambda: tf_idf(dictionary, arc, NUM_MATCHES, THRESHOLD), repeat
+            )
+            record("tf_idf", name, rows, timings)
+
+            timings, _ = timed(
+                lambda: sbert(dictionary, arc, num_matches=NUM_MATCHES), repeat
+            )
+            record("sbert", name, rows, timings)
+
+            similarity = np.random.default_rng(0).random(
+                (rows, len(arc)), dtype=np.float32
+            )
+            timings, _ = timed(
+                lambda: get_match_dataframe_from_similarity_matrix(
+                    dictionary, arc, similarity, NUM_MATCHES, THRESHOLD
+                ),
+                repeat,
+            )
+            record("get_match_dataframe_from_similarity_matrix", name, rows, timings)
+
+            # best match of each field, as approved in the app
+            draft = mapping[mapping["rank"] == 0].drop(
+                columns=["rank", "similarity"], errors="ignore"
+            )
+            timings, _ = timed(lambda: infer_response_mapping(draft), repeat)
+            record("infer_response_mapping", name, rows, timings)
+
+            timings, _ = timed(lambda: merge(draft, fhir_mapping), repeat)
+            record("fhir.merge", name, rows, timings)
+    return results
+
+
+def main(args: list[str] | None = None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",") if n],
+        default=SIZES,
+        help="Comma separated numbers of fields of synthetic dictionaries",
+    )
+    p.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Timed runs after the first"
+    )
+    p.add_argument("-o", "--output", type=Path, help="JSON file, default stdout")
+    ns = p.parse_args(args)
+
+    report = {
+        "created": pd.Timestamp.now(tz="UTC").isoformat(),
+        "environment": environment(),
+        "results": run(ns.sizes, ns.repeat),
+    }
+    if ns.output:
+        ns.output.write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"Synthetic REDCap data dictionaries of any size, for benchmarks"
+
+import numpy as np
+import pandas as pd
+
+WORDS = (
+    "patient date admission fever cough temperature blood pressure heart rate "
+    "oxygen saturation symptoms onset travel history vaccine dose pregnancy "
+    "outcome discharge death treatment antiviral steroid ventilation"
+).split()
+
+RESPONSE_SETS = [
+    "1, Yes | 0, No | 99, Unknown",
+    "1, Male | 2, Female | 3, Other",
+    "1, Mild | 2, Moderate | 3, Severe",
+    None,
+    None,
+]
+
+
+def synthetic_dictionary(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    "Returns a data dictionary in REDCap export format with n_rows fields"
+    rng = np.random.default_rng(seed)
+    words = np.array(WORDS)
+    labels = [
+        " ".join(words[rng.integers(0, len(words), rng.integers(3, 10))]).capitalize()
+        for _ in range(n_rows)
+    ]
+    return pd.DataFrame(
+        {
+            "Variable / Field Name": [f"field_{i}" for i in range(n_rows)],
+            "Form Name": "form_" + pd.Series(rng.integers(0, 20, n_rows)).astype(str),
+            "Field Type": rng.choice(["radio", "text", "checkbox"], n_rows),
+            "Field Label": labels,
+            "Choices, Calculations, OR Slider Labels": rng.choice(
+                np.array(RESPONSE_SETS, dtype=object), n_rows
+            ),
+        }
+    )
@@ -8,8 +8,8 @@ dd = arcmapper.read_data_dictionary(
     response_func="redcap",
 )
 print("Mapping using TF-IDF... ", end="")
-arcmapper.map("tf-idf", dd, arc).to_csv("mapping_tfidf.csv", index=False)
+arcmapper.use_map("tf-idf", dd, arc).to_csv("mapping_tfidf.csv", index=False)
 print("done.")
 print(" Mapping using SBERT... ", end="")
-arcmapper.map("sbert", dd, arc).to_csv("mapping_sbert.csv", index=False)
+arcmapper.use_map("sbert", dd, arc).to_csv("mapping_sbert.csv", index=False)
 print("done.")
@@ -8,9 +8,10 @@ import subprocess
 import webbrowser
 
 from waitress import serve
-from .app import app
 from .arc import read_arc_schema
 from .dictionary import read_data_dictionary
+from .models import warmup
+from .strategies import use_map
 
 __version__ = "0.1.0"
 
@@ -20,6 +21,8 @@ ARCMAPPER_TIMEOUT = 30
 
 
 def launch_app():
+    from .app import app
+
     logging.getLogger("waitress.queue").setLevel(logging.ERROR)
     serve(app.server, host=ARCMAPPER_HOST, port=ARCMAPPER_PORT)
 
@@ -60,14 +63,29 @@ def wait_for_server(
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "map":
+        from .batch import cli
+
+        sys.exit(cli(sys.argv[2:]))
     if len(sys.argv) > 1 and sys.argv[1] in ["--debug", "-d"]:
+        from .app import app
+
         print("[DEBUG]")
         app.run_server(debug=True)
         return
+    # shows stage timings logged by arcmapper.metrics, among others
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
     if check_port(ARCMAPPER_HOST, ARCMAPPER_PORT):
         logging.info("Port is already in use. Opening browser.")
         webbrowser.open(f"http://{ARCMAPPER_HOST}:{ARCMAPPER_PORT}")
         return
+    from .prefork import ARCMAPPER_SERVER_WORKERS, serve_workers
+
+    if ARCMAPPER_SERVER_WORKERS > 1 and hasattr(os, "fork"):
+        serve_workers(ARCMAPPER_HOST, ARCMAPPER_PORT, ARCMAPPER_SERVER_WORKERS)
+        return
+    # Load models in the background so the first mapping does not wait
+    threading.Thread(target=warmup, daemon=True).start()
     # Launch the server in a separate thread
     server_thread = threading.Thread(target=launch_app)
     server_thread.start()
@@ -82,4 +100,4 @@ def main():
     server_thread.join()
 
 
-__all__ = ["read_arc_schema", "map", "read_data_dictionary", "main"]
+__all__ = ["read_arc_schema", "use_map", "read_data_dictionary", "main"]
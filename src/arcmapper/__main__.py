@@ -1,15 +1,21 @@
+import sys
 import logging
 import argparse
 from . import main
-from .app import app
 
 
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:2] == ["map"]:
+    from .batch import cli
+
+    sys.exit(cli(sys.argv[2:]))
+elif __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("--debug", action="store_true")
     args = p.parse_args()
 
     if args.debug:
+        from .app import app
+
         # Dash launches a Flask development server
         root_logger = logging.getLogger()
         if root_logger.hasHandlers():
@@ -1,18 +1,38 @@
 """Dash frontend for the arcmapper library"""
 
 import io
+import time
+import base64
+import functools
+from pathlib import Path
 
 import pandas as pd
 import dash
-from dash import dcc, html, ctx, callback, dash_table, Input, Output, State
+from dash import (
+    dcc,
+    html,
+    ctx,
+    callback,
+    clientside_callback,
+    dash_table,
+    Input,
+    Output,
+    State,
+    Patch,
+)
+from dash.dash_table.Format import Format, Scheme
 import dash_bootstrap_components as dbc
 
 from .components import arc_form, upload_form
 from .fhir import merge, FHIRMapping, FHIR_RESOURCES_ONE_TO_ONE
 from .util import read_upload_data
 from .dictionary import read_data_dictionary
-from .strategies import use_map
+from .strategies import NUM_MATCHES, THRESHOLD, use_map
 from .arc import read_arc_schema
+from .sessions import SESSIONS, new_session_id
+from .table import MappingTable, mapping_metadata, parquet_available
+from .jobs import JOBS, Job
+from .metrics import METRICS, request, span
 from .labels import (
     MAP_TO_ARC,
     DOWNLOAD_FHIRFLAT_MAPPING,
@@ -27,7 +47,18 @@ PAGE_SIZE = 20
 OK = "✅"
 HIGHLIGHT_COLOR = "bisque"
 
-FHIR_MAPPING = FHIRMapping("arc-fhir/ARC_pre_1.0.0_preset_dengue.xlsx")
+# Milliseconds between polls of background job progress
+JOB_POLL_INTERVAL = 500
+JOB_ALERT_STYLE = {"marginTop": "1em"}
+
+FHIR_MAPPING_FILE = "arc-fhir/ARC_pre_1.0.0_preset_dengue.xlsx"
+
+
+@functools.cache
+def get_fhir_mapping() -> FHIRMapping:
+    "Returns FHIR mapping, loaded on first use"
+    return FHIRMapping(FHIR_MAPPING_FILE)
+
 
 navbar = dbc.Navbar(
     dbc.Container(
@@ -75,6 +106,15 @@ output_table = dbc.Container(
                         "arc_response",
                         "rank",
                     ]
+                ]
+                + [
+                    {
+                        "name": "similarity",
+                        "id": "similarity",
+                        "editable": False,
+                        "type": "numeric",
+                        "format": Format(precision=2, scheme=Scheme.fixed),
+                    }
                 ],
                 editable=True,
                 style_data={
@@ -82,8 +122,24 @@ output_table = dbc.Container(
                     "height": "auto",
                     "fontSize": "90%",
                 },
+                # approved rows are highlighted by a single rule on status,
+                # so that toggling status does not update the styles
+                style_data_conditional=[
+                    {
+                        "if": {"filter_query": f'{{status}} = "{OK}"'},
+                        "backgroundColor": HIGHLIGHT_COLOR,
+                    }
+                ],
                 style_table={"overflowX": "auto"},
+                # pages are sorted, filtered and sent by update_table
+                page_action="custom",
+                sort_action="custom",
+                filter_action="custom",
+                sort_mode="multi",
+                page_current=0,
                 page_size=PAGE_SIZE,
+                sort_by=[],
+                filter_query="",
             ),
         ),
         style={"padding": "0.5em", "border": "1px solid silver", "borderRadius": "5px"},
@@ -97,9 +153,25 @@ final_mapping_form = dbc.Container(
                 dbc.Col(
                     [
                         dcc.Download(id="download-intermediate-mapping"),
-                        dbc.Button(
-                            SAVE_INTERMEDIATE_FILE,
-                            id="save-intermediate",
+                        dbc.InputGroup(
+                            [
+                                dbc.Button(
+                                    SAVE_INTERMEDIATE_FILE,
+                                    id="save-intermediate",
+                                ),
+                                dbc.Select(
+                                    id="intermediate-format",
+                                    options=[
+                                        {"label": "CSV", "value": "csv"},
+                                        {
+                                            "label": "Parquet",
+                                            "value": "parquet",
+                                            "disabled": not parquet_available(),
+                                        },
+                                    ],
+                                    value="csv",
+                                ),
+                            ],
                             style={"marginTop": "1em", "marginLeft": "0.6em"},
                         ),
                     ]
@@ -178,6 +250,7 @@ final_mapping_form = dbc.Container(
     State("upload-input-file", "filename"),
     State("upload-col-responses", "value"),
     State("upload-col-description", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
 def upload_data_dictionary(
@@ -185,6 +258,7 @@ def upload_data_dictionary(
     filename,
     col_responses,
     col_description,
+    session_id,
 ):
     ok = html.P(
         f"✓ Upload successful: {filename}",
@@ -210,7 +284,10 @@ def upload_data_dictionary(
                 response_field=col_responses,
                 response_func="redcap",
             )
-            return data.to_json(), ok
+            # the data dictionary is kept on the server, only a summary
+            # is sent to the browser
+            SESSIONS.set(session_id, "dictionary", data)
+            return {"filename": filename, "rows": len(data)}, ok
 
         except Exception as e:
             print(e)
@@ -236,132 +313,260 @@ def set_loading_save_fhirflat(_):
     return [dbc.Spinner(size="sm"), DOWNLOAD_FHIRFLAT_MAPPING[1:]]
 
 
-def stringify_response_columns(df: pd.DataFrame):
-    "Stringify response columns for output in mapping frame"
+def map_job(job: Job, session_id, version, method, num_matches, threshold):
+    "Maps the session data dictionary to ARC, storing the mapping in the session"
+    dictionary = SESSIONS.get(session_id, "dictionary")
+    with request(job.id), span("app.map", method=method, rows=len(dictionary)):
+        job.report(0.05, "Reading ARC")
+        arc = read_arc_schema(version)
+        job.report(0.2, "Mapping")
+        mapped_data = use_map(method, dictionary, arc, num_matches, threshold)
+        job.report(0.9, "Preparing table")
+        with span("app.mapping_table"):
+            table = MappingTable(
+                mapped_data,
+                mapping_metadata(dictionary, version, method, num_matches, threshold),
+            )
+        job.report(1.0)
+        SESSIONS.set(session_id, "mapping", table)
+
+
+def job_progress(label: str, job: Job) -> list:
+    "Returns button contents showing progress of a running job"
+    return [dbc.Spinner(size="sm"), f" {job.message or label[2:]} {job.progress:.0%}"]
 
-    def stringify(x):
-        if isinstance(x, list):
-            return str(x)
-        else:
-            return x
 
-    df["raw_response"] = df["raw_response"].map(stringify)
-    df["arc_response"] = df["arc_response"].map(stringify)
+def job_error(job: Job) -> dbc.Alert | None:
+    if job.status == "failed":
+        return dbc.Alert(f"Failed: {job.error}", color="danger", style=JOB_ALERT_STYLE)
+    if job.status == "cancelled":
+        return dbc.Alert("Cancelled", color="secondary", style=JOB_ALERT_STYLE)
+    return None
 
 
 @callback(
-    Output("mapping", "data"),
+    Output("map-job", "data"),
+    Output("map-job-poll", "disabled"),
     Output("map-btn", "children", allow_duplicate=True),
     State("upload-data-dictionary", "data"),
     Input("map-btn", "n_clicks"),
     State("arc-version", "value"),
     State("arc-mapping-method", "value"),
     State("arc-num-matches", "value"),
+    State("arc-threshold", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def invoke_map_arc(data, _, version, method, num_matches):
-    if ctx.triggered_id == "map-btn":
-        arc = read_arc_schema(version)
-        dictionary = pd.read_json(data)
+def invoke_map_arc(_upload, _, version, method, num_matches, threshold, session_id):
+    if (
+        ctx.triggered_id == "map-btn"
+        and SESSIONS.get(session_id, "dictionary") is not None
+    ):
+        # cleared or out of range inputs are None
+        if num_matches is None:
+            num_matches = NUM_MATCHES
+        if threshold is None:
+            threshold = THRESHOLD
+        job = JOBS.submit(map_job, session_id, version, method, num_matches, threshold)
+        return job.id, False, dash.no_update
+    else:
+        return dash.no_update, dash.no_update, MAP_TO_ARC
 
-        mapped_data = use_map(method, dictionary, arc, num_matches)
-        stringify_response_columns(mapped_data)
-        data = mapped_data.to_dict("records")
-        for i, row in enumerate(data):
-            row["id"] = i
-        return data, MAP_TO_ARC
 
-    else:
-        return html.Span("No data to see here"), "↪ Map to ARC"
+@callback(
+    Output("mapping-version", "data"),
+    Output("mapping", "page_current"),
+    Output("map-btn", "children", allow_duplicate=True),
+    Output("map-job-poll", "disabled", allow_duplicate=True),
+    Output("job-status", "children"),
+    Input("map-job-poll", "n_intervals"),
+    State("map-job", "data"),
+    prevent_initial_call=True,
+)
+def poll_map_job(_, job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return dash.no_update, dash.no_update, MAP_TO_ARC, True, None
+    if not job.done:
+        return (
+            dash.no_update,
+            dash.no_update,
+            job_progress(MAP_TO_ARC, job),
+            False,
+            dash.no_update,
+        )
+    if job.status == "done":
+        return time.time_ns(), 0, MAP_TO_ARC, True, None
+    return dash.no_update, dash.no_update, MAP_TO_ARC, True, job_error(job)
+
+
+@callback(
+    Output("job-status", "children", allow_duplicate=True),
+    Input("cancel-jobs", "n_clicks"),
+    State("map-job", "data"),
+    State("fhirflat-job", "data"),
+    prevent_initial_call=True,
+)
+def cancel_jobs(_, map_job_id, fhirflat_job_id):
+    JOBS.cancel(map_job_id)
+    JOBS.cancel(fhirflat_job_id)
+    return dash.no_update
+
+
+@callback(
+    Output("mapping", "data"),
+    Output("mapping", "page_count"),
+    Input("mapping-version", "data"),
+    Input("mapping", "page_current"),
+    Input("mapping", "page_size"),
+    Input("mapping", "sort_by"),
+    Input("mapping", "filter_query"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def update_table(_, page_current, page_size, sort_by, filter_query, session_id):
+    "Sends the visible page of the mapping to the browser"
+    table = SESSIONS.get(session_id, "mapping")
+    if table is None:
+        return [], 1
+    return table.page(page_current or 0, page_size, sort_by, filter_query)
 
 
 @callback(
     Output("mapping", "data", allow_duplicate=True),
-    Output("mapping", "style_data_conditional"),
     Output("mapping", "active_cell"),
-    Input("mapping", "data"),
     Input("mapping", "active_cell"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def handle_status(data, active_cell):
-    if active_cell and active_cell.get("column_id") == "status":
-        i = active_cell.get("row_id")
-        row = data[i]
-        row["status"] = OK if row["status"] == "-" else "-"
-    else:
+def handle_status(active_cell, session_id):
+    if not (active_cell and active_cell.get("column_id") == "status"):
+        raise dash.exceptions.PreventUpdate
+    i = active_cell.get("row_id")
+
+    def toggle(table: MappingTable) -> list:
+        return [(i, "status", OK if table.get(i, "status") == "-" else "-")]
+
+    if not (edits := SESSIONS.edit(session_id, "mapping", toggle)):
         raise dash.exceptions.PreventUpdate
-    highlighted_rows = [i for i in range(len(data)) if data[i]["status"] == OK]
+    [(_, _, status)] = edits
+    # only the changed cell is sent to the browser; row is the position
+    # of the row in the current page
+    data = Patch()
+    data[active_cell["row"]]["status"] = status
     return (
         data,  # mapping data
-        [
-            {
-                "if": {
-                    "filter_query": " || ".join(
-                        f"{{id}} = {k}" for k in highlighted_rows
-                    )
-                },
-                "backgroundColor": HIGHLIGHT_COLOR,
-            }
-        ],  # style_data_conditional
         False,  # unsets active cell, allowing the cell to be clicked immediately again
     )
 
 
+# Sends only cells edited in the table to the server, instead of the table
+clientside_callback(
+    """
+    function(_, data, previous) {
+        if (!data || !previous) {
+            return window.dash_clientside.no_update;
+        }
+        const edits = [];
+        data.forEach((row, i) => {
+            const old = previous[i] || {};
+            for (const column in row) {
+                if (row[column] !== old[column]) {
+                    edits.push({id: row.id, column: column, value: row[column]});
+                }
+            }
+        });
+        return edits.length ? edits : window.dash_clientside.no_update;
+    }
+    """,
+    Output("mapping-edits", "data"),
+    Input("mapping", "data_timestamp"),
+    State("mapping", "data"),
+    State("mapping", "data_previous"),
+    prevent_initial_call=True,
+)
+
+
 @callback(
-    Output("mapping", "data", allow_duplicate=True),
-    Output("mapping", "style_data_conditional", allow_duplicate=True),
+    Output("mapping-edits", "data", allow_duplicate=True),
+    Input("mapping-edits", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def handle_edits(edits, session_id):
+    if not edits:
+        raise dash.exceptions.PreventUpdate
+
+    def cells(table: MappingTable) -> list:
+        return [
+            (edit["id"], edit["column"], edit["value"])
+            for edit in edits
+            if edit["column"] in table.frame.columns and 0 <= edit["id"] < len(table)
+        ]
+
+    if SESSIONS.edit(session_id, "mapping", cells) is None:
+        raise dash.exceptions.PreventUpdate
+    return None
+
+
+@callback(
+    Output("mapping-version", "data", allow_duplicate=True),
+    Output("mapping", "page_current", allow_duplicate=True),
+    Output("arc-version", "value"),
+    Output("arc-mapping-method", "value"),
     Input("upload-intermediate-file", "contents"),
     State("upload-intermediate-file", "filename"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def upload_intermediate_file(contents, filename):
-    df = read_upload_data(contents, filename)
-    assert df is not None
-    data = df.to_dict("records")
-    highlighted_rows = [i for i in range(len(data)) if data[i]["status"] == OK]
+def upload_intermediate_file(contents, filename, session_id):
+    if Path(filename).suffix == ".parquet":
+        _, content_string = contents.split(",")
+        table = MappingTable.read_parquet(io.BytesIO(base64.b64decode(content_string)))
+    else:
+        df = read_upload_data(contents, filename)
+        assert df is not None
+        table = MappingTable(df)
+    SESSIONS.set(session_id, "mapping", table)
+    # restores the settings the mapping was made with, so that mapping
+    # again reuses the cached ARC embeddings
     return (
-        data,  # mapping data
-        [
-            {
-                "if": {
-                    "filter_query": " || ".join(
-                        f"{{id}} = {k}" for k in highlighted_rows
-                    )
-                },
-                "backgroundColor": HIGHLIGHT_COLOR,
-            }
-        ],
+        time.time_ns(),
+        0,
+        table.metadata.get("arc_version", dash.no_update),
+        table.metadata.get("method", dash.no_update),
     )
 
 
 @callback(
     Output("download-intermediate-mapping", "data"),
     Input("save-intermediate", "n_clicks"),
-    State("mapping", "data"),
+    State("intermediate-format", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def handle_download(_, data):
-    if ctx.triggered_id == "save-intermediate":
-        df = pd.DataFrame(data)
-        return dcc.send_data_frame(df.to_csv, "arcmapper-mapping-file.csv", index=False)
+def handle_download(_, file_format, session_id):
+    table = SESSIONS.get(session_id, "mapping")
+    if ctx.triggered_id == "save-intermediate" and table is not None:
+        if file_format == "parquet":
+            return dcc.send_bytes(table.to_parquet, "arcmapper-mapping-file.parquet")
+        return dcc.send_data_frame(
+            table.to_csv, "arcmapper-mapping-file.csv", index=False
+        )
     else:
         raise dash.exceptions.PreventUpdate
 
 
-@callback(
-    Output("download-fhirflat", "data"),
-    Output("save-fhirflat", "children", allow_duplicate=True),
-    Input("save-fhirflat", "n_clicks"),
-    State("mapping", "data"),
-    prevent_initial_call=True,
-)
-def handle_download_fhir(_, data):
-    if ctx.triggered_id == "save-fhirflat":
-        df = pd.DataFrame(data)
-        df = df[df.status == OK].drop(columns=["status", "rank"])
-        dfs_by_resource = merge(df, FHIR_MAPPING)
+def fhirflat_job(job: Job, df: pd.DataFrame) -> bytes:
+    "Returns Excel file of the FHIRflat mapping for approved rows"
+    with request(job.id), span("app.fhirflat", rows=len(df)):
+        job.report(0.05, "Merging")
+        dfs_by_resource = merge(df, get_fhir_mapping())
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        with (
+            span("app.fhirflat.excel"),
+            pd.ExcelWriter(output, engine="xlsxwriter") as writer,
+        ):
             non_empty_resources = [
                 res for res in dfs_by_resource if not dfs_by_resource[res].empty
             ]
@@ -373,17 +578,95 @@ def handle_download_fhir(_, data):
                 {"Resources": non_empty_resources, "Resource Type": resource_type}
             )
             index.to_excel(writer, sheet_name="Resources")
-            for resource in dfs_by_resource:
-                if dfs_by_resource[resource].empty:
-                    continue
+            for k, resource in enumerate(non_empty_resources):
+                job.report(
+                    0.3 + 0.6 * k / len(non_empty_resources), f"Writing {resource}"
+                )
                 dfs_by_resource[resource].to_excel(
                     writer, sheet_name=resource, index=False
                 )
-        data = output.getvalue()
-        return dcc.send_bytes(data, "fhirflat-mapping.xlsx"), DOWNLOAD_FHIRFLAT_MAPPING
+            job.report(0.9, "Saving")
+        return output.getvalue()
+
+
+@callback(
+    Output("fhirflat-job", "data"),
+    Output("fhirflat-job-poll", "disabled"),
+    Output("save-fhirflat", "children", allow_duplicate=True),
+    Input("save-fhirflat", "n_clicks"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def handle_download_fhir(_, session_id):
+    table = SESSIONS.get(session_id, "mapping")
+    if ctx.triggered_id == "save-fhirflat" and table is not None:
+        df = table.frame
+        df = df[df.status == OK].drop(
+            columns=["status", "rank", "similarity"], errors="ignore"
+        )
+        job = JOBS.submit(fhirflat_job, df)
+        return job.id, False, dash.no_update
     else:
-        raise dash.exceptions.PreventUpdate
+        return dash.no_update, dash.no_update, DOWNLOAD_FHIRFLAT_MAPPING
+
+
+@callback(
+    Output("download-fhirflat", "data"),
+    Output("save-fhirflat", "children", allow_duplicate=True),
+    Output("fhirflat-job-poll", "disabled", allow_duplicate=True),
+    Output("job-status", "children", allow_duplicate=True),
+    Input("fhirflat-job-poll", "n_intervals"),
+    State("fhirflat-job", "data"),
+    prevent_initial_call=True,
+)
+def poll_fhirflat_job(_, job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return dash.no_update, DOWNLOAD_FHIRFLAT_MAPPING, True, None
+    if not job.done:
+        return (
+            dash.no_update,
+            job_progress(DOWNLOAD_FHIRFLAT_MAPPING, job),
+            False,
+            dash.no_update,
+        )
+    if job.status == "done":
+        return (
+            dcc.send_bytes(job.result, "fhirflat-mapping.xlsx"),
+            DOWNLOAD_FHIRFLAT_MAPPING,
+            True,
+            None,
+        )
+    return dash.no_update, DOWNLOAD_FHIRFLAT_MAPPING, True, job_error(job)
+
+
+def layout():
+    "Returns app layout, with a new session id for each page load"
+    return html.Div(
+        [
+            dcc.Store(id="session-id", data=new_session_id()),
+            dcc.Store(id="mapping-edits"),
+            dcc.Store(id="mapping-version"),
+            dcc.Store(id="map-job"),
+            dcc.Store(id="fhirflat-job"),
+            dcc.Interval(id="map-job-poll", interval=JOB_POLL_INTERVAL, disabled=True),
+            dcc.Interval(
+                id="fhirflat-job-poll", interval=JOB_POLL_INTERVAL, disabled=True
+            ),
+            navbar,
+            upload_form,
+            arc_form,
+            output_table,
+            final_mapping_form,
+        ]
+    )
 
 
-app.layout = html.Div([navbar, upload_form, arc_form, output_table, final_mapping_form])
+app.layout = layout
 server = app.server
+
+
+@server.route("/metrics")
+def metrics():
+    "Per-stage latency and memory histograms in Prometheus text format"
+    return METRICS.shared().render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
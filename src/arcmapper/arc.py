@@ -1,19 +1,44 @@
 "Module to read ARC schema"
 
+import os
+import time
+import logging
+import threading
+import urllib.error
+import urllib.request
+
 import pandas as pd
 
 from .types import DataType
-from .util import read_csv_with_encoding_detection
+from .cache import cache_dir, slug, load_pickle, save_pickle
+from .metrics import span, timed
+from .util import (
+    read_csv_with_encoding_detection,
+    read_csv_bytes_with_encoding_detection,
+)
 from .dictionary import read_data_dictionary
 
+# Never fetch ARC from the network, only use locally cached schemas
+ARCMAPPER_OFFLINE = os.getenv("ARCMAPPER_OFFLINE", "").lower() in ["1", "true", "yes"]
+
+# Seconds after which an ARC schema held in memory is revalidated with the
+# server; revalidation is a conditional request that only downloads the
+# schema if it has changed
+ARCMAPPER_ARC_REVALIDATE = int(os.getenv("ARCMAPPER_ARC_REVALIDATE", 3600))
+
+ARC_FETCH_TIMEOUT = 30
+
+# In-process cache of parsed ARC schemas: version -> (time loaded, schema)
+_schemas: dict[str, tuple[float, pd.DataFrame]] = {}
+_schemas_lock = threading.Lock()
+
 
 def arc_schema_url(arc_version: str) -> str:
     return f"https://github.com/ISARICResearch/DataPlatform/raw/refs/heads/main/ARCH/ARCH{arc_version}/ARCH.csv"
 
 
-def read_arc_schema(
-    arc_version_or_file: str, preset: str | None = None
-) -> pd.DataFrame:
+def parse_arc_schema(arc: pd.DataFrame) -> pd.DataFrame:
+    "Parses ARC schema from ARCH.csv into the data dictionary format"
     types_mapping: dict[str, DataType] = {
         "radio": "enum",
         "number": "number",
@@ -23,12 +48,6 @@ def read_arc_schema(
         "dropdown": "enum",
         "datetime_dmy": "date",
     }
-    arc_location = (
-        arc_version_or_file
-        if arc_version_or_file.endswith(".csv")
-        else arc_schema_url(arc_version_or_file)
-    )
-    arc = read_csv_with_encoding_detection(arc_location)
     arc["Description"] = arc.Question + " " + arc.Definition
     arc["Type"] = arc.Type.map(types_mapping)
     dd = read_data_dictionary(
@@ -39,10 +58,99 @@ def read_arc_schema(
         response_field="Answer Options",
         response_func="redcap",
     )
-    dd = dd[~pd.isna(dd.description)]
+    # keep preset columns, used to select subsets of ARC
+    for col in arc.columns:
+        if col.startswith("preset_"):
+            dd[col] = arc[col]
+    return dd[~pd.isna(dd.description)]
+
+
+def fetch_arc_schema(
+    arc_version: str, etag: str | None = None
+) -> tuple[pd.DataFrame | None, str | None]:
+    """Fetches ARC schema from GitHub
+
+    If etag is specified, a conditional request is made, and None is
+    returned in place of the schema if the schema has not changed.
+
+    Returns
+    -------
+    tuple[pd.DataFrame | None, str | None]
+        Parsed ARC schema and ETag of the response
+    """
+    request = urllib.request.Request(arc_schema_url(arc_version))
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        with span("arc.download", arc_version=arc_version):
+            with urllib.request.urlopen(request, timeout=ARC_FETCH_TIMEOUT) as response:
+                data = response.read()
+                etag = response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag
+        raise
+    return parse_arc_schema(read_csv_bytes_with_encoding_detection(data)), etag
+
+
+def load_arc_version(arc_version: str) -> pd.DataFrame:
+    """Loads parsed ARC schema for a version
+
+    Schemas are looked up in memory, then in the on-disk cache, and are
+    fetched from GitHub if not cached. Cached schemas are revalidated with
+    GitHub every ARCMAPPER_ARC_REVALIDATE seconds, unless ARCMAPPER_OFFLINE
+    is set. If GitHub is not reachable, the cached schema is used.
+    """
+    with _schemas_lock:
+        if arc_version in _schemas:
+            loaded, arc = _schemas[arc_version]
+            if ARCMAPPER_OFFLINE or time.time() - loaded < ARCMAPPER_ARC_REVALIDATE:
+                return arc
+
+    directory = cache_dir("arc")
+    path = directory / ("ARCH" + slug(arc_version) + ".pkl") if directory else None
+    cached = load_pickle(path) if path else None
+    arc, etag = (cached["schema"], cached["etag"]) if cached else (None, None)
+
+    if ARCMAPPER_OFFLINE:
+        if arc is None:
+            raise ValueError(
+                f"ARC schema {arc_version} is not cached, and offline mode is set"
+            )
+    else:
+        try:
+            fetched, etag = fetch_arc_schema(arc_version, etag)
+            if fetched is not None:
+                arc = fetched
+                if path is not None:
+                    save_pickle(path, {"schema": arc, "etag": etag})
+        except (urllib.error.URLError, OSError) as e:
+            if arc is None:
+                raise
+            logging.warning(f"Using cached ARC schema {arc_version}: {e}")
+
+    with _schemas_lock:
+        _schemas[arc_version] = (time.time(), arc)
+    return arc
+
+
+@timed("arc.read_arc_schema")
+def read_arc_schema(
+    arc_version_or_file: str, preset: str | None = None
+) -> pd.DataFrame:
+    if arc_version_or_file.endswith(".csv"):
+        dd = parse_arc_schema(read_csv_with_encoding_detection(arc_version_or_file))
+    else:
+        dd = load_arc_version(arc_version_or_file)
     if preset:
         preset_col = "preset_" + preset
-        if preset_col not in arc.columns:
+        if preset_col not in dd.columns:
             raise ValueError(f"No such preset column exists in ARC: {preset_col}")
         dd = dd[dd[preset_col] == 1]
+    else:
+        # shallow copy, so that the shared cached schema is not modified
+        dd = dd.copy(deep=False)
+    # used to identify cached artifacts derived from this schema
+    dd.attrs["arc_version"] = arc_version_or_file
+    dd.attrs["preset"] = preset
     return dd
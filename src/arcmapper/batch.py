@@ -0,0 +1,294 @@
+"""Headless batch mapping of many data dictionaries to ARC
+
+Dictionaries are parsed in a process pool. TF-IDF mappings are also
+computed in the pool, while sentence transformer mappings are computed in
+the main process, so that one loaded model and one ARC embedding matrix
+are shared across all dictionaries.
+"""
+
+import os
+import glob
+import logging
+import argparse
+from pathlib import Path
+from typing import Any
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .arc import read_arc_schema
+from .dictionary import read_data_dictionary
+from .embeddings import arc_embeddings
+from .strategies import STRATEGIES
+from .table import MappingTable, mapping_metadata
+from .tfidf import arc_tfidf
+from .util import read_csv_with_encoding_detection
+
+# Number of worker processes used for batch mapping, defaults to number of CPUs
+ARCMAPPER_BATCH_WORKERS = int(os.getenv("ARCMAPPER_BATCH_WORKERS", 0)) or None
+
+# Mapping methods that are run in worker processes; other methods are run
+# in the main process to share loaded models
+PARALLEL_METHODS = ["tf-idf"]
+
+DICTIONARY_SUFFIXES = [".csv", ".xlsx"]
+
+# Formats of intermediate mapping files, parquet requires pyarrow
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+# REDCap data dictionary column names
+REDCAP_DESCRIPTION_FIELD = "Field Label"
+REDCAP_RESPONSE_FIELD = "Choices, Calculations, OR Slider Labels"
+
+# ARC schema in each worker process, set by the pool initializer
+_arc: pd.DataFrame | None = None
+
+
+def find_dictionaries(inputs: list[str]) -> list[Path]:
+    "Expands directories and glob patterns to a list of data dictionary files"
+    files: list[Path] = []
+    for pattern in inputs:
+        path = Path(pattern)
+        if path.is_dir():
+            found = sorted(p for p in path.iterdir() if p.suffix in DICTIONARY_SUFFIXES)
+        elif path.exists():
+            found = [path]
+        else:
+            found = sorted(Path(p) for p in glob.glob(pattern, recursive=True))
+        files.extend(p for p in found if p not in files)
+    return files
+
+
+def output_file(
+    file: Path, output_dir: Path, method: str, output_format: str = "csv"
+) -> Path:
+    "Returns path of the intermediate mapping file for a data dictionary"
+    return output_dir / f"{file.stem}-mapping-{method}.{output_format}"
+
+
+def read_dictionary(
+    file: Path,
+    description_field: str = REDCAP_DESCRIPTION_FIELD,
+    response_field: str = REDCAP_RESPONSE_FIELD,
+) -> pd.DataFrame:
+    "Reads a REDCap data dictionary, detecting encoding of CSV files"
+    source = (
+        read_csv_with_encoding_detection(str(file))
+        if file.suffix == ".csv"
+        else pd.read_excel(file)
+    )
+    return read_data_dictionary(
+        source,
+        description_field=description_field,
+        response_field=response_field,
+        response_func="redcap",
+    )
+
+
+def write_mapping(
+    mapping: pd.DataFrame, path: Path, metadata: dict[str, Any] | None = None
+):
+    """Writes mapping in the intermediate file format used by the app
+
+    The format is chosen by file suffix, metadata is only kept in Parquet files.
+    """
+    table = MappingTable(mapping, metadata)
+    if path.suffix == ".parquet":
+        table.to_parquet(str(path))
+    else:
+        table.to_csv(path, index=False)
+
+
+def _init_worker(arc: pd.DataFrame | None):
+    global _arc
+    _arc = arc
+
+
+def _map_dictionary(
+    dictionary: pd.DataFrame,
+    arc: pd.DataFrame,
+    output: Path,
+    method: str,
+    num_matches: int,
+    threshold: float,
+) -> Path:
+    write_mapping(
+        STRATEGIES[method](
+            dictionary, arc, num_matches=num_matches, threshold=threshold
+        ),
+        output,
+        mapping_metadata(
+            dictionary,
+            str(arc.attrs.get("arc_version", "local")),
+            method,
+            num_matches,
+            threshold,
+        ),
+    )
+    return output
+
+
+def _map_file(
+    file: Path,
+    output: Path,
+    method: str,
+    num_matches: int,
+    threshold: float,
+    dictionary_options: dict[str, str],
+) -> Path:
+    assert _arc is not None, "worker not initialized with ARC schema"
+    dictionary = read_dictionary(file, **dictionary_options)
+    return _map_dictionary(dictionary, _arc, output, method, num_matches, threshold)
+
+
+def map_dictionaries(
+    files: list[Path],
+    arc_version: str,
+    method: str,
+    output_dir: Path,
+    num_matches: int = 5,
+    threshold: float = 0.3,
+    preset: str | None = None,
+    workers: int | None = ARCMAPPER_BATCH_WORKERS,
+    output_format: str = "csv",
+    **dictionary_options: str,
+) -> dict[Path, Path | None]:
+    """Maps data dictionaries to ARC, writing intermediate mapping files
+
+    Parameters
+    ----------
+    files
+        REDCap data dictionaries to map, see :meth:`find_dictionaries`
+    arc_version
+        ARC version or ARCH.csv file, see :meth:`arcmapper.read_arc_schema`
+    method
+        Mapping method, one of the keys of STRATEGIES: 'tf-idf' or 'sbert'
+    output_dir
+        Directory in which intermediate mapping files are written
+    num_matches
+        Number of matches to return
+    threshold
+        Similarity threshold beyond which a match is reported, see
+        :meth:`arcmapper.strategies.tf_idf`
+    preset
+        ARC preset to restrict mapping to
+    workers
+        Number of worker processes, defaults to number of CPUs
+    output_format
+        Format of intermediate mapping files, one of OUTPUT_FORMATS; Parquet
+        files keep responses as lists and the mapping metadata
+    dictionary_options
+        Column names passed to :meth:`read_dictionary`
+
+    Returns
+    -------
+    dict[Path, Path | None]
+        Intermediate mapping file for each data dictionary, or None if
+        mapping failed
+    """
+    if method not in STRATEGIES:
+        raise ValueError(f"Unknown mapping method: {method}")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    arc = read_arc_schema(arc_version, preset)
+    parallel = method in PARALLEL_METHODS
+    results: dict[Path, Path | None] = {}
+    if method == "tf-idf":
+        # fitted before worker processes start, so that they inherit the
+        # model, or read it from the cache directory, instead of fitting it
+        arc_tfidf(arc)
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(arc if parallel else None,)
+    ) as pool:
+        if parallel:
+            futures = {
+                file: pool.submit(
+                    _map_file,
+                    file,
+                    output_file(file, output_dir, method, output_format),
+                    method,
+                    num_matches,
+                    threshold,
+                    dictionary_options,
+                )
+                for file in files
+            }
+        else:
+            futures = {
+                file: pool.submit(read_dictionary, file, **dictionary_options)
+                for file in files
+            }
+            if method == "sbert":
+                # computed once here, and read from cache for each dictionary
+                arc_embeddings(arc)
+
+        for file, future in futures.items():
+            try:
+                if parallel:
+                    results[file] = future.result()
+                else:
+                    results[file] = _map_dictionary(
+                        future.result(),
+                        arc,
+                        output_file(file, output_dir, method, output_format),
+                        method,
+                        num_matches,
+                        threshold,
+                    )
+                logging.info(f"Mapped {file} -> {results[file]}")
+            except Exception as e:
+                logging.error(f"Failed to map {file}: {e}")
+                results[file] = None
+    return results
+
+
+def cli(args: list[str] | None = None) -> int:
+    "Entry point for the 'arcmapper map' command"
+    p = argparse.ArgumentParser(
+        prog="arcmapper map",
+        description="Map REDCap data dictionaries to ARC without the web interface",
+    )
+    p.add_argument(
+        "inputs", nargs="+", help="Data dictionary files, directories or glob patterns"
+    )
+    p.add_argument("-a", "--arc-version", required=True, help="ARC version or file")
+    p.add_argument("-m", "--method", choices=list(STRATEGIES), default="tf-idf")
+    p.add_argument("-o", "--output-dir", type=Path, default=Path("."))
+    p.add_argument("-n", "--num-matches", type=int, default=5)
+    p.add_argument("-t", "--threshold", type=float, default=0.3)
+    p.add_argument("--preset", help="ARC preset to restrict mapping to")
+    p.add_argument("-j", "--workers", type=int, default=ARCMAPPER_BATCH_WORKERS)
+    p.add_argument(
+        "-f",
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Format of intermediate mapping files, parquet requires pyarrow",
+    )
+    p.add_argument("--description-field", default=REDCAP_DESCRIPTION_FIELD)
+    p.add_argument("--response-field", default=REDCAP_RESPONSE_FIELD)
+    ns = p.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    files = find_dictionaries(ns.inputs)
+    if not files:
+        logging.error("No data dictionaries found")
+        return 1
+    results = map_dictionaries(
+        files,
+        ns.arc_version,
+        ns.method,
+        ns.output_dir,
+        num_matches=ns.num_matches,
+        threshold=ns.threshold,
+        preset=ns.preset,
+        workers=ns.workers,
+        output_format=ns.format,
+        description_field=ns.description_field,
+        response_field=ns.response_field,
+    )
+    failed = [file for file, output in results.items() if output is None]
+    print(f"Mapped {len(results) - len(failed)} of {len(results)} data dictionaries")
+    return 1 if failed else 0
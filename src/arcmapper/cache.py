@@ -0,0 +1,105 @@
+"On-disk cache for artifacts that are expensive to recompute"
+
+import os
+import re
+import pickle
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Any, BinaryIO, Callable
+
+import numpy as np
+import pandas as pd
+
+ARCMAPPER_CACHE_DIR = Path(
+    os.getenv("ARCMAPPER_CACHE_DIR", Path.home() / ".cache" / "arcmapper")
+)
+
+
+def cache_dir(kind: str) -> Path | None:
+    """Returns cache directory for a kind of artifact, creating it if needed
+
+    Returns None if the cache directory cannot be created, in which case
+    callers should recompute instead of caching.
+    """
+    path = ARCMAPPER_CACHE_DIR / kind
+    try:
+        path.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logging.warning(f"Cache directory not available: {path}: {e}")
+        return None
+    return path
+
+
+def slug(s: str) -> str:
+    "Returns filesystem safe version of a string, such as a model name"
+    return re.sub(r"[^A-Za-z0-9.]+", "_", s).strip("_")
+
+
+def text_hash(texts: list[str]) -> str:
+    "Returns content hash of a list of strings"
+    h = hashlib.sha256()
+    for t in texts:
+        h.update(t.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    "Returns content hash of a data frame, including columns with list values"
+    h = hashlib.sha256(",".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy())
+    return h.hexdigest()
+
+
+def atomic_write(path: Path, write: Callable[[BinaryIO], None]):
+    """Atomically writes file, so that concurrent readers never see partial files
+
+    Failure to write is logged and not raised, as the cache is optional.
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    except OSError as e:
+        logging.warning(f"Could not write cache file {path}: {e}")
+        return
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            write(fp)
+        os.replace(tmp, path)
+    except OSError as e:
+        Path(tmp).unlink(missing_ok=True)
+        logging.warning(f"Could not write cache file {path}: {e}")
+
+
+def save_npy(path: Path, array: np.ndarray):
+    "Saves array to cache, see :meth:`atomic_write`"
+    atomic_write(path, lambda fp: np.save(fp, array))
+
+
+def load_npy(path: Path) -> np.ndarray | None:
+    "Loads memory-mapped array, returns None if missing or unreadable"
+    if not path.exists():
+        return None
+    try:
+        return np.load(path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable cache file {path}: {e}")
+        return None
+
+
+def save_pickle(path: Path, obj: Any):
+    "Saves object to cache, see :meth:`atomic_write`"
+    atomic_write(path, lambda fp: pickle.dump(obj, fp, pickle.HIGHEST_PROTOCOL))
+
+
+def load_pickle(path: Path) -> Any | None:
+    "Loads object saved by :meth:`save_pickle`, returns None if missing or unreadable"
+    if not path.exists():
+        return None
+    try:
+        with path.open("rb") as fp:
+            return pickle.load(fp)
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable cache file {path}: {e}")
+        return None
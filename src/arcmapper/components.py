@@ -1,7 +1,7 @@
 from dash import html, dcc
 import dash_bootstrap_components as dbc
 
-from .labels import UPLOAD_DATA_DICTIONARY, MAP_TO_ARC
+from .labels import UPLOAD_DATA_DICTIONARY, MAP_TO_ARC, CANCEL
 
 
 def select(id: str, values: list[str], default: str | None = None) -> dbc.Select:
@@ -136,9 +136,19 @@ arc_form = dbc.Container(
                             ),
                         ),
                         dbc.Col(dbc.Button(MAP_TO_ARC, id="map-btn"), width="auto"),
+                        dbc.Col(
+                            dbc.Button(
+                                CANCEL,
+                                id="cancel-jobs",
+                                color="secondary",
+                                outline=True,
+                            ),
+                            width="auto",
+                        ),
                     ],
                     className="g-2",
                 ),
+                dbc.Row(id="job-status"),
             ]
         ),
         style={
@@ -5,12 +5,19 @@ import operator
 from typing import Any, NamedTuple
 
 import pandas as pd
-from pandas.api.types import is_object_dtype
+from pandas.api.types import is_object_dtype, is_string_dtype
+from .metrics import timed
 from .types import DataType
-from .util import read_data, parse_redcap_response
+from .util import read_data_chunks, parse_redcap_response, parse_redcap_responses
 
 RESPONSE_PARSERS = {"redcap": parse_redcap_response}
 
+# Parsers of a column of responses, used in place of RESPONSE_PARSERS
+RESPONSE_COLUMN_PARSERS = {"redcap": parse_redcap_responses}
+
+# Number of rows sampled to infer the description field
+DESCRIPTION_SAMPLE_ROWS = 1000
+
 
 class DictionaryField(NamedTuple):
     "Data dictionary field"
@@ -21,6 +28,32 @@ class DictionaryField(NamedTuple):
     type: DataType
 
 
+def infer_description_field(dd: pd.DataFrame) -> str:
+    "Returns the stringly typed column with the maximum mean length in a sample"
+    sample = (
+        dd.sample(DESCRIPTION_SAMPLE_ROWS, random_state=0)
+        if len(dd) > DESCRIPTION_SAMPLE_ROWS
+        else dd
+    )
+    return max(
+        (
+            (c, sample[c].map(lambda x: len(x) if isinstance(x, str) else 0).mean())
+            for c in sample.columns
+            if is_object_dtype(sample[c]) or is_string_dtype(sample[c])
+        ),
+        key=operator.itemgetter(1),
+    )[0]
+
+
+def parse_responses(values: pd.Series, response_func: str) -> pd.Series:
+    "Parses a column of responses, values that are not strings are parsed as None"
+    if response_func in RESPONSE_COLUMN_PARSERS:
+        return RESPONSE_COLUMN_PARSERS[response_func](values)
+    parser = RESPONSE_PARSERS[response_func]
+    return values.map(lambda x: parser(x) if isinstance(x, str) else None)
+
+
+@timed("dictionary.read_data_dictionary")
 def read_data_dictionary(
     source: str | pd.DataFrame,
     variable_field: str | None = None,
@@ -28,6 +61,7 @@ def read_data_dictionary(
     type_field: str | None = None,
     response_field: str | None = None,
     response_func: str | None = None,
+    chunksize: int | None = None,
 ) -> pd.DataFrame:
     """Reads from data dictionary file or data frame
 
@@ -44,7 +78,8 @@ def read_data_dictionary(
         column
     description_field
         Field to use for description. If not specified, is taken to be the
-        stringly typed column with the maximum mean length.
+        stringly typed column with the maximum mean length in a sample of
+        rows.
     type_field
         Field to use for type information. If not specified, every type
         defaults to 'string'
@@ -52,41 +87,44 @@ def read_data_dictionary(
         Response field to use
     response_func
         Function that takes a string and returns a Responses type
+    chunksize
+        If specified, files are read in chunks of this many rows, which
+        reduces peak memory use for very large files. The description field
+        is then inferred from the first chunk.
 
     Returns
     -------
     pd.DataFrame
         Data dictionary
     """
-    dd = read_data(source)
-    variable_field = variable_field or dd.columns[0]
-    if description_field is None:
-        description_field = max(
-            (
-                (c, dd[c].map(lambda x: len(x) if isinstance(x, str) else 0).mean())
-                for c in dd.columns
-                if is_object_dtype(dd[c])
-            ),
-            key=operator.itemgetter(1),
-        )[0]
     if (response_field is None) ^ (response_func is None):
         raise ValueError("Both response_field and response_func have to be specified")
     assert (
-        response_func in RESPONSE_PARSERS
+        response_func is None or response_func in RESPONSE_PARSERS
     ), f"Unknown response parser: {response_func}"
-    return pd.DataFrame(
-        [
-            DictionaryField(
-                row[variable_field],
-                row[description_field],
-                RESPONSE_PARSERS[response_func](row[response_field])
-                if response_field and isinstance(row[response_field], str)
-                else None,
-                row[type_field] if type_field else "string",
+
+    dictionary = []
+    for dd in read_data_chunks(source, chunksize):
+        variable_field = variable_field or dd.columns[0]
+        description_field = description_field or infer_description_field(dd)
+        dictionary.append(
+            pd.DataFrame(
+                {
+                    "variable": dd[variable_field].to_numpy(),
+                    "description": dd[description_field].to_numpy(),
+                    "responses": (
+                        parse_responses(dd[response_field], response_func).to_numpy()
+                        if response_field and response_func
+                        else None
+                    ),
+                    "type": dd[type_field].to_numpy() if type_field else "string",
+                },
+                columns=list(DictionaryField._fields),
             )
-            for row in dd.to_dict(orient="records")
-        ]
-    )
+        )
+    if not dictionary:
+        return pd.DataFrame(columns=list(DictionaryField._fields))
+    return pd.concat(dictionary, ignore_index=True)
 
 
 def read_from_data(data: str | pd.DataFrame) -> pd.DataFrame:
@@ -0,0 +1,385 @@
+"Text construction and cached embeddings for the sbert strategy"
+
+import os
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import contextlib
+from typing import Iterator, Literal
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .cache import cache_dir, slug, text_hash, save_npy, load_npy
+from .jobs import check_cancelled
+from .metrics import span, timed
+from .models import SBERT_MODEL, get_model
+from .util import top_k
+
+IndexType = Literal["float16", "int8"]
+
+# Use an EmbeddingIndex of this type for the sbert strategy, instead of
+# computing the full similarity matrix; one of 'float16' or 'int8'
+ARCMAPPER_SBERT_INDEX = os.getenv("ARCMAPPER_SBERT_INDEX") or None
+
+# Identifies the way text is built from ARC and dictionary fields, change
+# this whenever arc_text() or dictionary_text() change to invalidate caches
+TEXT_RECIPE = "v1"
+
+# Maximum size of embeddings of text kept in the text embedding cache, in
+# megabytes; least recently used embeddings are evicted beyond this, and 0
+# disables the cache
+ARCMAPPER_TEXT_CACHE_MB = float(os.getenv("ARCMAPPER_TEXT_CACHE_MB", "512"))
+
+# Number of texts encoded by the model at once; cancelled jobs stop between
+# batches
+ENCODE_BATCH = 1024
+
+# Text embedding caches by path, see text_cache()
+_text_caches: dict[Path, "TextEmbeddingCache"] = {}
+_text_caches_lock = threading.Lock()
+
+# Number of texts looked up in a single query of the text embedding cache,
+# below the SQLite limit on query parameters
+TEXT_CACHE_CHUNK = 500
+
+
+def dictionary_text(dictionary: pd.DataFrame) -> list[str]:
+    "Text used to embed data dictionary fields"
+    return list(
+        dictionary.variable.astype(str).replace("_", " ")
+        + dictionary.description.map(lambda x: x if isinstance(x, str) else "")
+    )
+
+
+def arc_text(arc: pd.DataFrame) -> list[str]:
+    "Text used to embed ARC fields"
+    return list(
+        arc.variable.astype(str).replace("_", " ") + " " + arc.description.astype(str)
+    )
+
+
+def arc_cache_key(arc: pd.DataFrame, texts: list[str], model: str) -> str:
+    """Returns cache key for ARC embeddings
+
+    The ARC version and preset are included for readability, the content
+    hash of the text ensures that changes in ARC invalidate the cache.
+    """
+    return "-".join(
+        [
+            "arc",
+            slug(str(arc.attrs.get("arc_version", "local"))),
+            slug(str(arc.attrs.get("preset") or "all")),
+            slug(model),
+            TEXT_RECIPE,
+            text_hash(texts)[:16],
+        ]
+    )
+
+
+def normalize_text(text: str) -> str:
+    "Returns text with runs of whitespace collapsed, as embedded and cached"
+    return " ".join(str(text).split())
+
+
+class TextEmbeddingCache:
+    """Persistent cache of embeddings of text, keyed by model and text hash
+
+    Field labels, such as those of demographics and vital signs, repeat
+    across data dictionaries of different sites, so that most text is only
+    encoded once. Embeddings are stored as float32 in a SQLite database
+    in the arcmapper cache directory, which can be shared by processes.
+    When the stored embeddings exceed max_bytes, the least recently used
+    are evicted.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "nbytes INTEGER NOT NULL, used REAL NOT NULL, "
+                "PRIMARY KEY (model, hash))"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        "Connection committing on exit; connections are not shared by threads"
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def key(text: str) -> str:
+        "Returns hash of normalized text"
+        return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+    def get(self, model: str, keys: list[str]) -> dict[str, np.ndarray]:
+        "Returns cached embeddings by key, marking them as recently used"
+        found = {}
+        with self._connect() as db:
+            for i in range(0, len(keys), TEXT_CACHE_CHUNK):
+                chunk = keys[i : i + TEXT_CACHE_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                rows = db.execute(
+                    f"SELECT hash, vector FROM embeddings "
+                    f"WHERE model = ? AND hash IN ({marks})",
+                    [model, *chunk],
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                if rows:
+                    db.execute(
+                        f"UPDATE embeddings SET used = ? "
+                        f"WHERE model = ? AND hash IN ({marks})",
+                        [time.time(), model, *chunk],
+                    )
+        return found
+
+    def put(self, model: str, embeddings: dict[str, np.ndarray]):
+        "Stores embeddings by key, evicting least recently used beyond max_bytes"
+        now = time.time()
+        with self._connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                [
+                    (model, key, vector.tobytes(), vector.nbytes, now)
+                    for key, vector in (
+                        (k, np.asarray(v, dtype=np.float32))
+                        for k, v in embeddings.items()
+                    )
+                ],
+            )
+            (total,) = db.execute("SELECT total(nbytes) FROM embeddings").fetchone()
+            if total <= self.max_bytes:
+                return
+            # evict down to 90% of the limit, so eviction does not run on
+            # every subsequent put
+            excess = total - 0.9 * self.max_bytes
+            evict = []
+            for rowid, nbytes in db.execute(
+                "SELECT rowid, nbytes FROM embeddings ORDER BY used"
+            ):
+                if excess <= 0:
+                    break
+                evict.append((rowid,))
+                excess -= nbytes
+            db.executemany("DELETE FROM embeddings WHERE rowid = ?", evict)
+            logging.info(f"Evicted {len(evict)} embeddings from {self.path}")
+
+    def __len__(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT count(*) FROM embeddings").fetchone()[0]
+
+
+def text_cache() -> TextEmbeddingCache | None:
+    """Returns the text embedding cache, or None if disabled or not available
+
+    One cache is kept per path for the life of the process, so that the
+    database is only set up once.
+    """
+    if ARCMAPPER_TEXT_CACHE_MB <= 0 or (directory := cache_dir("embeddings")) is None:
+        return None
+    path = directory / "text.sqlite"
+    with _text_caches_lock:
+        if path in _text_caches:
+            return _text_caches[path]
+        try:
+            store = TextEmbeddingCache(path, int(ARCMAPPER_TEXT_CACHE_MB * 2**20))
+        except sqlite3.Error as e:
+            logging.warning(f"Text embedding cache not available: {e}")
+            return None
+        _text_caches[path] = store
+        return store
+
+
+def encode(
+    texts: list[str], model: str = SBERT_MODEL, write_cache: bool = True
+) -> np.ndarray:
+    """Returns float32 embeddings of texts, using the text embedding cache
+
+    Text is normalized, see :func:`normalize_text`, and each distinct text
+    not in the cache is encoded once by the model, see
+    :class:`TextEmbeddingCache`. If write_cache is False, newly encoded text
+    is not added to the cache, such as ARC text stored elsewhere.
+    """
+    texts = [normalize_text(t) for t in texts]
+    keys = [TextEmbeddingCache.key(t) for t in texts]
+    unique = dict(zip(keys, texts))
+    store = text_cache()
+    found = {}
+    if store is not None:
+        try:
+            found = store.get(model, list(unique))
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read text embedding cache: {e}")
+    missing = [key for key in unique if key not in found]
+    if missing or not texts:
+        with span(
+            "embeddings.encode", texts=len(missing), cached=len(unique) - len(missing)
+        ):
+            vectors = _encode_batches(
+                get_model(model), [unique[key] for key in missing]
+            )
+        if not texts:
+            return vectors
+        new = dict(zip(missing, vectors))
+        if store is not None and write_cache:
+            try:
+                store.put(model, new)
+            except sqlite3.Error as e:
+                logging.warning(f"Could not write text embedding cache: {e}")
+        found.update(new)
+    return np.stack([found[key] for key in keys])
+
+
+def _encode_batches(sbert_model, texts: list[str]) -> np.ndarray:
+    "Encodes texts in batches of ENCODE_BATCH, so that jobs can be cancelled"
+    batches = []
+    for i in range(0, len(texts), ENCODE_BATCH):
+        check_cancelled()
+        batches.append(
+            np.asarray(sbert_model.encode(texts[i : i + ENCODE_BATCH]), np.float32)
+        )
+    if not batches:
+        return np.asarray(sbert_model.encode([]), dtype=np.float32)
+    return np.concatenate(batches)
+
+
+@timed("embeddings.arc_embeddings")
+def arc_embeddings(arc: pd.DataFrame, model: str = SBERT_MODEL) -> np.ndarray:
+    """Returns embeddings of ARC text, reading from cache where possible
+
+    Embeddings are stored as .npy files in the arcmapper cache directory and
+    are memory-mapped on load.
+    """
+    texts = arc_text(arc)
+    directory = cache_dir("embeddings")
+    if directory is None:
+        return encode(texts, model)
+    path = directory / (arc_cache_key(arc, texts, model) + ".npy")
+    if (embeddings := load_npy(path)) is not None and len(embeddings) == len(texts):
+        return embeddings
+    # stored in the .npy file, so not also in the text embedding cache
+    embeddings = encode(texts, model, write_cache=False)
+    save_npy(path, embeddings)
+    return embeddings
+
+
+class EmbeddingIndex:
+    """Brute-force cosine similarity index over quantized embeddings
+
+    Embeddings are normalized and stored either as float16, or as int8 with
+    a scale factor per vector, reducing memory use by a factor of 2 or 4
+    respectively at the cost of a small loss of precision in scores. Scale
+    factors are applied to scores rather than to vectors when querying.
+    """
+
+    def __init__(self, vectors: np.ndarray, scale: np.ndarray | None = None):
+        self.vectors = vectors
+        self.scale = scale
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @classmethod
+    def build(
+        cls, embeddings: np.ndarray, index_type: IndexType = "float16"
+    ) -> "EmbeddingIndex":
+        "Builds index from embeddings"
+        vectors = normalize(embeddings)
+        match index_type:
+            case "float16":
+                return cls(vectors.astype(np.float16))
+            case "int8":
+                scale = np.abs(vectors).max(axis=1) / 127
+                scale[scale == 0] = 1
+                return cls(
+                    np.round(vectors / scale[:, None]).astype(np.int8),
+                    scale.astype(np.float32),
+                )
+            case _:
+                raise ValueError(f"Unknown index type: {index_type}")
+
+    def query(
+        self, queries: np.ndarray, num_matches: int, chunk_size: int = 1024
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns indices and scores of the top matches for each query
+
+        Queries are processed in chunks, so the full similarity matrix is
+        never allocated, see :meth:`arcmapper.util.top_k`. Vectors are
+        converted to float32 one chunk at a time, so the index is never
+        held in memory at full precision.
+        """
+        queries = normalize(queries)
+        chunks = []
+        for i in range(0, len(queries), chunk_size):
+            check_cancelled()
+            S = self._similarity(queries[i : i + chunk_size], chunk_size)
+            chunks.append(top_k(S, num_matches))
+        if not chunks:
+            return top_k(np.empty((0, len(self))), num_matches)
+        return (
+            np.concatenate([top for top, _ in chunks]),
+            np.concatenate([scores for _, scores in chunks]),
+        )
+
+    def _similarity(self, queries: np.ndarray, chunk_size: int) -> np.ndarray:
+        "Returns similarity of normalized queries to vectors, in vector chunks"
+        S = np.empty((len(queries), len(self)), dtype=np.float32)
+        for j in range(0, len(self), chunk_size):
+            S[:, j : j + chunk_size] = (
+                queries @ self.vectors[j : j + chunk_size].astype(np.float32).T
+            )
+        if self.scale is not None:
+            S *= self.scale
+        return S
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    "Returns L2 normalized embeddings as float32"
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norm = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norm[norm == 0] = 1
+    return embeddings / norm
+
+
+def arc_index(
+    arc: pd.DataFrame, model: str = SBERT_MODEL, index_type: IndexType = "float16"
+) -> EmbeddingIndex:
+    """Returns EmbeddingIndex of ARC text, reading from cache where possible
+
+    The index is stored next to the cached ARC embeddings, see
+    :meth:`arc_embeddings`
+    """
+    texts = arc_text(arc)
+    directory = cache_dir("embeddings")
+    if directory is None:
+        return EmbeddingIndex.build(arc_embeddings(arc, model), index_type)
+    key = arc_cache_key(arc, texts, model) + "-" + index_type
+    vectors = load_npy(directory / (key + ".npy"))
+    scale = load_npy(directory / (key + "-scale.npy"))
+    if (
+        vectors is not None
+        and len(vectors) == len(texts)
+        and (index_type == "float16" or scale is not None)
+    ):
+        return EmbeddingIndex(vectors, scale)
+    index = EmbeddingIndex.build(arc_embeddings(arc, model), index_type)
+    if index.scale is not None:
+        save_npy(directory / (key + "-scale.npy"), index.scale)
+    save_npy(directory / (key + ".npy"), index.vectors)
+    return index
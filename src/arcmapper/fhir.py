@@ -4,11 +4,17 @@ Mapping file MUST conform to specification at
 https://fhirflat.readthedocs.io/en/latest/spec/mapping.html
 """
 
+import io
+import hashlib
 import warnings
+import functools
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+from .cache import cache_dir, slug, load_pickle, save_pickle
+from .metrics import timed
 from .strategies import infer_response_mapping
 
 VALID_FHIR_RESOURCES = [
@@ -26,6 +32,39 @@ VALID_FHIR_RESOURCES = [
 
 FHIR_RESOURCES_ONE_TO_ONE = ["Patient", "Encounter"]
 
+# Columns on which the mapping frame is joined with FHIR resource sheets
+JOIN_KEYS = ["arc_variable", "arc_response"]
+
+
+def read_mapping_sheets(path: Path) -> dict[str, pd.DataFrame]:
+    """Reads all sheets from FHIR mapping Excel file
+
+    Resource sheets are preprocessed for merging with the mapping frame.
+    The parsed sheets are cached on disk, keyed by a hash of the file
+    contents, so that changes to the file invalidate the cache.
+    """
+    data = path.read_bytes()
+    directory = cache_dir("fhir")
+    cache_path = (
+        directory / f"{slug(path.stem)}-{hashlib.sha256(data).hexdigest()[:16]}.pkl"
+        if directory
+        else None
+    )
+    if cache_path and (sheets := load_pickle(cache_path)) is not None:
+        return sheets
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=None)
+    for name, df in sheets.items():
+        if "raw_variable" not in df.columns:
+            continue
+        # forward fill NaNs to enable merge with mapping frame
+        df["raw_variable"] = df["raw_variable"].ffill()
+        sheets[name] = df.rename(
+            columns={"raw_variable": "arc_variable", "raw_response": "arc_response"}
+        )
+    if cache_path:
+        save_pickle(cache_path, sheets)
+    return sheets
+
 
 class FHIRMapping:
     "Loads mapping file from a Excel (XLSX) sheet"
@@ -34,7 +73,8 @@ class FHIRMapping:
         path = Path(file)
         if path.suffix != ".xlsx":
             raise ValueError("FHIRMapping only supports Excel sheets at the moment")
-        index = pd.read_excel(path)
+        self.sheets = read_mapping_sheets(path)
+        index = next(iter(self.sheets.values()))
         if "Resources" not in index.columns:
             raise ValueError(
                 "Required 'Resources' column not present in FHIR mapping file"
@@ -47,33 +87,96 @@ class FHIRMapping:
         self.path = path
 
     def get_resource(self, resource: str) -> pd.DataFrame:
-        "Gets resource from FHIR mapping Excel sheet"
+        """Gets resource from FHIR mapping Excel sheet
+
+        The returned frame is shared between calls and should not be modified.
+        """
         if resource not in self.resources:
             raise ValueError(
                 f"Resource '{resource}' not found, valid resources: {self.resources}"
             )
-        df = pd.read_excel(self.path, sheet_name=resource)
+        if resource not in self.sheets:
+            raise ValueError(f"Sheet for resource '{resource}' not found")
+        return self.sheets[resource]
 
-        # forward fill NaNs to enable merge with mapping frame
-        df["raw_variable"] = df["raw_variable"].ffill()
-        return df.rename(
-            columns={"raw_variable": "arc_variable", "raw_response": "arc_response"}
+    @functools.cached_property
+    def join_index(self) -> pd.DataFrame:
+        """Index from JOIN_KEYS to rows of all resource sheets
+
+        Has the JOIN_KEYS columns, and the resource and position of the
+        row in the resource sheet, in the order of resources and rows.
+        Built on first use, so that merging a mapping frame only hashes the
+        frame once instead of once per resource, see :meth:`join_resources`.
+        """
+        return pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        **{key: sheet[key].to_numpy() for key in JOIN_KEYS},
+                        "resource": resource,
+                        "row": np.arange(len(sheet)),
+                    }
+                )
+                for resource in self.resources
+                if (sheet := self.sheets.get(resource)) is not None
+            ],
+            ignore_index=True,
         )
 
 
+@timed("fhir.merge")
 def merge(
     draft: pd.DataFrame, mapping: FHIRMapping, resources: list[str] = []
 ) -> dict[str, pd.DataFrame]:
-    out = {}
-    draft = infer_response_mapping(draft)
-    for resource in resources or mapping.resources:
-        # first generate choice responses for each mapping
+    # first generate choice responses for each mapping
+    return join_resources(infer_response_mapping(draft), mapping, resources)
+
+
+def join_resources(
+    draft: pd.DataFrame, mapping: FHIRMapping, resources: list[str] = []
+) -> dict[str, pd.DataFrame]:
+    """Joins mapping frame with FHIR resource sheets on JOIN_KEYS
+
+    The frame is joined once with the join index of the FHIR mapping, and
+    the joined rows are then split by resource. For each resource, this
+    gives the same result as an inner merge of the frame with the resource
+    sheet, see :meth:`FHIRMapping.join_index`
+    """
+    resources = resources or mapping.resources
+    for resource in resources:
         if resource not in mapping.resources:
             warnings.warn(
                 f"Resource requested to be mapped but not found in mapping file: {resource}"
             )
-        out[resource] = draft.merge(
-            mapping.get_resource(resource), on=["arc_variable", "arc_response"]
+        mapping.get_resource(resource)
+
+    draft = draft.reset_index(drop=True)
+    joined = (
+        draft[JOIN_KEYS]
+        .assign(draft_row=np.arange(len(draft)))
+        .merge(mapping.join_index, on=JOIN_KEYS)
+    )
+    groups = joined.groupby("resource", sort=False).indices
+    draft_rows = joined.draft_row.to_numpy()
+    sheet_rows = joined.row.to_numpy()
+    out = {}
+    for resource in resources:
+        positions = groups.get(resource, np.array([], dtype=np.intp))
+        left = draft.take(draft_rows[positions]).reset_index(drop=True)
+        right = (
+            mapping.get_resource(resource)
+            .drop(columns=JOIN_KEYS)
+            .take(sheet_rows[positions])
+            .reset_index(drop=True)
+        )
+        # suffixes of columns present in both, as in pandas.merge
+        overlap = set(left.columns) & set(right.columns)
+        out[resource] = pd.concat(
+            [
+                left.rename(columns={c: c + "_x" for c in overlap}),
+                right.rename(columns={c: c + "_y" for c in overlap}),
+            ],
+            axis=1,
         )
     return out
 
@@ -0,0 +1,309 @@
+"""Background jobs for long-running app callbacks
+
+Jobs run in a bounded thread pool in the server process, so that a long
+mapping does not hold a server thread, while still sharing the loaded
+models and the session store. The app polls jobs for progress.
+
+With several server worker processes, the state of jobs is also written to
+the arcmapper cache directory, so that any worker can poll or cancel a job.
+
+Cancelling takes effect at the next progress report of a job, or at the next
+chunk of long computations, such as encoding or similarity, which call
+:func:`check_cancelled`.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Literal
+
+from .cache import cache_dir, save_pickle, load_pickle
+
+# Number of jobs run at once, defaults to number of CPUs
+ARCMAPPER_JOB_WORKERS = (
+    int(os.getenv("ARCMAPPER_JOB_WORKERS", 0)) or os.cpu_count() or 1
+)
+
+# Seconds for which finished jobs are kept for polling
+ARCMAPPER_JOB_TTL = int(os.getenv("ARCMAPPER_JOB_TTL", 3600))
+
+# Write the state of jobs to the arcmapper cache directory, so that jobs
+# can be polled and cancelled from other processes
+ARCMAPPER_JOBS_ON_DISK = os.getenv("ARCMAPPER_JOBS_ON_DISK", "").lower() in [
+    "1",
+    "true",
+    "yes",
+]
+
+# Seconds between writes of the state of unfinished jobs to disk, which
+# show other processes that the process running the job is still alive
+ARCMAPPER_JOB_HEARTBEAT = float(os.getenv("ARCMAPPER_JOB_HEARTBEAT", 10))
+
+# Unfinished jobs on disk not written for this many heartbeats are failed,
+# as the process running them has stopped
+JOB_STALE_HEARTBEATS = 6
+
+# Attributes of a job that are written to disk
+JOB_STATE = [
+    "id",
+    "status",
+    "progress",
+    "message",
+    "result",
+    "error",
+    "finished",
+    "pid",
+    "heartbeat",
+]
+
+JobStatus = Literal["queued", "running", "done", "failed", "cancelled"]
+
+
+class JobCancelled(Exception):
+    "Raised inside a job when it has been cancelled"
+
+
+# Job run in the current context, set while a job function runs
+current_job: contextvars.ContextVar["Job | None"] = contextvars.ContextVar(
+    "current_job", default=None
+)
+
+
+def check_cancelled():
+    """Raises JobCancelled if called from a job that has been cancelled
+
+    Called between chunks of long computations, so that they stop soon after
+    the job is cancelled; does nothing outside of jobs.
+    """
+    if (job := current_job.get()) is not None and job.cancelled:
+        raise JobCancelled
+
+
+class Job:
+    """Background job, passed as first argument to the job function
+
+    Job functions call :meth:`report` to update progress, which raises
+    :class:`JobCancelled` if the job has been cancelled. If path is set,
+    the job state is written there, with the id of the process running the
+    job and the time of writing, and a job is also cancelled by creating a
+    cancel file next to it.
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.id = uuid.uuid4().hex
+        self.status: JobStatus = "queued"
+        self.progress = 0.0
+        self.message = ""
+        self.result: Any = None
+        self.error: str | None = None
+        self.finished: float | None = None
+        self.future: Future | None = None
+        self.path = path
+        self.pid = os.getpid()
+        self.heartbeat: float | None = None
+        self._cancelled = threading.Event()
+        self._save_lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ["done", "failed", "cancelled"]
+
+    @property
+    def cancelled(self) -> bool:
+        if self.path is not None and self._cancel_path.exists():
+            self._cancelled.set()
+        return self._cancelled.is_set()
+
+    @property
+    def _cancel_path(self) -> Path:
+        assert self.path is not None
+        return self.path.with_suffix(".cancel")
+
+    def report(self, progress: float, message: str = ""):
+        "Reports progress from 0 to 1, raises JobCancelled if cancelled"
+        if self.cancelled:
+            raise JobCancelled
+        self.progress = progress
+        self.message = message
+        self._save()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.path is not None:
+            try:
+                self._cancel_path.touch()
+            except OSError as e:
+                logging.warning(f"Could not cancel job {self.id}: {e}")
+        if self.future is not None and self.future.cancel():
+            self._finish("cancelled")
+
+    def _finish(self, status: JobStatus):
+        self.status = status
+        self.finished = time.time()
+        self._save()
+
+    @property
+    def stale(self) -> bool:
+        "Whether the process running a job loaded from disk has stopped"
+        if self.done:
+            return False
+        if self.pid != os.getpid() and not process_alive(self.pid):
+            return True
+        return (
+            self.heartbeat is None
+            or time.time() - self.heartbeat
+            > JOB_STALE_HEARTBEATS * ARCMAPPER_JOB_HEARTBEAT
+        )
+
+    def _save(self):
+        if self.path is not None:
+            with self._save_lock:
+                self.heartbeat = time.time()
+                save_pickle(self.path, {k: getattr(self, k) for k in JOB_STATE})
+
+    @classmethod
+    def load(cls, path: Path) -> "Job | None":
+        "Loads state of a job run by another process, see :meth:`_save`"
+        state = load_pickle(path)
+        if not isinstance(state, dict):
+            return None
+        job = cls(path)
+        for k in JOB_STATE:
+            setattr(job, k, state.get(k))
+        return job
+
+
+class JobQueue:
+    "Runs jobs in a bounded thread pool, keeping finished jobs for polling"
+
+    def __init__(
+        self,
+        workers: int = ARCMAPPER_JOB_WORKERS,
+        ttl: float = ARCMAPPER_JOB_TTL,
+        on_disk: bool = ARCMAPPER_JOBS_ON_DISK,
+    ):
+        self.ttl = ttl
+        self.on_disk = on_disk
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="arcmapper-job")
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        # id of the process running the heartbeat thread, if started
+        self._heartbeat_pid: int | None = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def _path(self, job_id: str) -> Path | None:
+        if not self.on_disk or not job_id.isalnum():
+            return None
+        directory = cache_dir("jobs")
+        return directory / (job_id + ".pkl") if directory else None
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Job:
+        "Submits func(job, *args, **kwargs) to run in the background"
+        job = Job()
+        job.path = self._path(job.id)
+        job._save()
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+            if job.path is not None and self._heartbeat_pid != os.getpid():
+                # threads do not survive fork, so start one in each process
+                self._heartbeat_pid = os.getpid()
+                threading.Thread(
+                    target=self._heartbeat, name="arcmapper-job-heartbeat", daemon=True
+                ).start()
+        job.future = self._executor.submit(self._run, job, func, *args, **kwargs)
+        return job
+
+    def get(self, job_id: str | None) -> Job | None:
+        """Returns job, loading its state from disk if run by another process
+
+        Jobs of processes that have stopped, such as server workers that
+        crashed, are reported as failed.
+        """
+        if not job_id:
+            return None
+        with self._lock:
+            if job_id in self._jobs:
+                return self._jobs[job_id]
+        if (path := self._path(job_id)) and path.exists():
+            job = Job.load(path)
+            if job is not None and job.stale:
+                job.status = "failed"
+                job.error = "The server process running the job stopped"
+                job.finished = time.time()
+            return job
+        return None
+
+    def cancel(self, job_id: str | None):
+        if job := self.get(job_id):
+            job.cancel()
+
+    def _run(self, job: Job, func: Callable[..., Any], *args, **kwargs):
+        if job.cancelled:
+            job._finish("cancelled")
+            return
+        job.status = "running"
+        job._save()
+        token = current_job.set(job)
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.progress = 1.0
+            job._finish("done")
+        except JobCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            job.error = str(e)
+            job._finish("failed")
+        finally:
+            current_job.reset(token)
+
+    def _heartbeat(self):
+        "Writes the state of unfinished jobs to disk, see :attr:`Job.stale`"
+        while True:
+            time.sleep(ARCMAPPER_JOB_HEARTBEAT)
+            with self._lock:
+                jobs = [job for job in self._jobs.values() if not job.done]
+            for job in jobs:
+                job._save()
+
+    def _expire(self):
+        "Removes finished jobs older than ttl, must be called with lock held"
+        now = time.time()
+        for job_id in [
+            k
+            for k, job in self._jobs.items()
+            if job.finished is not None and now - job.finished > self.ttl
+        ]:
+            job = self._jobs.pop(job_id)
+            if job.path is not None:
+                job.path.unlink(missing_ok=True)
+                job._cancel_path.unlink(missing_ok=True)
+
+
+def process_alive(pid: int | None) -> bool:
+    "Returns whether a process with this id is running"
+    if pid is None:
+        return False
+    if os.name == "nt":
+        # os.kill terminates processes on Windows, rely on heartbeats instead
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # exists, but owned by another user
+        return True
+    return True
+
+
+JOBS = JobQueue()
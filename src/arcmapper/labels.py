@@ -5,3 +5,4 @@ UPLOAD_DATA_DICTIONARY = "↟ Upload data dictionary"
 SAVE_INTERMEDIATE_FILE = "↓ Save intermediate file"
 LOAD_INTERMEDIATE_FILE = "↑ Load intermediate file"
 DOWNLOAD_FHIRFLAT_MAPPING = "▼ Download FHIRflat mapping"
+CANCEL = "✕ Cancel"
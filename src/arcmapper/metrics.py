@@ -0,0 +1,324 @@
+"""Per-stage latency and memory metrics, in Prometheus text format
+
+Stages of mapping, such as reading ARC or computing similarities, are
+wrapped in spans, see :func:`span` and :func:`timed`. Span durations, and
+optionally peak memory, are aggregated as histograms in the process, which
+the app exposes at /metrics, and are logged as one JSON line per span.
+
+With several server worker processes, each process writes its histograms
+to the arcmapper cache directory, and /metrics shows their sum.
+"""
+
+import os
+import copy
+import json
+import time
+import uuid
+import logging
+import functools
+import threading
+import contextlib
+import contextvars
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Iterator, TypeVar
+
+from .cache import cache_dir, save_pickle, load_pickle
+
+# Track peak memory allocated by each span using tracemalloc; this slows
+# down allocations, so is off by default. Memory is not recorded for spans
+# that overlap spans of other threads, see _peak_start()
+ARCMAPPER_METRICS_MEMORY = os.getenv("ARCMAPPER_METRICS_MEMORY", "").lower() in [
+    "1",
+    "true",
+    "yes",
+]
+
+# Seconds between writes of metrics to disk, when shared by processes
+METRICS_SAVE_INTERVAL = 1.0
+
+# Upper bounds of histogram buckets for span durations, in seconds
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Upper bounds of histogram buckets for peak memory, in bytes
+MEMORY_BUCKETS = [2**i for i in range(20, 34, 2)]
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+logger = logging.getLogger("arcmapper.metrics")
+
+# Identifies the request or job that spans belong to, in log lines
+request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "request_id", default=None
+)
+
+
+class Histogram:
+    "Cumulative histogram of observations, as in Prometheus"
+
+    def __init__(self, buckets: list[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram"):
+        "Adds observations of a histogram with the same buckets"
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def render(self, name: str, labels: str) -> list[str]:
+        "Returns lines of the histogram in Prometheus text format"
+        lines = [
+            f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Thread-safe histograms of span duration and peak memory, keyed by stage
+
+    If on_disk is set, the metrics are written to the arcmapper cache
+    directory at most every METRICS_SAVE_INTERVAL seconds, so that
+    :meth:`shared` can sum the metrics of all server worker processes.
+    """
+
+    def __init__(self, on_disk: bool = False):
+        self.durations: dict[str, Histogram] = {}
+        self.memory: dict[str, Histogram] = {}
+        self.errors: dict[str, int] = {}
+        self.on_disk = on_disk
+        # identifies the process in the name of its metrics file
+        self._worker = uuid.uuid4().hex
+        self._timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, peak_bytes: int | None, failed: bool):
+        with self._lock:
+            self.durations.setdefault(stage, Histogram(DURATION_BUCKETS)).observe(
+                seconds
+            )
+            if peak_bytes is not None:
+                self.memory.setdefault(stage, Histogram(MEMORY_BUCKETS)).observe(
+                    peak_bytes
+                )
+            if failed:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            if self.on_disk and self._timer is None:
+                self._timer = threading.Timer(METRICS_SAVE_INTERVAL, self.save)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _path(self) -> Path | None:
+        directory = cache_dir("metrics")
+        return directory / (self._worker + ".pkl") if directory else None
+
+    def save(self):
+        "Writes metrics of this process to disk"
+        with self._lock:
+            self._timer = None
+            state = copy.deepcopy((self.durations, self.memory, self.errors))
+        if path := self._path():
+            save_pickle(path, state)
+
+    def shared(self) -> "Metrics":
+        "Returns sum of the metrics of all processes, if stored on disk"
+        if not self.on_disk or (directory := cache_dir("metrics")) is None:
+            return self
+        self.save()
+        total = Metrics()
+        for path in directory.glob("*.pkl"):
+            if not isinstance(state := load_pickle(path), tuple):
+                continue
+            durations, memory, errors = state
+            for totals, values in [
+                (total.durations, durations),
+                (total.memory, memory),
+            ]:
+                for stage, histogram in values.items():
+                    if stage in totals:
+                        totals[stage].merge(histogram)
+                    else:
+                        totals[stage] = histogram
+            for stage, count in errors.items():
+                total.errors[stage] = total.errors.get(stage, 0) + count
+        return total
+
+    def clear_shared(self):
+        "Removes metrics written to disk, such as by earlier server runs"
+        if directory := cache_dir("metrics"):
+            for path in directory.glob("*.pkl"):
+                path.unlink(missing_ok=True)
+
+    def _forked(self):
+        "Starts empty metrics in a forked process, which the parent reports"
+        self.durations, self.memory, self.errors = {}, {}, {}
+        self._worker = uuid.uuid4().hex
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def render(self) -> str:
+        "Returns metrics in Prometheus text exposition format"
+        lines = []
+        with self._lock:
+            for name, kind, help, values in [
+                (
+                    "arcmapper_stage_duration_seconds",
+                    "histogram",
+                    "Duration of arcmapper stages",
+                    self.durations,
+                ),
+                (
+                    "arcmapper_stage_peak_memory_bytes",
+                    "histogram",
+                    "Peak memory allocated during arcmapper stages",
+                    self.memory,
+                ),
+                (
+                    "arcmapper_stage_errors_total",
+                    "counter",
+                    "Number of arcmapper stages that raised an exception",
+                    self.errors,
+                ),
+            ]:
+                if not values:
+                    continue
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                for stage, value in sorted(values.items()):
+                    labels = f'stage="{stage}"'
+                    if isinstance(value, Histogram):
+                        lines += value.render(name, labels)
+                    else:
+                        lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.durations.clear()
+            self.memory.clear()
+            self.errors.clear()
+
+
+METRICS = Metrics()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=METRICS._forked)
+
+# tracemalloc measures memory of the whole process, so peak memory is only
+# recorded for spans of one thread at a time: the thread that opens the first
+# span owns tracing until its outermost span ends. Spans opened by other
+# threads meanwhile are not measured, and mark the owner's open spans as
+# contended, so that memory allocated by those threads is not recorded.
+_memory_lock = threading.Lock()
+_memory_owner: int | None = None
+_memory_contended = False
+_memory_started = False
+
+# Peak traced memory of the open spans of the owner thread, so that resetting
+# the peak for a nested span does not lose the peak of its parent
+_memory_stack: list[int] = []
+
+
+def _peak_start() -> int | None:
+    global _memory_owner, _memory_contended, _memory_started
+    if not ARCMAPPER_METRICS_MEMORY:
+        return None
+    with _memory_lock:
+        thread = threading.get_ident()
+        if _memory_owner is None:
+            _memory_owner = thread
+            _memory_contended = False
+            _memory_started = not tracemalloc.is_tracing()
+            if _memory_started:
+                tracemalloc.start()
+        elif _memory_owner != thread:
+            _memory_contended = True
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        if _memory_stack:
+            _memory_stack[-1] = max(_memory_stack[-1], peak)
+        _memory_stack.append(current)
+        tracemalloc.reset_peak()
+        return current
+
+
+def _peak_end(start: int | None) -> int | None:
+    global _memory_owner, _memory_started
+    if start is None:
+        return None
+    with _memory_lock:
+        peak = max(_memory_stack.pop(), tracemalloc.get_traced_memory()[1])
+        if _memory_stack:
+            _memory_stack[-1] = max(_memory_stack[-1], peak)
+        contended = _memory_contended
+        if not _memory_stack:
+            # stop tracing when no spans are open, unless started elsewhere
+            _memory_owner = None
+            if _memory_started:
+                tracemalloc.stop()
+                _memory_started = False
+        return None if contended else max(0, peak - start)
+
+
+@contextlib.contextmanager
+def span(stage: str, **fields: Any) -> Iterator[None]:
+    """Times a stage, recording it in METRICS and logging it
+
+    Extra fields, such as the number of rows, are added to the log line.
+    """
+    memory_start = _peak_start()
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        peak_bytes = _peak_end(memory_start)
+        METRICS.observe(stage, seconds, peak_bytes, failed)
+        if logger.isEnabledFor(logging.INFO):
+            record = {"stage": stage, "seconds": round(seconds, 6)}
+            if peak_bytes is not None:
+                record["peak_bytes"] = peak_bytes
+            if rid := request_id.get():
+                record["request_id"] = rid
+            if failed:
+                record["failed"] = True
+            logger.info(json.dumps({**record, **fields}))
+
+
+def timed(stage: str) -> Callable[[F], F]:
+    "Decorator that runs a function in a :func:`span`"
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+@contextlib.contextmanager
+def request(rid: str) -> Iterator[None]:
+    "Sets the request id added to log lines of spans in this context"
+    token = request_id.set(rid)
+    try:
+        yield
+    finally:
+        request_id.reset(token)
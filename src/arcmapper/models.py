@@ -0,0 +1,109 @@
+"Process-wide registry of sentence transformer models"
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+SBERT_MODEL = "all-MiniLM-L6-v2"
+
+# Maximum number of models kept loaded at once, least recently used
+# models are evicted beyond this limit
+ARCMAPPER_MAX_MODELS = int(os.getenv("ARCMAPPER_MAX_MODELS", 2))
+
+# Device to load models on, such as 'cpu' or 'cuda'; autodetected if unset
+ARCMAPPER_DEVICE = os.getenv("ARCMAPPER_DEVICE") or None
+
+# Comma separated list of models to load at server start
+ARCMAPPER_WARMUP_MODELS = os.getenv("ARCMAPPER_WARMUP_MODELS", SBERT_MODEL)
+
+
+def load_sentence_transformer(name: str, device: str | None = None) -> Any:
+    # imported here as importing sentence_transformers (and torch) is slow
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name, device=device)
+
+
+class ModelRegistry:
+    """Thread-safe LRU registry of loaded models keyed by (name, device)
+
+    Models are loaded lazily on first use. Concurrent requests for the same
+    model wait for a single load instead of loading duplicate copies.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = ARCMAPPER_MAX_MODELS,
+        loader: Callable[[str, str | None], Any] = load_sentence_transformer,
+    ):
+        if maxsize < 1:
+            raise ValueError("ModelRegistry maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.loader = loader
+        self._models: OrderedDict[tuple[str, str | None], Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: dict[tuple[str, str | None], threading.Lock] = {}
+
+    def __contains__(self, key: tuple[str, str | None]) -> bool:
+        with self._lock:
+            return key in self._models
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._models)
+
+    def get(self, name: str = SBERT_MODEL, device: str | None = ARCMAPPER_DEVICE):
+        "Returns model, loading it if not already present"
+        key = (name, device)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        # Only hold the per-model lock while loading, so that lookups of
+        # other models are not blocked by a slow load
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+            model = self.loader(name, device)
+            with self._lock:
+                self._models[key] = model
+                self._models.move_to_end(key)
+                while len(self._models) > self.maxsize:
+                    evicted, _ = self._models.popitem(last=False)
+                    logging.info(f"Evicted model from registry: {evicted}")
+                self._loading.pop(key, None)
+            return model
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+MODELS = ModelRegistry()
+
+
+def get_model(name: str = SBERT_MODEL, device: str | None = ARCMAPPER_DEVICE):
+    "Returns shared model instance from the process-wide registry"
+    return MODELS.get(name, device)
+
+
+def warmup(models: list[str] | None = None, device: str | None = ARCMAPPER_DEVICE):
+    """Loads models into the registry ahead of first use
+
+    Failures are logged and not raised, so that the server can still start
+    when models cannot be downloaded, such as in offline deployments.
+    """
+    if models is None:
+        models = [m.strip() for m in ARCMAPPER_WARMUP_MODELS.split(",") if m.strip()]
+    for name in models:
+        try:
+            get_model(name, device)
+            logging.info(f"Loaded model: {name}")
+        except Exception as e:
+            logging.warning(f"Could not load model {name}: {e}")
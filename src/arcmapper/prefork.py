@@ -0,0 +1,134 @@
+"""Prefork multi-process server for the app
+
+The parent process loads models, ARC schemas, TF-IDF models and ARC
+embeddings, then forks worker processes that each serve the app with
+waitress on a shared listening socket. Workers share the loaded state
+copy-on-write, and memory-mapped embeddings through the page cache, so
+memory grows far less than linearly with the number of workers. Sessions
+and jobs are stored on disk, so that any worker can serve any request.
+
+Forking is not available on Windows, where a single process is used.
+"""
+
+import os
+import gc
+import time
+import signal
+import socket
+import logging
+
+from .models import warmup
+
+# Number of server worker processes
+ARCMAPPER_SERVER_WORKERS = int(os.getenv("ARCMAPPER_SERVER_WORKERS", 1))
+
+# Comma separated list of ARC versions loaded before forking workers
+ARCMAPPER_PRELOAD_ARC = os.getenv("ARCMAPPER_PRELOAD_ARC", "1.0.0,1.0.1")
+
+
+def preload(arc_versions: list[str] | None = None):
+    """Loads state shared by workers, such as models and ARC schemas
+
+    Failures are logged and not raised, so that the server can still start
+    offline; anything not loaded is loaded by each worker on first use.
+    """
+    from .app import get_fhir_mapping
+    from .arc import read_arc_schema
+    from .embeddings import arc_embeddings
+    from .tfidf import arc_tfidf
+
+    if arc_versions is None:
+        arc_versions = [
+            v.strip() for v in ARCMAPPER_PRELOAD_ARC.split(",") if v.strip()
+        ]
+    warmup()
+    for version in arc_versions:
+        try:
+            arc = read_arc_schema(version)
+            arc_tfidf(arc)
+            arc_embeddings(arc)
+            logging.info(f"Loaded ARC {version}")
+        except Exception as e:
+            logging.warning(f"Could not load ARC {version}: {e}")
+    try:
+        get_fhir_mapping()
+    except Exception as e:
+        logging.warning(f"Could not load FHIR mapping: {e}")
+
+
+def share_state():
+    "Stores sessions, jobs and metrics on disk, so that they are shared by workers"
+    from .jobs import JOBS
+    from .metrics import METRICS
+    from .sessions import SESSIONS
+
+    SESSIONS.on_disk = True
+    JOBS.on_disk = True
+    METRICS.on_disk = True
+    METRICS.clear_shared()
+
+
+def _serve_worker(sock: socket.socket):
+    from waitress import serve
+
+    from .app import app
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        serve(app.server, sockets=[sock])
+    finally:
+        os._exit(0)
+
+
+def serve_workers(host: str, port: int, workers: int = ARCMAPPER_SERVER_WORKERS):
+    """Serves the app from forked worker processes until interrupted
+
+    Workers that exit unexpectedly are replaced.
+    """
+    logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+    share_state()
+    preload()
+    sock = socket.create_server((host, port))
+    # objects loaded so far are never freed, so the garbage collector need
+    # not touch them, which would copy their memory pages in each worker
+    gc.collect()
+    gc.freeze()
+
+    children: set[int] = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _serve_worker(sock)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"[PROD] Open browser at http://{host}:{port} ({workers} workers)")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            logging.warning(f"Worker {pid} exited with status {status}, restarting")
+            time.sleep(1)
+            spawn()
+    sock.close()
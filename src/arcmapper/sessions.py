@@ -0,0 +1,312 @@
+"""Server-side store of data dictionaries and mappings for app sessions
+
+The app keeps the uploaded data dictionary and the intermediate mapping
+for each browser session here, so that callbacks only exchange the session
+id and the rows that changed with the browser.
+"""
+
+import os
+import time
+import uuid
+import pickle
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows, which is served by a single process
+    fcntl = None  # type: ignore[assignment]
+
+from .cache import cache_dir, save_pickle, load_pickle
+
+# Maximum number of sessions kept in memory, least recently used sessions
+# are evicted first (and are still available on disk if enabled)
+ARCMAPPER_MAX_SESSIONS = int(os.getenv("ARCMAPPER_MAX_SESSIONS", 32))
+
+# Seconds of inactivity after which a session is discarded
+ARCMAPPER_SESSION_TTL = int(os.getenv("ARCMAPPER_SESSION_TTL", 6 * 3600))
+
+# Also write sessions to the arcmapper cache directory, so that they survive
+# eviction from memory and server restarts, and are shared by server workers
+ARCMAPPER_SESSIONS_ON_DISK = os.getenv("ARCMAPPER_SESSIONS_ON_DISK", "").lower() in [
+    "1",
+    "true",
+    "yes",
+]
+
+# Size of the edit log of a session in bytes beyond which the session is
+# written again in full, and the log emptied
+SESSION_LOG_MAX_BYTES = 2**20
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+class SessionStore:
+    """Thread-safe LRU store of session data with a time to live
+
+    Each session is a dictionary of values, such as data frames, keyed by
+    name. Sessions not accessed within ttl seconds are discarded.
+
+    If stored on disk, sessions changed on disk by another process are
+    reloaded, so that server worker processes see each other's changes.
+    Small changes to a value, such as edits of cells of a mapping, are made
+    with :meth:`edit`, which appends them to an edit log of the session
+    instead of writing the whole session. Access to the session files is
+    serialized across processes by a lock file per session.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = ARCMAPPER_MAX_SESSIONS,
+        ttl: float = ARCMAPPER_SESSION_TTL,
+        on_disk: bool = ARCMAPPER_SESSIONS_ON_DISK,
+    ):
+        if maxsize < 1:
+            raise ValueError("SessionStore maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_disk = on_disk
+        # session id -> (last access time, session data)
+        self._sessions: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        # session id -> modification time of the session file last read or written
+        self._mtimes: dict[str, int] = {}
+        # session id -> position in the edit log up to which edits are applied
+        self._offsets: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _path(self, session_id: str, suffix: str = ".pkl") -> Path | None:
+        if not self.on_disk or not session_id.isalnum():
+            return None
+        directory = cache_dir("sessions")
+        return directory / (session_id + suffix) if directory else None
+
+    @contextlib.contextmanager
+    def _file_lock(self, session_id: str, exclusive: bool) -> Iterator[None]:
+        "Locks session files against other processes, if stored on disk"
+        path = self._path(session_id, ".lock")
+        if path is None or fcntl is None:
+            yield
+            return
+        with path.open("a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _forget(self, session_id: str):
+        "Removes session from memory, must be called with lock held"
+        self._sessions.pop(session_id, None)
+        self._mtimes.pop(session_id, None)
+        self._offsets.pop(session_id, None)
+
+    def _unlink(self, session_id: str):
+        for suffix in [".pkl", ".log", ".lock"]:
+            if path := self._path(session_id, suffix):
+                path.unlink(missing_ok=True)
+
+    def _modified(self, session_id: str) -> float | None:
+        """Returns last time a session was written or accessed by any process
+
+        The lock file is touched on each access, see :meth:`_session`.
+        """
+        times = []
+        for suffix in [".pkl", ".log", ".lock"]:
+            try:
+                if path := self._path(session_id, suffix):
+                    times.append(path.stat().st_mtime)
+            except OSError:
+                pass
+        return max(times, default=None)
+
+    def _expire(self, now: float):
+        """Removes expired sessions, must be called with lock held
+
+        Sessions on disk are only removed if no process has accessed them
+        within ttl, and no process holds their file lock.
+        """
+        while self._sessions:
+            session_id, (accessed, _) = next(iter(self._sessions.items()))
+            if now - accessed <= self.ttl:
+                break
+            self._forget(session_id)
+            if not self.on_disk:
+                continue
+            modified = self._modified(session_id)
+            if modified is not None and now - modified <= self.ttl:
+                # still used by another process
+                continue
+            self._unlink_expired(session_id)
+
+    def _unlink_expired(self, session_id: str):
+        "Removes files of an expired session, unless its file lock is held"
+        path = self._path(session_id, ".lock")
+        if path is None or fcntl is None:
+            self._unlink(session_id)
+            return
+        try:
+            with path.open("a") as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                try:
+                    self._unlink(session_id)
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+        except OSError:
+            # locked by a process using the session
+            pass
+
+    def _load(self, session_id: str, path: Path, now: float) -> dict[str, Any] | None:
+        "Loads session from disk if changed since last read, with lock held"
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        if (
+            stat.st_mtime_ns == self._mtimes.get(session_id)
+            or now - (self._modified(session_id) or stat.st_mtime) > self.ttl
+            or not isinstance(loaded := load_pickle(path), dict)
+        ):
+            return None
+        self._mtimes[session_id] = stat.st_mtime_ns
+        self._offsets[session_id] = 0
+        return loaded
+
+    def _replay(self, session_id: str, session: dict[str, Any]):
+        "Applies edits logged by other processes since last read, with lock held"
+        path = self._path(session_id, ".log")
+        offset = self._offsets.get(session_id, 0)
+        if path is None or not path.exists() or path.stat().st_size <= offset:
+            return
+        with path.open("rb") as fp:
+            fp.seek(offset)
+            while True:
+                try:
+                    key, changes = pickle.load(fp)
+                except EOFError:
+                    break
+                except Exception as e:
+                    logging.warning(f"Ignoring unreadable session log {path}: {e}")
+                    break
+                if (value := session.get(key)) is not None:
+                    value.apply(changes)
+                offset = fp.tell()
+        self._offsets[session_id] = offset
+
+    def _session(self, session_id: str) -> dict[str, Any]:
+        """Returns session data, loading it from disk if needed
+
+        Must be called with lock held, and the file lock if stored on disk.
+        """
+        now = time.time()
+        self._expire(now)
+        session = (
+            self._sessions[session_id][1] if session_id in self._sessions else None
+        )
+        if path := self._path(session_id):
+            session = self._load(session_id, path, now) or session
+            if session is not None:
+                self._replay(session_id, session)
+            if lock := self._path(session_id, ".lock"):
+                # marks the session as used for other processes
+                try:
+                    lock.touch()
+                except OSError:
+                    pass
+        if session is None:
+            session = {}
+        self._sessions[session_id] = (now, session)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.maxsize:
+            evicted, _ = self._sessions.popitem(last=False)
+            self._forget(evicted)
+            logging.info(f"Evicted session from memory: {evicted}")
+        return session
+
+    def _save(self, session_id: str, session: dict[str, Any]):
+        "Writes whole session to disk and empties its edit log, with locks held"
+        if (path := self._path(session_id)) is None:
+            return
+        save_pickle(path, session)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtimes.get(session_id):
+            # not written, keep the edit log
+            return
+        self._mtimes[session_id] = mtime
+        if log := self._path(session_id, ".log"):
+            log.unlink(missing_ok=True)
+        self._offsets[session_id] = 0
+
+    def get(self, session_id: str, key: str, default: Any = None) -> Any:
+        "Returns value stored in session, or default if not present"
+        with self._lock, self._file_lock(session_id, exclusive=False):
+            return self._session(session_id).get(key, default)
+
+    def set(self, session_id: str, key: str, value: Any):
+        "Stores value in session, writing the session to disk if enabled"
+        with self._lock, self._file_lock(session_id, exclusive=True):
+            session = self._session(session_id)
+            session[key] = value
+            self._save(session_id, session)
+
+    def edit(
+        self, session_id: str, key: str, func: Callable[[Any], list | None]
+    ) -> list | None:
+        """Changes a value in session, logging only the changes to disk
+
+        func is called with the current value, including edits made by other
+        processes, and returns a list of changes, which are applied with the
+        apply() method of the value, such as :meth:`MappingTable.apply`. No
+        other process changes the session in between. Returns the changes,
+        or None if the value is not present.
+        """
+        with self._lock, self._file_lock(session_id, exclusive=True):
+            session = self._session(session_id)
+            if (value := session.get(key)) is None:
+                return None
+            if not (changes := func(value)):
+                return changes
+            value.apply(changes)
+            if (log := self._path(session_id, ".log")) is None:
+                return changes
+            try:
+                with log.open("ab") as fp:
+                    pickle.dump((key, changes), fp, pickle.HIGHEST_PROTOCOL)
+                    self._offsets[session_id] = fp.tell()
+            except OSError as e:
+                logging.warning(f"Could not write session log {log}: {e}")
+                self._save(session_id, session)
+                return changes
+            if self._offsets[session_id] > SESSION_LOG_MAX_BYTES:
+                self._save(session_id, session)
+            return changes
+
+    def delete(self, session_id: str):
+        with self._lock, self._file_lock(session_id, exclusive=True):
+            self._forget(session_id)
+            self._unlink(session_id)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._mtimes.clear()
+            self._offsets.clear()
+
+
+SESSIONS = SessionStore()
@@ -1,13 +1,48 @@
-import ast
-from collections import namedtuple
+import os
+import threading
+from collections import namedtuple, OrderedDict
+from typing import TYPE_CHECKING, Callable
 
 import pandas as pd
 import numpy as np
 import numpy.typing
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sentence_transformers import SentenceTransformer
 
-SBERT_MODEL = "all-MiniLM-L6-v2"
+from .cache import frame_hash
+from .jobs import check_cancelled
+from .metrics import span, timed
+from .models import SBERT_MODEL, get_model
+from .embeddings import (
+    ARCMAPPER_SBERT_INDEX,
+    IndexType,
+    arc_embeddings,
+    arc_index,
+    dictionary_text,
+    encode,
+)
+from .tfidf import arc_tfidf, tfidf_dictionary_text
+from .util import top_k, parse_response_columns
+
+if TYPE_CHECKING:
+    import scipy.sparse
+
+# Maximum number of cells of the similarity matrix held in memory at once
+# when computing sparse similarities in chunks
+SIMILARITY_CHUNK_CELLS = 2**22
+
+# Default number of matches and similarity threshold of use_map
+NUM_MATCHES = 5
+THRESHOLD = 0.3
+
+# Number of candidate matches computed per variable by use_map, matches
+# upto this number can be requested without recomputing similarities
+CANDIDATE_MATCHES = 10
+
+# Number of candidate match sets kept in memory by use_map
+ARCMAPPER_MAX_CANDIDATE_SETS = int(os.getenv("ARCMAPPER_MAX_CANDIDATE_SETS", 8))
+
+# Cached candidate matches: (method, dictionary hash, ARC hash) -> (depth, matches)
+_candidates: OrderedDict[tuple[str, str, str], tuple[int, pd.DataFrame]] = OrderedDict()
+_candidates_lock = threading.Lock()
 
 NULL_RESPONSES = ["none", "na", "nk", "n/a", "n/k"]
 Response = namedtuple("Response", ["val", "text"])
@@ -45,44 +80,71 @@ def get_match_dataframe_from_similarity_matrix(
     pd.DataFrame
         Dataframe containing `raw_variable`, `arc_variable` and `rank` columns
         where `rank` is a number from 0 to num_matches - 1 indicating the fitness
-        of the match, with 0 indicating highest similarity.
+        of the match, with 0 indicating highest similarity. The `similarity`
+        column contains the similarity score of the match.
+
+    """
+    with span("strategies.top_k"):
+        top, scores = top_k(similarity_matrix, num_matches)
+    return get_match_dataframe_from_top_k(dictionary, arc, top, scores, threshold)
+
+
+def sparse_top_k(
+    X: "scipy.sparse.sparray | scipy.sparse.spmatrix",
+    Y: "scipy.sparse.sparray | scipy.sparse.spmatrix",
+    num_matches: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns top matches of X.dot(Y.T) without allocating the full matrix
 
+    The product is computed in chunks of rows of X, and only the top matches
+    of each chunk are kept, see :meth:`top_k`
     """
-    S = np.argsort(similarity_matrix, axis=1)[:, ::-1][:, :num_matches]
+    import scipy.sparse
+
+    X = scipy.sparse.csr_matrix(X)
+    Y_T = scipy.sparse.csr_matrix(Y).T.tocsc()
+    chunk_size = max(1, SIMILARITY_CHUNK_CELLS // max(1, Y_T.shape[1]))
+    chunks = []
+    for i in range(0, X.shape[0], chunk_size):
+        check_cancelled()
+        chunks.append(top_k(X[i : i + chunk_size].dot(Y_T).toarray(), num_matches))
+    if not chunks:
+        return top_k(np.empty((0, Y_T.shape[1])), num_matches)
+    return (
+        np.concatenate([top for top, _ in chunks]),
+        np.concatenate([scores for _, scores in chunks]),
+    )
 
+
+@timed("strategies.match_dataframe")
+def get_match_dataframe_from_top_k(
+    dictionary: pd.DataFrame,
+    arc: pd.DataFrame,
+    top: np.ndarray,
+    scores: np.ndarray,
+    threshold: float,
+) -> pd.DataFrame:
+    """Get mapping matches dataframe from top matches, as returned by :meth:`top_k`
+
+    See :meth:`get_match_dataframe_from_similarity_matrix` for details.
+    """
+    mask = scores > threshold
+    dictionary_idx, rank = np.nonzero(mask)
+    matched_dictionary = dictionary.take(dictionary_idx)
+    matched_arc = arc.take(top[mask])
     match_df = pd.DataFrame(
-        columns=[
-            "status",
-            "raw_variable",
-            "raw_description",
-            "raw_response",
-            "arc_variable",
-            "arc_description",
-            "arc_response",
-            "arc_type",
-            "rank",
-        ],
-        data=sum(
-            [
-                [
-                    [
-                        "-",
-                        dictionary.iloc[i].variable,
-                        dictionary.iloc[i].description,
-                        dictionary.iloc[i].responses,
-                        arc.iloc[k].variable,
-                        arc.iloc[k].description,
-                        arc.iloc[k].responses,
-                        arc.iloc[k].type,
-                        j,
-                    ]
-                    for j, k in enumerate(S[i])
-                    if similarity_matrix[i, S[i, j]] > threshold  # type: ignore
-                ]
-                for i in range(len(dictionary))
-            ],
-            [],
-        ),
+        {
+            "status": "-",
+            "raw_variable": matched_dictionary.variable.to_numpy(),
+            "raw_description": matched_dictionary.description.to_numpy(),
+            "raw_response": matched_dictionary.responses.to_numpy(),
+            "arc_variable": matched_arc.variable.to_numpy(),
+            "arc_description": matched_arc.description.to_numpy(),
+            "arc_response": matched_arc.responses.to_numpy(),
+            "arc_type": matched_arc.type.to_numpy(),
+            "rank": rank,
+            "similarity": scores[mask],
+        }
     )
     dictionary_categorical_vars = dictionary[pd.notnull(dictionary.responses)].variable
     arc_categorical_vars = arc[pd.notnull(arc.responses)].variable
@@ -134,20 +196,74 @@ def match_responses(
     list[tuple[tuple[str, str], tuple[str, str]]]
         List of pairs of mappings of dictionary to ARC
     """
-    model = SentenceTransformer(sbert_model)
-    source_embeddings = model.encode([i.text for i in source])
-    target_embeddings = model.encode([i.text for i in target])
-    source_map: dict[str, str] = {v: k for k, v in source}
-    target_map: dict[str, str] = {v: k for k, v in target}
-    S = model.similarity(source_embeddings, target_embeddings).numpy()
-    max_idx = np.argmax(S, axis=1)
-    return [
-        (
-            Response(source_map[source[i].text], source[i].text),
-            Response(target_map[target[max_idx[i]].text], target[max_idx[i]].text),
+    return match_responses_batch([(source, target)], sbert_model)[0]
+
+
+def match_responses_batch(
+    pairs: list[tuple[list[Response], list[Response]]],
+    sbert_model: str = SBERT_MODEL,
+) -> list[list[tuple[Response, Response]]]:
+    """Batched version of :meth:`match_responses`
+
+    All unique response texts across all pairs are encoded in a single pass,
+    and the similarity for each pair is looked up from a shared similarity
+    matrix. As response sets such as Yes/No/Unknown repeat across many
+    variables, this encodes far fewer texts than matching each pair separately.
+
+    Parameters
+    ----------
+    pairs
+        List of (source, target) response lists, see :meth:`match_responses`
+    sbert_model
+        SBERT model to use (optional)
+
+    Returns
+    -------
+    list[list[tuple[Response, Response]]]
+        Mapping of responses for each (source, target) pair, in order
+    """
+    source_texts = list(dict.fromkeys(r.text for source, _ in pairs for r in source))
+    target_texts = list(dict.fromkeys(r.text for _, target in pairs for r in target))
+    if not source_texts or not target_texts:
+        return [[] for _ in pairs]
+
+    model = get_model(sbert_model)
+    texts = list(dict.fromkeys(source_texts + target_texts))
+    text_index = {t: i for i, t in enumerate(texts)}
+    embeddings = encode(texts, sbert_model)
+    S = model.similarity(
+        embeddings[[text_index[t] for t in source_texts]],
+        embeddings[[text_index[t] for t in target_texts]],
+    ).numpy()
+    source_index = {t: i for i, t in enumerate(source_texts)}
+    target_index = {t: i for i, t in enumerate(target_texts)}
+
+    out = []
+    for source, target in pairs:
+        if not source or not target:
+            out.append([])
+            continue
+        block = S[
+            np.ix_(
+                [source_index[r.text] for r in source],
+                [target_index[r.text] for r in target],
+            )
+        ]
+        max_idx = np.argmax(block, axis=1)
+        source_map: dict[str, str] = {v: k for k, v in source}
+        target_map: dict[str, str] = {v: k for k, v in target}
+        out.append(
+            [
+                (
+                    Response(source_map[source[i].text], source[i].text),
+                    Response(
+                        target_map[target[max_idx[i]].text], target[max_idx[i]].text
+                    ),
+                )
+                for i in range(len(source))
+            ]
         )
-        for i in range(len(source))
-    ]
+    return out
 
 
 def has_valid_response(row) -> bool:
@@ -156,12 +272,17 @@ def has_valid_response(row) -> bool:
     ) or (isinstance(row.raw_response, list) and isinstance(row.arc_response, list))
 
 
+@timed("strategies.infer_response_mapping")
 def infer_response_mapping(
     m: pd.DataFrame, sbert_model: str = SBERT_MODEL
 ) -> pd.DataFrame:
     """Infer response mapping from data dicitonary to ARC.
 
-    This is a simplified version of the mapping that takes place in strategies
+    This is a simplified version of the mapping that takes place in strategies.
+    Responses for all rows are matched in one batch, see
+    :meth:`match_responses_batch`. Responses stored as text, such as in
+    intermediate files, are parsed first, see
+    :meth:`arcmapper.util.parse_response_columns`
     """
     columns = [
         "raw_variable",
@@ -171,23 +292,21 @@ def infer_response_mapping(
         "arc_description",
         "arc_response",
     ]
-    out = []
-    sbert_model = SentenceTransformer(sbert_model)
-
-    for row in m.itertuples():
+    m = m.copy()
+    parse_response_columns(m)
+    rows = list(m.itertuples())
+    pairs = {}
+    for k, row in enumerate(rows):
         if has_valid_response(row):
-            raw_response = (
-                row.raw_response
-                if isinstance(row.raw_response, list)
-                else ast.literal_eval(row.raw_response)
+            pairs[k] = (
+                list(map(lambda r: Response(*r), row.raw_response)),
+                list(map(lambda r: Response(*r), row.arc_response)),
             )
-            arc_response = (
-                row.arc_response
-                if isinstance(row.arc_response, list)
-                else ast.literal_eval(row.arc_response)
-            )
-            s = list(map(lambda r: Response(*r), raw_response))
-            t = list(map(lambda r: Response(*r), arc_response))
+    matches = dict(zip(pairs, match_responses_batch(list(pairs.values()), sbert_model)))
+
+    out = []
+    for k, row in enumerate(rows):
+        if k in matches:
             if row.arc_type != "multiselect":
                 out.extend(
                     [
@@ -199,7 +318,7 @@ def infer_response_mapping(
                             row.arc_description,
                             str(tr),
                         )
-                        for sr, tr in match_responses(s, t)
+                        for sr, tr in matches[k]
                     ]
                 )
             else:
@@ -213,7 +332,7 @@ def infer_response_mapping(
                             row.arc_description,
                             "1, " + str(tr.text),
                         )
-                        for sr, tr in match_responses(s, t)
+                        for sr, tr in matches[k]
                         if sr.text.lower() not in NULL_RESPONSES
                     ]
                 )
@@ -232,6 +351,7 @@ def infer_response_mapping(
     return df
 
 
+@timed("strategies.tf_idf")
 def tf_idf(
     dictionary: pd.DataFrame,
     arc: pd.DataFrame,
@@ -240,6 +360,10 @@ def tf_idf(
 ) -> pd.DataFrame:
     """Uses TF-IDF (text frequency - inverse document frequency) technique for mapping
 
+    The TF-IDF model is fitted on ARC and cached, see
+    :meth:`arcmapper.tfidf.arc_tfidf`, so that scores of a field do not
+    depend on the rest of the data dictionary.
+
     Parameters
     ----------
     dictionary
@@ -262,25 +386,22 @@ def tf_idf(
         where `rank` is a number from 0 to num_matches - 1 indicating the fitness
         of the match, with 0 indicating highest similarity.
     """
-    dictionary_text = dictionary.variable.str.replace(
-        "_", " "
-    ) + dictionary.description.map(lambda x: x if isinstance(x, str) else "")
-    arc_text = arc.variable.str.replace("_", " ") + " " + arc.description
-    vec = TfidfVectorizer(max_df=0.9, ngram_range=(1, 2))
-
-    X = vec.fit_transform(dictionary_text)
-    Y = vec.transform(arc_text)
-    return get_match_dataframe_from_similarity_matrix(
-        dictionary, arc, X.dot(Y.T).toarray(), num_matches, threshold
-    )
+    model = arc_tfidf(arc)
+    with span("strategies.tf_idf.transform", rows=len(dictionary)):
+        X = model.transform(tfidf_dictionary_text(dictionary))
+    with span("strategies.similarity_top_k"):
+        top, scores = sparse_top_k(X, model.arc_matrix, num_matches)
+    return get_match_dataframe_from_top_k(dictionary, arc, top, scores, threshold)
 
 
+@timed("strategies.sbert")
 def sbert(
     dictionary: pd.DataFrame,
     arc: pd.DataFrame,
-    model: str = "all-MiniLM-L6-v2",
+    model: str = SBERT_MODEL,
     num_matches: int = 5,
     threshold: float = 0.3,
+    index: IndexType | None = ARCMAPPER_SBERT_INDEX,
 ) -> pd.DataFrame:
     """Uses sentence transformers (https://sbert.net) technique for mapping
 
@@ -304,6 +425,11 @@ def sbert(
         incorrect (higher false positive ratio), while a higher threshold will
         reduce the number of matches, but potentially miss out on correct matches
         as well (low false positive, higher false negative ratio)
+    index
+        If set to 'float16' or 'int8', query top matches from a cached
+        :class:`arcmapper.embeddings.EmbeddingIndex` of quantized ARC
+        embeddings instead of computing the full similarity matrix. This
+        assumes that the model uses cosine similarity.
 
     Returns
     -------
@@ -312,37 +438,93 @@ def sbert(
         where `rank` is a number from 0 to num_matches - 1 indicating the fitness
         of the match, with 0 indicating highest similarity.
     """
-    dictionary_text = list(
-        dictionary.variable.astype(str).replace("_", " ")
-        + dictionary.description.map(lambda x: x if isinstance(x, str) else "")
-    )
-    arc_text = list(
-        arc.variable.astype(str).replace("_", " ") + " " + arc.description.astype(str)
+    sbert_model = get_model(model)
+    with span("strategies.sbert.encode", rows=len(dictionary)):
+        embeddings = encode(dictionary_text(dictionary), model)
+
+    if index:
+        search = arc_index(arc, model, index)
+        with span("strategies.similarity_top_k"):
+            top, scores = search.query(
+                embeddings,
+                num_matches,
+                chunk_size=max(1, SIMILARITY_CHUNK_CELLS // max(1, len(arc))),
+            )
+        return get_match_dataframe_from_top_k(dictionary, arc, top, scores, threshold)
+    arc_vectors = arc_embeddings(arc, model)
+    with span("strategies.similarity"):
+        similarity_matrix = sbert_model.similarity(embeddings, arc_vectors).numpy()
+    return get_match_dataframe_from_similarity_matrix(
+        dictionary, arc, similarity_matrix, num_matches, threshold
     )
 
-    sbert_model = SentenceTransformer(model)
-    embeddings = sbert_model.encode(dictionary_text)
-    arc_embeddings = sbert_model.encode(arc_text)
 
-    return get_match_dataframe_from_similarity_matrix(
-        dictionary,
-        arc,
-        sbert_model.similarity(embeddings, arc_embeddings).numpy(),
-        num_matches,
-        threshold,
-    )
+# Mapping methods, each a function taking (dictionary, arc, num_matches,
+# threshold) keyword arguments. Methods import their backend on first use.
+STRATEGIES: dict[str, Callable[..., pd.DataFrame]] = {
+    "tf-idf": tf_idf,
+    "sbert": sbert,
+}
 
 
+@timed("strategies.use_map")
 def use_map(
     method: str,
     dictionary: pd.DataFrame,
     arc: pd.DataFrame,
-    num_matches: int = 5,
+    num_matches: int = NUM_MATCHES,
+    threshold: float = THRESHOLD,
+) -> pd.DataFrame:
+    """Maps data dictionary to ARC using a mapping method
+
+    Candidate matches are computed without a threshold and cached per
+    (method, dictionary, ARC), so that calling again with a different
+    threshold or number of matches only filters the cached candidates.
+
+    Parameters
+    ----------
+    method
+        Mapping method, one of the keys of STRATEGIES: 'tf-idf' or 'sbert'
+    dictionary
+        Source data dictionary to map
+    arc
+        ARC data dictionary, can be read using :meth:`arcmapper.read_arc_schema`
+    num_matches
+        Number of matches to return
+    threshold
+        Similarity threshold beyond which a match is reported, see :meth:`tf_idf`
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe of matches, see :meth:`tf_idf`
+    """
+    candidates = get_candidates(method, dictionary, arc, num_matches)
+    return candidates[
+        (candidates["rank"] < num_matches) & (candidates.similarity > threshold)
+    ].reset_index(drop=True)
+
+
+def get_candidates(
+    method: str, dictionary: pd.DataFrame, arc: pd.DataFrame, num_matches: int
 ) -> pd.DataFrame:
-    match method:
-        case "tf-idf":
-            return tf_idf(dictionary, arc, num_matches)
-        case "sbert":
-            return sbert(dictionary, arc, num_matches=num_matches)
-        case _:
-            raise ValueError(f"Unknown mapping method: {method}")
+    "Returns cached candidate matches with at least num_matches per variable"
+    key = (method, frame_hash(dictionary), frame_hash(arc))
+    with _candidates_lock:
+        if key in _candidates and _candidates[key][0] >= num_matches:
+            _candidates.move_to_end(key)
+            return _candidates[key][1]
+
+    if method not in STRATEGIES:
+        raise ValueError(f"Unknown mapping method: {method}")
+    depth = max(num_matches, CANDIDATE_MATCHES)
+    candidates = STRATEGIES[method](
+        dictionary, arc, num_matches=depth, threshold=-np.inf
+    )
+
+    with _candidates_lock:
+        _candidates[key] = (depth, candidates)
+        _candidates.move_to_end(key)
+        while len(_candidates) > ARCMAPPER_MAX_CANDIDATE_SETS:
+            _candidates.popitem(last=False)
+    return candidates
@@ -0,0 +1,304 @@
+"""Server-side paging, sorting and filtering of the mapping table
+
+Implements the custom paging, sorting and filtering actions of the Dash
+DataTable, so that only the visible page of a mapping is sent to the browser.
+"""
+
+import re
+import json
+import math
+import importlib.util
+from typing import Any, BinaryIO
+
+import numpy as np
+import pandas as pd
+
+from .cache import frame_hash
+from .models import SBERT_MODEL
+from .util import (
+    RESPONSE_COLUMNS,
+    parse_responses_text,
+    parse_response_columns,
+    stringify_response_columns,
+)
+
+# Columns with an index used for equality filters
+INDEXED_COLUMNS = ["raw_variable", "arc_variable", "status"]
+
+# Key of the arcmapper metadata in the schema of Parquet mapping files
+PARQUET_METADATA_KEY = b"arcmapper"
+
+# Suffix of columns of Parquet mapping files holding responses that are
+# text instead of lists, such as free-text edits
+RESPONSE_TEXT_SUFFIX = "__text"
+
+# Filter operators in DataTable filter queries, with their alternative forms
+FILTER_OPERATORS = [
+    ["ge", ">="],
+    ["le", "<="],
+    ["lt", "<"],
+    ["gt", ">"],
+    ["ne", "!="],
+    ["eq", "="],
+    ["contains"],
+    ["datestartswith"],
+]
+
+# Operator name of each form of a filter operator
+_FILTER_OPERATOR_NAMES = {
+    form: operators[0] for operators in FILTER_OPERATORS for form in operators
+}
+
+# Part of a filter query: column name in braces, operator, and value
+_FILTER_PART = re.compile(
+    r"\s*\{(?P<name>[^}]*)\}\s*(?P<operator>[<>!=]+|[a-z]+)\s*(?P<value>.*)"
+)
+
+
+def split_filter_part(filter_part: str) -> tuple[str | None, str | None, Any]:
+    """Splits part of a DataTable filter query into column, operator and value
+
+    For example, '{status} = "✅"' is split into ('status', 'eq', '✅'). The
+    operator is the token directly after the column name, so that values
+    containing operator names, such as 'age in', are kept as they are.
+    Returns (None, None, None) if the part could not be parsed.
+    """
+    match = _FILTER_PART.fullmatch(filter_part)
+    if match is None:
+        return None, None, None
+    operator = _FILTER_OPERATOR_NAMES.get(match["operator"])
+    value_part = match["value"].strip()
+    if operator is None or not value_part:
+        return None, None, None
+    quote = value_part[0]
+    if len(value_part) > 1 and quote == value_part[-1] and quote in ("'", '"', "`"):
+        value = value_part[1:-1].replace("\\" + quote, quote)
+    else:
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+    return match["name"], operator, value
+
+
+def filter_mask(values: pd.Series, operator: str, value: Any) -> np.ndarray:
+    "Returns boolean mask of values that match a filter operator and value"
+    match operator:
+        case "contains":
+            mask = values.astype(str).str.contains(str(value), case=False, regex=False)
+        case "datestartswith":
+            mask = values.astype(str).str.startswith(str(value))
+        case _:
+            try:
+                mask = getattr(values, operator)(value)
+            except TypeError:
+                # comparing strings with numbers, compare as strings instead
+                mask = getattr(values.astype(str), operator)(str(value))
+    return mask.fillna(False).to_numpy(dtype=bool)
+
+
+class MappingTable:
+    """Mapping data frame with indexes for server-side table queries
+
+    Rows are identified by their position, which is also stored in the
+    `id` column and used as the DataTable row id. Responses are kept as
+    lists, and formatted as text only for the rows sent to the browser.
+
+    Metadata describes how the mapping was made, such as the ARC version,
+    mapping method and model, and is kept in Parquet mapping files.
+    """
+
+    def __init__(self, frame: pd.DataFrame, metadata: dict[str, Any] | None = None):
+        self.frame = frame.reset_index(drop=True)
+        self.frame["id"] = range(len(self.frame))
+        parse_response_columns(self.frame)
+        self.metadata = dict(metadata or {})
+        # column -> value -> positions of rows with that value
+        self._indices: dict[str, dict[Any, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def positions(self, column: str, value: Any) -> np.ndarray:
+        "Returns positions of rows where column equals value, using an index"
+        if column not in self._indices:
+            self._indices[column] = self.frame.groupby(
+                column, sort=False, dropna=True
+            ).indices
+        index = self._indices[column]
+        if value not in index and isinstance(value, float):
+            # numeric looking filter values are parsed as floats
+            value = str(int(value)) if value.is_integer() else str(value)
+        return index.get(value, np.array([], dtype=np.intp))
+
+    def set(self, row_id: int, column: str, value: Any):
+        "Sets a cell, updating indexes"
+        if column in RESPONSE_COLUMNS and isinstance(value, str):
+            value = parse_responses_text(value)
+        self.frame.at[row_id, column] = value
+        self._indices.pop(column, None)
+
+    def apply(self, edits: list[tuple[int, str, Any]]):
+        "Sets cells from (row id, column, value) edits, see :meth:`set`"
+        for row_id, column, value in edits:
+            self.set(row_id, column, value)
+
+    def get(self, row_id: int, column: str) -> Any:
+        return self.frame.at[row_id, column]
+
+    def filter(self, filter_query: str | None) -> np.ndarray:
+        "Returns positions of rows matching a DataTable filter query"
+        positions = np.arange(len(self.frame))
+        for part in (filter_query or "").split(" && "):
+            column, operator, value = split_filter_part(part)
+            if column not in self.frame.columns:
+                continue
+            if operator == "eq" and column in INDEXED_COLUMNS:
+                positions = np.intersect1d(
+                    positions, self.positions(column, value), assume_unique=True
+                )
+            else:
+                values = self.frame[column].iloc[positions]
+                positions = positions[filter_mask(values, operator, value)]
+        return positions
+
+    def sort(
+        self, positions: np.ndarray, sort_by: list[dict[str, str]] | None
+    ) -> np.ndarray:
+        "Returns positions ordered by DataTable sort_by specification"
+        sort_by = [s for s in sort_by or [] if s["column_id"] in self.frame.columns]
+        if not sort_by:
+            return positions
+        columns = [s["column_id"] for s in sort_by]
+        subset = self.frame[columns].iloc[positions]
+        return subset.sort_values(
+            columns, ascending=[s["direction"] == "asc" for s in sort_by], kind="stable"
+        ).index.to_numpy()
+
+    def page(
+        self,
+        page_current: int,
+        page_size: int,
+        sort_by: list[dict[str, str]] | None = None,
+        filter_query: str | None = None,
+    ) -> tuple[list[dict[str, Any]], int]:
+        """Returns records of one page of the filtered and sorted table
+
+        Returns
+        -------
+        tuple[list[dict[str, Any]], int]
+            Records in the page, and the number of pages
+        """
+        positions = self.sort(self.filter(filter_query), sort_by)
+        page_count = max(1, math.ceil(len(positions) / page_size))
+        start = page_current * page_size
+        page = self.frame.iloc[positions[start : start + page_size]].copy()
+        stringify_response_columns(page)
+        return page.to_dict("records"), page_count
+
+    def to_csv(self, *args, **kwargs):
+        "Writes intermediate mapping file, see :meth:`pandas.DataFrame.to_csv`"
+        frame = self.frame.copy()
+        stringify_response_columns(frame)
+        return frame.to_csv(*args, **kwargs)
+
+    def to_parquet(self, path: str | BinaryIO):
+        """Writes intermediate mapping file in Parquet format
+
+        Unlike CSV files, responses are stored as nested lists, and the
+        metadata is stored in the file schema. Responses that are text are
+        stored in a companion column, see RESPONSE_TEXT_SUFFIX. Requires
+        pyarrow.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        frame = self.frame.copy()
+        for column in RESPONSE_COLUMNS:
+            if column in frame.columns:
+                text = frame[column].map(lambda x: x if isinstance(x, str) else None)
+                if text.notna().any():
+                    frame[column + RESPONSE_TEXT_SUFFIX] = text.astype(object)
+                frame[column] = frame[column].map(_response_lists)
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {
+                **(table.schema.metadata or {}),
+                PARQUET_METADATA_KEY: json.dumps(self.metadata).encode("utf-8"),
+            }
+        )
+        pq.write_table(table, path)
+
+    @classmethod
+    def read_parquet(cls, source: str | BinaryIO) -> "MappingTable":
+        """Reads intermediate mapping file written by :meth:`to_parquet`
+
+        Files are memory-mapped, so that columns other than responses are
+        loaded without copying. Requires pyarrow.
+        """
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(source, memory_map=True)
+        metadata = json.loads(
+            (table.schema.metadata or {}).get(PARQUET_METADATA_KEY, b"{}")
+        )
+        responses = {
+            column: pd.Series(
+                [
+                    None if r is None else [tuple(x) for x in r]
+                    for r in table.column(column).to_pylist()
+                ],
+                dtype=object,
+            )
+            for column in RESPONSE_COLUMNS
+            if column in table.column_names
+        }
+        texts = {
+            column: pd.Series(table.column(column + RESPONSE_TEXT_SUFFIX).to_pylist())
+            for column in responses
+            if column + RESPONSE_TEXT_SUFFIX in table.column_names
+        }
+        frame = table.drop_columns(
+            list(responses) + [column + RESPONSE_TEXT_SUFFIX for column in texts]
+        ).to_pandas()
+        for column, values in responses.items():
+            if column in texts:
+                values = values.where(texts[column].isna(), texts[column])
+            frame[column] = values
+        columns = [
+            c for c in table.column_names if not c.endswith(RESPONSE_TEXT_SUFFIX)
+        ]
+        return cls(frame[columns], metadata)
+
+
+def mapping_metadata(
+    dictionary: pd.DataFrame,
+    arc_version: str,
+    method: str,
+    num_matches: int,
+    threshold: float,
+) -> dict[str, Any]:
+    "Returns metadata describing how a mapping was made"
+    return {
+        "arc_version": arc_version,
+        "method": method,
+        "model": SBERT_MODEL if method == "sbert" else None,
+        "dictionary_hash": frame_hash(dictionary),
+        "num_matches": num_matches,
+        "threshold": threshold,
+    }
+
+
+def parquet_available() -> bool:
+    "Returns whether pyarrow is installed, which is needed for Parquet files"
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def _response_lists(responses: Any) -> list[list[str]] | None:
+    "Returns responses as lists of strings, as stored in Parquet files"
+    if not isinstance(responses, list):
+        return None
+    return [
+        [str(x) for x in r] if isinstance(r, tuple | list) else [str(r)]
+        for r in responses
+    ]
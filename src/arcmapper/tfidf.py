@@ -0,0 +1,170 @@
+"""TF-IDF model of the ARC corpus for the tf-idf strategy
+
+The vocabulary and inverse document frequencies are fitted on ARC text once
+per ARC version and preset, and stored with the normalized ARC matrix in the
+arcmapper cache directory, so that mapping only transforms the dictionary.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+from .cache import atomic_write, cache_dir, slug, text_hash
+from .metrics import timed
+
+if TYPE_CHECKING:
+    import scipy.sparse
+
+# Options of the TF-IDF vectorizer fitted on ARC text
+TFIDF_OPTIONS = {"max_df": 0.9, "ngram_range": (1, 2)}
+
+# Identifies TFIDF_OPTIONS and the way text is built, change this whenever
+# either changes to invalidate caches
+TFIDF_RECIPE = "v1"
+
+# Number of fitted models kept in memory
+MAX_TFIDF_MODELS = 4
+
+_models: OrderedDict[str, "TfidfModel"] = OrderedDict()
+_models_lock = threading.Lock()
+
+
+def tfidf_dictionary_text(dictionary: pd.DataFrame) -> list[str]:
+    "Text used to match data dictionary fields with TF-IDF"
+    return list(
+        (
+            dictionary.variable.str.replace("_", " ")
+            + dictionary.description.map(lambda x: x if isinstance(x, str) else "")
+        ).fillna("")
+    )
+
+
+def tfidf_arc_text(arc: pd.DataFrame) -> list[str]:
+    "Text used to fit the TF-IDF model and match ARC fields"
+    return list((arc.variable.str.replace("_", " ") + " " + arc.description).fillna(""))
+
+
+class TfidfModel:
+    """TF-IDF vocabulary and weights fitted on ARC, with the ARC matrix
+
+    Rows of the ARC matrix, and of transformed text, are L2 normalized, so
+    that their dot product is the cosine similarity.
+    """
+
+    def __init__(
+        self,
+        terms: np.ndarray,
+        idf: np.ndarray,
+        arc_matrix: "scipy.sparse.csr_matrix",
+    ):
+        self.terms = terms
+        self.idf = idf
+        self.arc_matrix = arc_matrix
+
+    @classmethod
+    def fit(cls, texts: list[str]) -> "TfidfModel":
+        "Fits model on ARC text"
+        # imported here as sklearn is slow to import and only used by tf_idf
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        vec = TfidfVectorizer(**TFIDF_OPTIONS)
+        arc_matrix = vec.fit_transform(texts).tocsr()
+        return cls(vec.get_feature_names_out().astype(str), vec.idf_, arc_matrix)
+
+    def transform(self, texts: list[str]) -> "scipy.sparse.csr_matrix":
+        "Returns normalized TF-IDF matrix of text, using the ARC vocabulary"
+        import scipy.sparse
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.preprocessing import normalize
+
+        counts = CountVectorizer(
+            vocabulary=self.terms, ngram_range=TFIDF_OPTIONS["ngram_range"]
+        ).transform(texts)
+        return normalize(counts @ scipy.sparse.diags(self.idf)).tocsr()
+
+    def save(self, path: Path):
+        "Saves model to cache, see :meth:`arcmapper.cache.atomic_write`"
+        atomic_write(
+            path,
+            lambda fp: np.savez(
+                fp,
+                terms=self.terms,
+                idf=self.idf,
+                data=self.arc_matrix.data,
+                indices=self.arc_matrix.indices,
+                indptr=self.arc_matrix.indptr,
+                shape=np.array(self.arc_matrix.shape),
+            ),
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "TfidfModel | None":
+        "Loads model saved by :meth:`save`, returns None if missing or unreadable"
+        if not path.exists():
+            return None
+        import scipy.sparse
+
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                return cls(
+                    f["terms"],
+                    f["idf"],
+                    scipy.sparse.csr_matrix(
+                        (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+                    ),
+                )
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable cache file {path}: {e}")
+            return None
+
+
+def tfidf_cache_key(arc: pd.DataFrame, texts: list[str]) -> str:
+    """Returns cache key for the TF-IDF model of ARC
+
+    The ARC version and preset are included for readability, the content
+    hash of the text ensures that changes in ARC invalidate the cache.
+    """
+    return "-".join(
+        [
+            "tfidf",
+            slug(str(arc.attrs.get("arc_version", "local"))),
+            slug(str(arc.attrs.get("preset") or "all")),
+            TFIDF_RECIPE,
+            text_hash(texts)[:16],
+        ]
+    )
+
+
+@timed("tfidf.arc_tfidf")
+def arc_tfidf(arc: pd.DataFrame) -> TfidfModel:
+    """Returns TF-IDF model fitted on ARC, reading from cache where possible
+
+    Models are kept in memory, and stored as .npz files in the arcmapper
+    cache directory.
+    """
+    texts = tfidf_arc_text(arc)
+    key = tfidf_cache_key(arc, texts)
+    with _models_lock:
+        if key in _models:
+            _models.move_to_end(key)
+            return _models[key]
+
+    directory = cache_dir("tfidf")
+    path = directory / (key + ".npz") if directory else None
+    model = TfidfModel.load(path) if path else None
+    if model is None or model.arc_matrix.shape[0] != len(texts):
+        model = TfidfModel.fit(texts)
+        if path:
+            model.save(path)
+
+    with _models_lock:
+        _models[key] = model
+        _models.move_to_end(key)
+        while len(_models) > MAX_TFIDF_MODELS:
+            _models.popitem(last=False)
+    return model
@@ -1,20 +1,32 @@
 "Utility functions for arcmapper"
 
 import io
+import re
+import ast
+import json
 import base64
 import warnings
+import itertools
 import urllib.request
 from pathlib import Path
+from typing import Any, Callable, Iterator
 
 import chardet
+import numpy as np
+import numpy.typing
 import pandas as pd
 
+from .metrics import timed
 from .types import Responses
 
+# Number of bytes used to detect encoding of non UTF-8 files
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
 
 def ctx_trigger(ctx, event):
     return any(k["prop_id"] == event for k in ctx.triggered)
 
+
 def read_data(file_or_dataframe: str | pd.DataFrame) -> pd.DataFrame:
     if isinstance(file_or_dataframe, pd.DataFrame):
         return file_or_dataframe
@@ -26,6 +38,41 @@ def read_data(file_or_dataframe: str | pd.DataFrame) -> pd.DataFrame:
             return pd.read_csv(file)
 
 
+def read_data_chunks(
+    file_or_dataframe: str | pd.DataFrame, chunksize: int | None = None
+) -> Iterator[pd.DataFrame]:
+    "Reads data in chunks of rows, or all at once if chunksize is None"
+    if chunksize is None or isinstance(file_or_dataframe, pd.DataFrame):
+        yield read_data(file_or_dataframe)
+        return
+    file = Path(file_or_dataframe)
+    match file.suffix:
+        case ".csv":
+            with pd.read_csv(file, chunksize=chunksize) as reader:
+                yield from reader
+        case ".xlsx":
+            yield from read_excel_chunks(file, chunksize)
+
+
+def read_excel_chunks(file: Path, chunksize: int) -> Iterator[pd.DataFrame]:
+    "Reads first sheet of an Excel file in chunks, without loading the whole sheet"
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [
+            f"Unnamed: {i}" if c is None else str(c) for i, c in enumerate(header)
+        ]
+        while chunk := list(itertools.islice(rows, chunksize)):
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
 def read_upload_data(contents: str, filename) -> pd.DataFrame | None:
     _, content_string = contents.split(",")
 
@@ -56,10 +103,179 @@ def read_csv_with_encoding_detection(file_or_url: str) -> pd.DataFrame:
     else:
         with open(file_or_url, "rb") as fp:
             data = fp.read()
-    encoding = chardet.detect(data)["encoding"]
-    decoded_data = data.decode(encoding)
-    return pd.read_csv(io.StringIO(decoded_data))
+    return read_csv_bytes_with_encoding_detection(data)
+
+
+@timed("util.detect_encoding")
+def detect_encoding(data: bytes) -> str:
+    """Detects encoding from a bounded sample of data
+
+    Only non-ASCII bytes distinguish encodings, so the sample starts just
+    before the first non-ASCII byte.
+    """
+    first_non_ascii = re.search(rb"[\x80-\xff]", data)
+    if first_non_ascii is None:
+        return "ascii"
+    start = max(0, first_non_ascii.start() - 1024)
+    sample = data[start : start + ENCODING_SAMPLE_SIZE]
+    return chardet.detect(sample)["encoding"] or "latin-1"
+
+
+@timed("util.read_csv")
+def read_csv_bytes_with_encoding_detection(data: bytes) -> pd.DataFrame:
+    """Reads CSV data with encoding detection
+
+    Data is first read as UTF-8, which covers most files. Otherwise the
+    encoding is detected from a sample of the data, falling back to
+    detection over the whole data if decoding with the sampled encoding fails.
+    """
+    try:
+        return pd.read_csv(io.BytesIO(data), encoding="utf-8-sig")
+    except UnicodeDecodeError:
+        pass
+    try:
+        return pd.read_csv(io.BytesIO(data), encoding=detect_encoding(data))
+    except UnicodeDecodeError:
+        encoding = chardet.detect(data)["encoding"] or "latin-1"
+        return pd.read_csv(io.BytesIO(data), encoding=encoding)
+
+
+# Codes of REDCap choices, such as '1' or 'yes'
+REDCAP_CODE = re.compile(r"[\w.\-]+")
+
+# Columns of a mapping that hold responses
+RESPONSE_COLUMNS = ["raw_response", "arc_response"]
+
+
+def format_responses(responses: Any) -> Any:
+    "Returns responses as JSON text, as shown in the app and intermediate files"
+    if isinstance(responses, list):
+        return json.dumps(responses, ensure_ascii=False)
+    return responses
+
+
+def parse_responses_text(s: str) -> Responses | str | None:
+    """Parses responses formatted by :meth:`format_responses`
+
+    Intermediate files from older versions store the Python representation
+    of responses instead of JSON, which is parsed using ast.literal_eval.
+    Text edited in the app may also be REDCap choices such as
+    '1, Yes | 0, No', see :meth:`is_redcap_response`. Only lists of
+    responses are accepted, any other text is returned unchanged.
+    """
+    if not s.strip():
+        return None
+    try:
+        responses = json.loads(s)
+    except ValueError:
+        try:
+            responses = ast.literal_eval(s)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            responses = None
+    if isinstance(responses, list | tuple) and all(
+        isinstance(r, list | tuple) for r in responses
+    ):
+        return [tuple(r) for r in responses]
+    if responses is None and is_redcap_response(s):
+        return parse_redcap_response(s)
+    return s
+
+
+def is_redcap_response(s: str) -> bool:
+    """Returns whether text is REDCap choices such as '1, Yes | 0, No'
+
+    Each choice needs a code without spaces and a label. A single choice
+    also needs a numeric code, so that free text such as 'yes if present,
+    see notes' is not taken for choices.
+    """
+    choices = [r.split(",", 1) for r in s.split("|")]
+    if not all(
+        len(r) == 2 and REDCAP_CODE.fullmatch(r[0].strip()) and r[1].strip()
+        for r in choices
+    ):
+        return False
+    return len(choices) > 1 or choices[0][0].strip().isdigit()
+
+
+def map_distinct_strings(
+    values: pd.Series, func: Callable[[str], Any], keep_other: bool = False
+) -> pd.Series:
+    """Applies func to each distinct string in values
+
+    Rows with the same string share the result. Values that are not strings
+    are replaced by None, or kept as they are if keep_other is set.
+    """
+    is_string = values.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+    if keep_other:
+        out = values.to_numpy(dtype=object, copy=True)
+    else:
+        out = np.full(len(values), None, dtype=object)
+    if is_string.any():
+        codes, uniques = pd.factorize(values[is_string])
+        results = np.empty(len(uniques), dtype=object)
+        results[:] = [func(s) for s in uniques]
+        out[is_string] = results[codes]
+    return pd.Series(out, index=values.index, dtype=object)
+
+
+def parse_response_columns(df: pd.DataFrame):
+    "Parses response columns of a mapping frame that are stored as text"
+    for column in RESPONSE_COLUMNS:
+        if column in df.columns:
+            df[column] = map_distinct_strings(
+                df[column], parse_responses_text, keep_other=True
+            )
+
+
+def stringify_response_columns(df: pd.DataFrame):
+    "Stringify response columns for output in mapping frame"
+    for column in RESPONSE_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].map(format_responses)
 
 
 def parse_redcap_response(s: str) -> Responses:
-    return [tuple([x.strip() for x in r.split(",")]) for r in s.split("|")]
+    "Parses REDCap choices such as '1, Yes | 0, No', labels may contain commas"
+    return [tuple([x.strip() for x in r.split(",", 1)]) for r in s.split("|")]
+
+
+def parse_redcap_responses(values: pd.Series) -> pd.Series:
+    """Parses a column of REDCap responses, see :meth:`parse_redcap_response`
+
+    Data dictionaries repeat the same few response sets (such as yes / no /
+    unknown) across many fields, so each distinct string is parsed once and
+    rows with the same responses share the parsed list. Values that are not
+    strings are parsed as None.
+    """
+    return map_distinct_strings(values, parse_redcap_response)
+
+
+def top_k(
+    similarity_matrix: numpy.typing.ArrayLike, num_matches: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns indices and scores of the top matches in each row
+
+    Only the selected scores are sorted, in descending order of similarity.
+    Ties are broken by lowest column index, so that the top matches for a
+    smaller num_matches are always a prefix of those for a larger one.
+    """
+    S = np.asarray(similarity_matrix)
+    k = max(min(num_matches, S.shape[1]), 0)
+    if k == 0:
+        top = np.empty((S.shape[0], 0), dtype=int)
+    else:
+        top = np.argpartition(-S, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(S, top, axis=1)
+    if k:
+        # argpartition picks arbitrary columns among scores tied with the
+        # last selected score, select these rows again with a stable sort
+        kth = scores.min(axis=1, keepdims=True)
+        tied = (S == kth).sum(axis=1) > (scores == kth).sum(axis=1)
+        if tied.any():
+            top[tied] = np.argsort(-S[tied], axis=1, kind="stable")[:, :k]
+            scores[tied] = np.take_along_axis(S[tied], top[tied], axis=1)
+    order = np.lexsort((top, -scores), axis=1)
+    return (
+        np.take_along_axis(top, order, axis=1),
+        np.take_along_axis(scores, order, axis=1),
+    )
@@ -2,9 +2,12 @@
 
 from pathlib import Path
 
+import numpy as np
 import pytest
+from sentence_transformers.util import cos_sim
 
 import arcmapper
+from arcmapper import cache, models
 
 dictionary_file = str(
     Path(__file__).parent
@@ -27,3 +30,40 @@ def data_dictionary():
         response_field="Choices, Calculations, OR Slider Labels",
         response_func="redcap",
     )
+
+
+class FakeModel:
+    "Stand-in encoder that embeds text as letter counts"
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, texts):
+        self.encoded += len(texts)
+        return np.array(
+            [
+                [t.lower().count(c) for c in "abcdefghijklmnopqrstuvwxyz "]
+                for t in texts
+            ],
+            dtype=np.float32,
+        ).reshape(len(texts), 27)
+
+    def similarity(self, a, b):
+        return cos_sim(a, b)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    "Uses a temporary cache directory for each test"
+    monkeypatch.setattr(cache, "ARCMAPPER_CACHE_DIR", tmp_path / "cache")
+    return tmp_path / "cache"
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    "Replaces models in the registry with a FakeModel"
+    model = FakeModel()
+    monkeypatch.setattr(
+        models, "MODELS", models.ModelRegistry(loader=lambda name, device: model)
+    )
+    return model
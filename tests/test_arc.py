@@ -1,8 +1,15 @@
 "Module to read ARC schema"
 
+import urllib.error
 from pathlib import Path
 
-from arcmapper.arc import arc_schema_url, read_arc_schema
+import pandas as pd
+import pytest
+
+import arcmapper.arc
+from arcmapper.arc import arc_schema_url, read_arc_schema, load_arc_version
+
+ARC_FILE = str(Path(__file__).parent / "data" / "ARCH.csv")
 
 
 def test_arc_schema_url():
@@ -13,5 +20,79 @@ def test_arc_schema_url():
 
 
 def test_read_arc_schema():
-    arc = read_arc_schema(str(Path(__file__).parent / "data" / "ARCH.csv"))
+    arc = read_arc_schema(ARC_FILE)
     print(arc)
+
+
+def test_read_arc_schema_preset():
+    arc = read_arc_schema(ARC_FILE)
+    dengue = read_arc_schema(ARC_FILE, "Disease_Dengue")
+    assert 0 < len(dengue) < len(arc)
+    assert dengue.attrs["preset"] == "Disease_Dengue"
+    with pytest.raises(ValueError, match="No such preset"):
+        read_arc_schema(ARC_FILE, "Disease_Unknown")
+
+
+class FakeFetch:
+    "Stand-in for fetch_arc_schema that serves the local ARC file"
+
+    def __init__(self, status=200):
+        self.status = status
+        self.etags = []
+
+    def __call__(self, arc_version, etag=None):
+        self.etags.append(etag)
+        match self.status:
+            case 200:
+                return read_arc_schema(ARC_FILE), '"v1"'
+            case 304:
+                return None, etag
+            case _:
+                raise urllib.error.URLError("network unreachable")
+
+
+@pytest.fixture
+def arc_cache(monkeypatch):
+    monkeypatch.setattr(arcmapper.arc, "_schemas", {})
+    fetch = FakeFetch()
+    monkeypatch.setattr(arcmapper.arc, "fetch_arc_schema", fetch)
+    return fetch
+
+
+def test_load_arc_version_memoized(arc_cache):
+    arc = load_arc_version("1.0.0")
+    assert load_arc_version("1.0.0") is arc
+    assert arc_cache.etags == [None]
+
+
+def test_load_arc_version_revalidate(arc_cache, monkeypatch):
+    arc = load_arc_version("1.0.0")
+    monkeypatch.setattr(arcmapper.arc, "_schemas", {})
+    arc_cache.status = 304
+    cached = load_arc_version("1.0.0")
+    assert arc_cache.etags == [None, '"v1"']
+    pd.testing.assert_frame_equal(arc, cached)
+
+
+def test_load_arc_version_unreachable(arc_cache, monkeypatch):
+    arc_cache.status = 500
+    with pytest.raises(urllib.error.URLError):
+        load_arc_version("1.0.0")
+    arc_cache.status = 200
+    arc = load_arc_version("1.0.0")
+    monkeypatch.setattr(arcmapper.arc, "_schemas", {})
+    arc_cache.status = 500
+    pd.testing.assert_frame_equal(arc, load_arc_version("1.0.0"))
+
+
+def test_load_arc_version_offline(arc_cache, monkeypatch):
+    monkeypatch.setattr(arcmapper.arc, "ARCMAPPER_OFFLINE", True)
+    with pytest.raises(ValueError, match="offline mode"):
+        load_arc_version("1.0.0")
+    monkeypatch.setattr(arcmapper.arc, "ARCMAPPER_OFFLINE", False)
+    load_arc_version("1.0.0")
+    monkeypatch.setattr(arcmapper.arc, "_schemas", {})
+    monkeypatch.setattr(arcmapper.arc, "ARCMAPPER_OFFLINE", True)
+    arc = read_arc_schema("1.0.0", "Disease_Dengue")
+    assert arc.attrs == {"arc_version": "1.0.0", "preset": "Disease_Dengue"}
+    assert arc_cache.etags == [None]
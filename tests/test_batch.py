@@ -0,0 +1,85 @@
+import shutil
+from pathlib import Path
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+
+from arcmapper import tfidf
+from arcmapper.batch import cli, find_dictionaries, map_dictionaries
+from arcmapper.table import MappingTable
+
+DATA = Path(__file__).parent / "data"
+dictionary_file = DATA / "CCPUKSARIEastMidlands_DataDictionary_2022-06-06.csv"
+arc_file = str(DATA / "ARCH.csv")
+
+
+def test_find_dictionaries(tmp_path):
+    for name in ["a.csv", "b.xlsx", "notes.txt"]:
+        (tmp_path / name).touch()
+    assert [p.name for p in find_dictionaries([str(tmp_path)])] == ["a.csv", "b.xlsx"]
+    assert [p.name for p in find_dictionaries([str(tmp_path / "*.csv")] * 2)] == [
+        "a.csv"
+    ]
+
+
+def test_map_dictionaries(tmp_path, monkeypatch):
+    monkeypatch.setattr(tfidf, "_models", OrderedDict())
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    for site in ["site1", "site2"]:
+        shutil.copy(dictionary_file, inputs / f"{site}.csv")
+    results = map_dictionaries(
+        find_dictionaries([str(inputs)]),
+        arc_file,
+        "tf-idf",
+        tmp_path / "out",
+        num_matches=3,
+        workers=2,
+    )
+    # ARC TF-IDF model is fitted once, before worker processes start
+    assert len(tfidf._models) == 1
+    assert [p.name for p in results.values()] == [
+        "site1-mapping-tf-idf.csv",
+        "site2-mapping-tf-idf.csv",
+    ]
+    mapping = pd.read_csv(tmp_path / "out" / "site1-mapping-tf-idf.csv")
+    assert {"raw_variable", "arc_variable", "status", "id"} <= set(mapping.columns)
+    assert mapping["rank"].max() < 3
+
+
+def test_cli_reports_failures(tmp_path):
+    (tmp_path / "broken.csv").write_text("x\n1\n")
+    assert (
+        cli(
+            [
+                str(tmp_path / "broken.csv"),
+                "-a",
+                arc_file,
+                "-o",
+                str(tmp_path),
+                "-j",
+                "1",
+            ]
+        )
+        == 1
+    )
+
+
+def test_map_dictionaries_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    results = map_dictionaries(
+        [dictionary_file],
+        arc_file,
+        "tf-idf",
+        tmp_path,
+        num_matches=2,
+        workers=1,
+        output_format="parquet",
+    )
+    table = MappingTable.read_parquet(str(results[dictionary_file]))
+    assert table.metadata["method"] == "tf-idf"
+    assert table.metadata["arc_version"] == arc_file
+    assert table.frame.raw_response.map(
+        lambda r: r is None or isinstance(r, list)
+    ).all()
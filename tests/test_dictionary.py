@@ -1,6 +1,15 @@
+from pathlib import Path
+
 import pandas as pd
 
-from arcmapper.dictionary import read_from_jsonschema
+from arcmapper.dictionary import read_data_dictionary, read_from_jsonschema
+from arcmapper.util import parse_redcap_response
+
+DICTIONARY_FILE = str(
+    Path(__file__).parent
+    / "data"
+    / "CCPUKSARIEastMidlands_DataDictionary_2022-06-06.csv"
+)
 
 
 EXAMPLE_JSON_SCHEMA = """{
@@ -28,6 +37,41 @@ def test_read_data_dictionary(data_dictionary):
     assert data_dictionary.columns.tolist()== ["variable", "description", "responses", "type"]
 
 
+def test_read_data_dictionary_responses(data_dictionary):
+    source = pd.read_csv(DICTIONARY_FILE)
+    expected = [
+        parse_redcap_response(x) if isinstance(x, str) else None
+        for x in source["Choices, Calculations, OR Slider Labels"]
+    ]
+    assert data_dictionary.responses.tolist() == expected
+
+
+def test_read_data_dictionary_infers_description():
+    dd = read_data_dictionary(
+        pd.DataFrame(
+            {
+                "name": ["age", "sex"],
+                "label": ["Age of the patient in years", "Sex at birth"],
+                "units": ["years", None],
+            }
+        )
+    )
+    assert dd.description.tolist() == ["Age of the patient in years", "Sex at birth"]
+    assert dd.type.tolist() == ["string", "string"]
+    assert dd.responses.isna().all()
+
+
+def test_read_data_dictionary_chunked(data_dictionary):
+    chunked = read_data_dictionary(
+        DICTIONARY_FILE,
+        description_field="Field Label",
+        response_field="Choices, Calculations, OR Slider Labels",
+        response_func="redcap",
+        chunksize=100,
+    )
+    assert chunked.equals(data_dictionary)
+
+
 def test_read_from_jsonschema():
     dd = read_from_jsonschema(EXAMPLE_JSON_SCHEMA)
     print(dd)
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from arcmapper import embeddings
+from arcmapper.embeddings import (
+    EmbeddingIndex,
+    TextEmbeddingCache,
+    arc_embeddings,
+    arc_index,
+    arc_text,
+    encode,
+    normalize,
+)
+from arcmapper.util import top_k
+
+
+def test_arc_embeddings_cached(fake_model, arc_schema, cache_dir):
+    first = arc_embeddings(arc_schema, "fake-model")
+    assert fake_model.encoded == len(arc_schema)
+    assert len(list((cache_dir / "embeddings").glob("*.npy"))) == 1
+
+    second = arc_embeddings(arc_schema, "fake-model")
+    assert fake_model.encoded == len(arc_schema)
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, second)
+
+
+def test_arc_embeddings_keyed_by_model_and_content(fake_model, arc_schema, cache_dir):
+    arc_embeddings(arc_schema, "fake-model")
+    arc_embeddings(arc_schema, "other-model")
+    arc_embeddings(arc_schema.iloc[:10], "fake-model")
+    assert len(list((cache_dir / "embeddings").glob("*.npy"))) == 3
+    assert fake_model.encoded == 2 * len(arc_schema) + 10
+
+
+def test_arc_embeddings_not_in_text_cache(fake_model, arc_schema):
+    arc_embeddings(arc_schema, "fake-model")
+    # ARC text is stored in the .npy file only
+    assert len(embeddings.text_cache()) == 0
+    encode(["Age"], "fake-model")
+    assert len(embeddings.text_cache()) == 1
+
+
+def test_text_cache_shared(cache_dir, tmp_path, monkeypatch):
+    store = embeddings.text_cache()
+    assert embeddings.text_cache() is store
+    # a different cache directory has its own cache
+    monkeypatch.setattr(embeddings, "cache_dir", lambda kind: tmp_path / "other")
+    (tmp_path / "other").mkdir()
+    assert embeddings.text_cache() is not store
+
+
+def test_encode_cached(fake_model):
+    first = encode(["Age", "Sex at birth", "Age"], "fake-model")
+    assert first.dtype == np.float32
+    assert first.shape == (3, 27)
+    np.testing.assert_array_equal(first[0], first[2])
+    assert fake_model.encoded == 2
+
+    # other sites share most labels, only new text is encoded
+    second = encode(["Sex  at birth ", "Weight", "Age"], "fake-model")
+    assert fake_model.encoded == 3
+    np.testing.assert_array_equal(second[0], first[1])
+    np.testing.assert_array_equal(second[2], first[0])
+
+    encode(["Age"], "other-model")
+    assert fake_model.encoded == 4
+
+
+def test_encode_cache_disabled(fake_model, monkeypatch):
+    monkeypatch.setattr(embeddings, "ARCMAPPER_TEXT_CACHE_MB", 0)
+    encode(["Age"], "fake-model")
+    encode(["Age"], "fake-model")
+    assert fake_model.encoded == 2
+
+
+def test_encode_empty(fake_model):
+    assert encode([], "fake-model").shape[0] == 0
+
+
+def test_text_embedding_cache_eviction(tmp_path):
+    store = TextEmbeddingCache(tmp_path / "text.sqlite", max_bytes=10 * 4 * 4)
+    vector = np.ones(4, dtype=np.float32)
+    store.put("model", {f"old{i}": vector for i in range(5)})
+    store.get("model", ["old0"])
+    store.put("model", {f"new{i}": vector for i in range(6)})
+    assert len(store) == 9
+    assert set(store.get("model", ["old0", "old1", "old2", "new5"])) == {
+        "old0",
+        "new5",
+    }
+
+
+def test_arc_text(arc_schema):
+    assert len(arc_text(arc_schema)) == len(arc_schema)
+
+
+@pytest.mark.parametrize("index_type,tolerance", [("float16", 1e-3), ("int8", 2e-2)])
+def test_embedding_index(index_type, tolerance):
+    rng = np.random.default_rng(0)
+    arc = rng.normal(size=(200, 32))
+    queries = rng.normal(size=(30, 32))
+    index = EmbeddingIndex.build(arc, index_type)
+    top, scores = index.query(queries, 5, chunk_size=7)
+    S = normalize(queries) @ normalize(arc).T
+    expected_top, expected_scores = top_k(S, 5)
+    assert top.shape == (30, 5)
+    np.testing.assert_allclose(scores, expected_scores, atol=tolerance)
+    assert (top[:, 0] == expected_top[:, 0]).mean() > 0.9
+
+
+def test_embedding_index_unknown_type():
+    with pytest.raises(ValueError, match="Unknown index type"):
+        EmbeddingIndex.build(np.ones((2, 2)), "int4")
+
+
+def test_arc_index_cached(fake_model, arc_schema):
+    index = arc_index(arc_schema, "fake-model", "int8")
+    assert fake_model.encoded == len(arc_schema)
+    cached = arc_index(arc_schema, "fake-model", "int8")
+    assert fake_model.encoded == len(arc_schema)
+    assert isinstance(cached.vectors, np.memmap)
+    np.testing.assert_array_equal(index.vectors, cached.vectors)
+    np.testing.assert_array_equal(index.scale, cached.scale)
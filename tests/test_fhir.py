@@ -1,8 +1,10 @@
+import shutil
 from pathlib import Path
 
 import pandas as pd
+import pytest
 
-from arcmapper.fhir import FHIRMapping, merge, format_merge
+from arcmapper.fhir import FHIRMapping, merge, format_merge, join_resources
 
 MAPPING = Path(__file__).parent.parent / "arc-fhir" / "ARC_pre_1.0.0_preset_dengue.xlsx"
 DRAFT_MAPPING = Path(__file__).parent / "data" / "arcmapper-mapping-file.csv"
@@ -27,8 +29,60 @@ def test_fhir_mapping():
     assert {"arc_variable", "arc_response"} <= set(encounter.columns)
 
 
+def test_fhir_mapping_cached(monkeypatch, tmp_path, cache_dir):
+    mapping_file = tmp_path / "mapping.xlsx"
+    shutil.copy(MAPPING, mapping_file)
+    patient = FHIRMapping(mapping_file).get_resource("Patient")
+    assert len(list((cache_dir / "fhir").glob("*.pkl"))) == 1
+
+    def read_excel(*args, **kwargs):
+        raise AssertionError("cached mapping should not be read again")
+
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_excel", read_excel)
+        cached = FHIRMapping(mapping_file)
+        pd.testing.assert_frame_equal(patient, cached.get_resource("Patient"))
+
+    # changing the mapping file invalidates the cache
+    with pd.ExcelWriter(mapping_file) as writer:
+        pd.DataFrame({"Resources": ["Patient"]}).to_excel(
+            writer, sheet_name="Resources", index=False
+        )
+        patient.iloc[:1].rename(columns={"arc_variable": "raw_variable"}).to_excel(
+            writer, sheet_name="Patient", index=False
+        )
+    changed = FHIRMapping(mapping_file)
+    assert changed.resources == ["Patient"]
+    assert len(changed.get_resource("Patient")) == 1
+    with pytest.raises(ValueError, match="Resource 'Encounter' not found"):
+        changed.get_resource("Encounter")
+
+
 def test_merge(snapshot):
     draft_mapping = pd.read_csv(DRAFT_MAPPING)
     fhir_mapping = FHIRMapping(MAPPING)
     data = merge(draft_mapping, fhir_mapping, resources=["Patient"])
     assert format_merge(data) == snapshot
+
+
+def test_join_resources():
+    fhir_mapping = FHIRMapping(MAPPING)
+    keys = fhir_mapping.join_index[["arc_variable", "arc_response"]]
+    draft = pd.concat(
+        [
+            keys.sample(200, random_state=0),
+            pd.DataFrame({"arc_variable": ["not_in_arc"], "arc_response": [None]}),
+        ],
+        ignore_index=True,
+    )
+    draft.insert(0, "raw_variable", [f"v{i}" for i in range(len(draft))])
+    draft["id"] = range(len(draft))
+    data = join_resources(draft, fhir_mapping)
+    assert list(data) == fhir_mapping.resources
+    for resource, joined in data.items():
+        pd.testing.assert_frame_equal(
+            joined,
+            draft.merge(
+                fhir_mapping.get_resource(resource), on=["arc_variable", "arc_response"]
+            ),
+        )
@@ -0,0 +1,162 @@
+import sys
+import time
+import threading
+import subprocess
+
+import pytest
+
+from arcmapper import jobs
+from arcmapper.cache import save_pickle
+from arcmapper.jobs import (
+    ARCMAPPER_JOB_HEARTBEAT,
+    JOB_STALE_HEARTBEATS,
+    JOB_STATE,
+    Job,
+    JobQueue,
+    check_cancelled,
+)
+
+
+def wait(job):
+    job.future.result(timeout=10)
+    return job
+
+
+def test_job_done():
+    queue = JobQueue(workers=2)
+
+    def add(job, a, b):
+        job.report(0.5, "adding")
+        return a + b
+
+    job = wait(queue.submit(add, 1, 2))
+    assert (job.status, job.result, job.progress) == ("done", 3, 1.0)
+    assert queue.get(job.id) is job
+    assert queue.get(None) is None
+
+
+def test_job_failed():
+    queue = JobQueue(workers=1)
+
+    def fail(job):
+        raise ValueError("bad input")
+
+    job = wait(queue.submit(fail))
+    assert job.status == "failed"
+    assert job.error == "bad input"
+
+
+def test_job_cancelled_while_running():
+    queue = JobQueue(workers=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(job):
+        started.set()
+        release.wait(10)
+        job.report(0.5)
+        raise AssertionError("job should have been cancelled")
+
+    job = queue.submit(slow)
+    started.wait(10)
+    queue.cancel(job.id)
+    release.set()
+    assert wait(job).status == "cancelled"
+
+
+def test_job_cancelled_while_queued():
+    queue = JobQueue(workers=1)
+    release = threading.Event()
+    blocker = queue.submit(lambda job: release.wait(10))
+    queued = queue.submit(lambda job: pytest.fail("should not run"))
+    queued.cancel()
+    release.set()
+    wait(blocker)
+    assert queued.status == "cancelled"
+
+
+def test_finished_jobs_expire():
+    queue = JobQueue(workers=1, ttl=0)
+    job = wait(queue.submit(lambda job: None))
+    job.finished -= 1
+    queue.submit(lambda job: None)
+    assert queue.get(job.id) is None
+
+
+def test_job_on_disk_shared(cache_dir):
+    # queues in two server worker processes
+    first, second = JobQueue(workers=1, on_disk=True), JobQueue(on_disk=True)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(job):
+        job.report(0.25, "started")
+        started.set()
+        release.wait(10)
+        job.report(0.5)
+        raise AssertionError("job should have been cancelled")
+
+    job = first.submit(slow)
+    started.wait(10)
+    polled = second.get(job.id)
+    assert (polled.status, polled.progress, polled.message) == (
+        "running",
+        0.25,
+        "started",
+    )
+    second.cancel(job.id)
+    release.set()
+    assert wait(job).status == "cancelled"
+    assert second.get(job.id).status == "cancelled"
+
+    done = wait(first.submit(lambda job: b"result"))
+    assert second.get(done.id).result == b"result"
+
+
+def test_job_on_disk_owner_stopped(cache_dir):
+    # a server worker process that stopped while running a job
+    worker = subprocess.Popen([sys.executable, "-c", "pass"])
+    worker.wait()
+    job = Job(JobQueue(on_disk=True)._path("abc123"))
+    job.id, job.status, job.pid = "abc123", "running", worker.pid
+    job._save()
+    polled = JobQueue(on_disk=True).get(job.id)
+    assert polled.status == "failed"
+    assert "stopped" in polled.error
+
+
+def test_job_on_disk_stale_heartbeat(cache_dir):
+    job = Job(JobQueue(on_disk=True)._path("abc123"))
+    job.id, job.status = "abc123", "running"
+    job._save()
+    second = JobQueue(on_disk=True)
+    assert second.get(job.id).status == "running"
+    job.heartbeat -= JOB_STALE_HEARTBEATS * ARCMAPPER_JOB_HEARTBEAT + 1
+    save_pickle(job.path, {k: getattr(job, k) for k in JOB_STATE})
+    assert second.get(job.id).status == "failed"
+
+
+def test_job_on_disk_heartbeat(cache_dir, monkeypatch):
+    monkeypatch.setattr(jobs, "ARCMAPPER_JOB_HEARTBEAT", 0.05)
+    queue, release = JobQueue(workers=1, on_disk=True), threading.Event()
+    job = queue.submit(lambda job: release.wait(10))
+    first = Job.load(job.path).heartbeat
+    time.sleep(0.3)
+    assert Job.load(job.path).heartbeat > first
+    release.set()
+    assert wait(job).status == "done"
+
+
+def test_job_cancelled_between_chunks():
+    queue, started = JobQueue(workers=1), threading.Event()
+
+    def chunks(job):
+        started.set()
+        while True:
+            check_cancelled()
+            time.sleep(0.01)
+
+    job = queue.submit(chunks)
+    started.wait(10)
+    queue.cancel(job.id)
+    assert wait(job).status == "cancelled"
+    # outside of jobs, check_cancelled does nothing
+    check_cancelled()
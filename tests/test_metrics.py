@@ -0,0 +1,125 @@
+import json
+import time
+import logging
+import threading
+import tracemalloc
+
+import pytest
+
+from arcmapper import metrics
+from arcmapper.metrics import Histogram, Metrics, request, span, timed
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    "Uses empty metrics for each test"
+    registry = Metrics()
+    monkeypatch.setattr(metrics, "METRICS", registry)
+    return registry
+
+
+def test_histogram():
+    h = Histogram([1, 5])
+    for value in [0.5, 2, 10]:
+        h.observe(value)
+    assert h.render("x", 'stage="a"') == [
+        'x_bucket{stage="a",le="1"} 1',
+        'x_bucket{stage="a",le="5"} 2',
+        'x_bucket{stage="a",le="+Inf"} 3',
+        'x_sum{stage="a"} 12.5',
+        'x_count{stage="a"} 3',
+    ]
+
+
+def test_span(registry, caplog):
+    @timed("outer")
+    def outer():
+        with span("inner", rows=3):
+            pass
+
+    with caplog.at_level(logging.INFO, logger="arcmapper.metrics"), request("r1"):
+        outer()
+        with pytest.raises(ValueError), span("inner"):
+            raise ValueError
+    assert registry.durations["outer"].count == 1
+    assert registry.durations["inner"].count == 2
+    assert registry.errors == {"inner": 1}
+    lines = [json.loads(r.message) for r in caplog.records]
+    assert [line["stage"] for line in lines] == ["inner", "outer", "inner"]
+    assert lines[0]["rows"] == 3
+    assert all(line["request_id"] == "r1" for line in lines)
+
+
+def test_span_memory(registry, monkeypatch):
+    monkeypatch.setattr(metrics, "ARCMAPPER_METRICS_MEMORY", True)
+    with span("outer"):
+        with span("inner"):
+            data = bytearray(8 * 2**20)
+        del data
+    assert registry.memory["inner"].sum >= 8 * 2**20
+    assert registry.memory["outer"].sum >= registry.memory["inner"].sum
+    # tracing stops when no spans are open
+    assert not tracemalloc.is_tracing()
+
+
+def test_span_memory_concurrent(registry, monkeypatch):
+    monkeypatch.setattr(metrics, "ARCMAPPER_METRICS_MEMORY", True)
+    started, done = threading.Event(), threading.Event()
+
+    def other():
+        with span("other"):
+            started.set()
+            done.wait(5)
+
+    with span("first"):
+        thread = threading.Thread(target=other)
+        thread.start()
+        started.wait(5)
+    done.set()
+    thread.join()
+    with span("after"):
+        pass
+    # memory of overlapping spans of different threads is not recorded
+    assert registry.durations.keys() == {"first", "other", "after"}
+    assert registry.memory.keys() == {"after"}
+    assert not tracemalloc.is_tracing()
+
+
+def test_render(registry):
+    registry.observe("arc.read_arc_schema", 0.2, None, failed=False)
+    text = registry.render()
+    assert "# TYPE arcmapper_stage_duration_seconds histogram" in text
+    assert (
+        'arcmapper_stage_duration_seconds_count{stage="arc.read_arc_schema"} 1' in text
+    )
+    assert "arcmapper_stage_peak_memory_bytes" not in text
+
+
+def test_metrics_shared(monkeypatch):
+    # metrics of two server worker processes
+    monkeypatch.setattr(metrics, "METRICS_SAVE_INTERVAL", 0.01)
+    first, second = Metrics(on_disk=True), Metrics(on_disk=True)
+    first.observe("app.map", 1.5, None, failed=False)
+    second.observe("app.map", 0.5, None, failed=True)
+    second.observe("arc.read_arc_schema", 0.2, 2**20, failed=False)
+    time.sleep(0.2)
+    total = first.shared()
+    assert total.durations["app.map"].count == 2
+    assert total.durations["app.map"].sum == 2.0
+    assert total.memory["arc.read_arc_schema"].count == 1
+    assert total.errors == {"app.map": 1}
+    # metrics of each process are unchanged
+    assert first.durations["app.map"].count == 1
+    first.clear_shared()
+    assert first.shared().durations["app.map"].count == 1
+
+
+def test_metrics_route(monkeypatch):
+    from arcmapper import app
+
+    monkeypatch.setattr(app, "METRICS", Metrics())
+    app.METRICS.observe("app.map", 1.5, None, failed=False)
+    response = app.server.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    assert b'arcmapper_stage_duration_seconds_count{stage="app.map"} 1' in response.data
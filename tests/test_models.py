@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from arcmapper.models import ModelRegistry
+
+
+class CountingLoader:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name, device):
+        with self.lock:
+            self.calls.append((name, device))
+        return object()
+
+
+def test_model_registry_loads_once():
+    loader = CountingLoader()
+    registry = ModelRegistry(loader=loader)
+    model = registry.get("model-a")
+    assert registry.get("model-a") is model
+    assert loader.calls == [("model-a", None)]
+
+
+def test_model_registry_keyed_by_device():
+    loader = CountingLoader()
+    registry = ModelRegistry(loader=loader)
+    assert registry.get("model-a", "cpu") is not registry.get("model-a", "cuda")
+    assert len(loader.calls) == 2
+
+
+def test_model_registry_lru_eviction():
+    loader = CountingLoader()
+    registry = ModelRegistry(maxsize=2, loader=loader)
+    registry.get("model-a")
+    registry.get("model-b")
+    registry.get("model-a")  # model-b is now least recently used
+    registry.get("model-c")
+    assert ("model-a", None) in registry
+    assert ("model-b", None) not in registry
+    assert len(registry) == 2
+
+
+def test_model_registry_concurrent_get():
+    loader = CountingLoader()
+    registry = ModelRegistry(loader=loader)
+    threads = [
+        threading.Thread(target=registry.get, args=("model-a",)) for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert loader.calls == [("model-a", None)]
+
+
+def test_model_registry_invalid_size():
+    with pytest.raises(ValueError, match="at least 1"):
+        ModelRegistry(maxsize=0)
@@ -0,0 +1,23 @@
+from collections import OrderedDict
+from pathlib import Path
+
+from arcmapper import jobs, metrics, prefork, sessions, tfidf
+
+arc_file = str(Path(__file__).parent / "data" / "ARCH.csv")
+
+
+def test_preload(fake_model, cache_dir, monkeypatch):
+    monkeypatch.setattr(tfidf, "_models", OrderedDict())
+    monkeypatch.setattr(prefork, "warmup", lambda: None)
+    prefork.preload([arc_file, "no-such-arc.csv"])
+    assert len(tfidf._models) == 1
+    assert len(list((cache_dir / "embeddings").glob("*.npy"))) == 1
+
+
+def test_share_state(monkeypatch):
+    monkeypatch.setattr(sessions.SESSIONS, "on_disk", False)
+    monkeypatch.setattr(jobs.JOBS, "on_disk", False)
+    monkeypatch.setattr(metrics.METRICS, "on_disk", False)
+    prefork.share_state()
+    assert sessions.SESSIONS.on_disk and jobs.JOBS.on_disk
+    assert metrics.METRICS.on_disk
@@ -0,0 +1,120 @@
+import time
+
+import pandas as pd
+
+from arcmapper import sessions
+from arcmapper.sessions import SessionStore, new_session_id
+from arcmapper.table import MappingTable
+
+
+def test_session_store_get_set():
+    store = SessionStore()
+    sid = new_session_id()
+    assert store.get(sid, "mapping") is None
+    df = pd.DataFrame({"status": ["-"]})
+    store.set(sid, "mapping", df)
+    assert store.get(sid, "mapping") is df
+    store.delete(sid)
+    assert store.get(sid, "mapping") is None
+
+
+def test_session_store_lru_eviction():
+    store = SessionStore(maxsize=2)
+    for sid in ["a", "b", "c"]:
+        store.set(sid, "x", sid)
+    assert "a" not in store
+    assert store.get("c", "x") == "c"
+    assert len(store) == 2
+
+
+def test_session_store_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, "time", lambda: now[0])
+    store = SessionStore(ttl=10)
+    store.set("a", "x", 1)
+    now[0] += 5
+    assert store.get("a", "x") == 1
+    now[0] += 11
+    store.set("b", "x", 2)
+    assert "a" not in store
+    assert store.get("a", "x") is None
+
+
+def test_session_store_on_disk(cache_dir):
+    sid = new_session_id()
+    SessionStore(on_disk=True).set(sid, "mapping", pd.DataFrame({"id": [0, 1]}))
+    assert (cache_dir / "sessions" / f"{sid}.pkl").exists()
+    # a new store, such as after a server restart, reads the session from disk
+    restored = SessionStore(on_disk=True).get(sid, "mapping")
+    assert list(restored.id) == [0, 1]
+
+
+def test_session_store_on_disk_shared(cache_dir):
+    # stores in two server worker processes
+    first, second = SessionStore(on_disk=True), SessionStore(on_disk=True)
+    sid = new_session_id()
+    first.set(sid, "x", 1)
+    assert second.get(sid, "x") == 1
+    second.set(sid, "x", 2)
+    assert first.get(sid, "x") == 2
+
+
+def test_session_store_edits_shared(cache_dir):
+    # stores in two server worker processes editing different rows
+    first, second = SessionStore(on_disk=True), SessionStore(on_disk=True)
+    sid = new_session_id()
+    first.set(sid, "mapping", MappingTable(pd.DataFrame({"status": ["-", "-"]})))
+    assert second.get(sid, "mapping").get(1, "status") == "-"
+    session_file = cache_dir / "sessions" / f"{sid}.pkl"
+    mtime = session_file.stat().st_mtime_ns
+    first.edit(sid, "mapping", lambda table: [(0, "status", "✅")])
+    second.edit(sid, "mapping", lambda table: [(1, "status", "✅")])
+    # only the edits are written, not the whole session
+    assert session_file.stat().st_mtime_ns == mtime
+    for store in [first, second, SessionStore(on_disk=True)]:
+        assert store.get(sid, "mapping").frame.status.tolist() == ["✅", "✅"]
+
+
+def test_session_store_edit_sees_other_edits(cache_dir):
+    first, second = SessionStore(on_disk=True), SessionStore(on_disk=True)
+    sid = new_session_id()
+    first.set(sid, "mapping", MappingTable(pd.DataFrame({"status": ["-"]})))
+
+    def toggle(table):
+        return [(0, "status", "✅" if table.get(0, "status") == "-" else "-")]
+
+    assert first.edit(sid, "mapping", toggle) == [(0, "status", "✅")]
+    assert second.edit(sid, "mapping", toggle) == [(0, "status", "-")]
+    assert first.get(sid, "mapping").get(0, "status") == "-"
+    assert first.edit(sid, "missing", toggle) is None
+
+
+def test_session_store_edit_log_compacted(cache_dir, monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_LOG_MAX_BYTES", 0)
+    store = SessionStore(on_disk=True)
+    sid = new_session_id()
+    store.set(sid, "mapping", MappingTable(pd.DataFrame({"status": ["-"]})))
+    store.edit(sid, "mapping", lambda table: [(0, "status", "✅")])
+    assert not (cache_dir / "sessions" / f"{sid}.log").exists()
+    restored = SessionStore(on_disk=True).get(sid, "mapping")
+    assert restored.get(0, "status") == "✅"
+
+
+def test_session_store_on_disk_kept_alive_by_other_store(cache_dir):
+    # stores in two server worker processes, the session is used by second
+    first, second = SessionStore(ttl=1, on_disk=True), SessionStore(ttl=1, on_disk=True)
+    sid = new_session_id()
+    first.set(sid, "x", 1)
+    time.sleep(0.6)
+    assert second.get(sid, "x") == 1
+    time.sleep(0.6)
+    # expires the session in the memory of first, but not on disk
+    first.set(new_session_id(), "x", 2)
+    assert sid not in first
+    assert (cache_dir / "sessions" / f"{sid}.pkl").exists()
+    assert second.get(sid, "x") == 1
+    time.sleep(1.1)
+    # not used by any store within ttl
+    second.set(new_session_id(), "x", 3)
+    assert not (cache_dir / "sessions" / f"{sid}.pkl").exists()
+    assert first.get(sid, "x") is None
@@ -0,0 +1,39 @@
+"Startup time budget, guards against heavy imports at module load"
+
+import sys
+import subprocess
+
+import pytest
+
+# Backends that should only be imported when a mapping method needs them
+HEAVY_MODULES = ["torch", "sentence_transformers", "sklearn", "scipy"]
+
+# Budget for cumulative import time of arcmapper, in microseconds
+IMPORT_BUDGET_US = 5_000_000
+
+
+def import_times(module: str) -> dict[str, int]:
+    "Returns cumulative import time in microseconds of each imported module"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", ["arcmapper", "arcmapper.app"])
+def test_import_skips_heavy_backends(module):
+    imported = import_times(module)
+    assert not [m for m in HEAVY_MODULES if m in imported]
+
+
+def test_import_time_budget():
+    assert import_times("arcmapper")["arcmapper"] < IMPORT_BUDGET_US
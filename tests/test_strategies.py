@@ -1,6 +1,27 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
 import pytest
+import scipy.sparse
+
+import arcmapper.strategies
+
+from arcmapper.strategies import (
+    get_match_dataframe_from_similarity_matrix,
+    sparse_top_k,
+    top_k,
+    use_map,
+    sbert,
+    tf_idf,
+    match_responses,
+    match_responses_batch,
+    infer_response_mapping,
+    Response,
+)
 
-from arcmapper.strategies import use_map, match_responses, Response
+YES_NO = [Response("1", "Yes"), Response("0", "No"), Response("99", "Unknown")]
+YES_NO_STR = "[('1', 'Yes'), ('0', 'No'), ('99', 'Unknown')]"
 
 
 def test_match_responses():
@@ -12,14 +33,137 @@ def test_match_responses():
     ]
 
 
+def test_match_responses_batch(fake_model):
+    pairs = [(YES_NO, YES_NO)] * 50 + [([Response("1", "No")], YES_NO), ([], YES_NO)]
+    matches = match_responses_batch(pairs)
+    assert fake_model.encoded == 3
+    assert matches[0] == list(zip(YES_NO, YES_NO))
+    assert matches[50] == [(("1", "No"), ("0", "No"))]
+    assert matches[51] == []
+
+
+def test_infer_response_mapping(fake_model):
+    m = pd.DataFrame(
+        {
+            "raw_variable": ["sex", "fever", "subjid"],
+            "raw_description": ["Sex", "Fever", "Subject"],
+            "raw_response": ["[('1', 'Female'), ('2', 'Male')]", YES_NO_STR, None],
+            "arc_variable": ["demog_sex", "sympt_fever", "subjid"],
+            "arc_description": ["Sex at birth", "Fever", "Subject ID"],
+            "arc_response": ["[('1', 'Male'), ('2', 'Female')]", YES_NO_STR, None],
+            "arc_type": ["enum", "multiselect", "string"],
+        }
+    )
+    df = infer_response_mapping(m)
+    assert df.raw_response.tolist() == [
+        "1, Female",
+        "2, Male",
+        "1, Yes",
+        "0, No",
+        "99, Unknown",
+        None,
+    ]
+    assert df.arc_response.tolist() == [
+        "2, Female",
+        "1, Male",
+        "1, Yes",
+        "1, No",
+        "1, Unknown",
+        None,
+    ]
+    assert df.arc_variable.tolist() == [
+        "demog_sex",
+        "demog_sex",
+        "sympt_fever___1",
+        "sympt_fever___0",
+        "sympt_fever___99",
+        "subjid",
+    ]
+
+
+def test_get_match_dataframe_from_similarity_matrix():
+    rng = np.random.default_rng(42)
+    S = rng.random((40, 60))
+    dictionary = pd.DataFrame(
+        {"variable": [f"d{i}" for i in range(40)], "description": "", "responses": None}
+    )
+    arc = pd.DataFrame(
+        {
+            "variable": [f"a{i}" for i in range(60)],
+            "description": "",
+            "responses": None,
+            "type": "string",
+        }
+    )
+    df = get_match_dataframe_from_similarity_matrix(dictionary, arc, S, 3, 0.9)
+    expected = [
+        (f"d{i}", f"a{k}", j)
+        for i in range(40)
+        for j, k in enumerate(np.argsort(-S[i])[:3])
+        if S[i, k] > 0.9
+    ]
+    assert list(zip(df.raw_variable, df.arc_variable, df["rank"])) == expected
+    assert (df.similarity > 0.9).all()
+    assert df.columns[-1] == "similarity"
+
+
+def test_sparse_top_k(monkeypatch):
+    monkeypatch.setattr(arcmapper.strategies, "SIMILARITY_CHUNK_CELLS", 100)
+    X = scipy.sparse.random(50, 30, density=0.2, random_state=1, format="csr")
+    Y = scipy.sparse.random(40, 30, density=0.2, random_state=2, format="csr")
+    top, scores = sparse_top_k(X, Y, 4)
+    _, expected_scores = top_k(X.dot(Y.T).toarray(), 4)
+    assert top.shape == (50, 4)
+    np.testing.assert_allclose(scores, expected_scores)
+
+
 def test_tf_idf(data_dictionary, arc_schema):
     use_map("tf-idf", data_dictionary, arc_schema, num_matches=3)
 
 
+def test_use_map_threshold(data_dictionary, arc_schema, monkeypatch):
+    monkeypatch.setattr(arcmapper.strategies, "_candidates", OrderedDict())
+    for num_matches, threshold in [(3, 0.3), (5, 0.5), (2, 0.1)]:
+        expected = tf_idf(
+            data_dictionary, arc_schema, num_matches, threshold
+        ).reset_index(drop=True)
+        pd.testing.assert_frame_equal(
+            use_map("tf-idf", data_dictionary, arc_schema, num_matches, threshold),
+            expected,
+        )
+    assert len(arcmapper.strategies._candidates) == 1
+
+
+def test_use_map_cached(data_dictionary, arc_schema, monkeypatch):
+    monkeypatch.setattr(arcmapper.strategies, "_candidates", OrderedDict())
+    use_map("tf-idf", data_dictionary, arc_schema, 3, 0.3)
+
+    def tf_idf(*args, **kwargs):
+        raise AssertionError("candidates should be reused")
+
+    monkeypatch.setitem(arcmapper.strategies.STRATEGIES, "tf-idf", tf_idf)
+    use_map("tf-idf", data_dictionary, arc_schema, 10, 0.1)
+    with pytest.raises(AssertionError, match="reused"):
+        use_map("tf-idf", data_dictionary.iloc[:10], arc_schema, 3, 0.3)
+
+
 def test_sbert(data_dictionary, arc_schema):
     use_map("sbert", data_dictionary, arc_schema, num_matches=3)
 
 
+def test_sbert_index(fake_model, data_dictionary, arc_schema):
+    exact = sbert(data_dictionary, arc_schema, num_matches=3, index=None)
+    indexed = sbert(data_dictionary, arc_schema, num_matches=3, index="float16")
+    assert fake_model.encoded == len(data_dictionary) + len(arc_schema)
+    best = pd.merge(
+        exact.groupby("raw_variable").similarity.max(),
+        indexed.groupby("raw_variable").similarity.max(),
+        on="raw_variable",
+    )
+    assert len(best) > 0.9 * exact.raw_variable.nunique()
+    np.testing.assert_allclose(best.similarity_x, best.similarity_y, atol=1e-3)
+
+
 def test_unknown_mapping_strategy(data_dictionary, arc_schema):
     with pytest.raises(ValueError, match="Unknown mapping method"):
         use_map("magic", data_dictionary, arc_schema)
@@ -0,0 +1,159 @@
+import pandas as pd
+import pytest
+
+from arcmapper.table import MappingTable, split_filter_part
+
+OK = "✅"
+
+
+@pytest.fixture
+def table():
+    return MappingTable(
+        pd.DataFrame(
+            {
+                "status": ["-", OK, "-", OK, "-"],
+                "raw_variable": ["age", "age", "sex", "sex", "weight"],
+                "arc_variable": ["demog_age", "age", "demog_sex", "sex", "weight"],
+                "similarity": [0.9, 0.5, 0.8, 0.4, 0.7],
+            },
+            index=[10, 11, 12, 13, 14],
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "part,expected",
+    [
+        ('{status} = "✅"', ("status", "eq", OK)),
+        ("{similarity} >= 0.5", ("similarity", "ge", 0.5)),
+        ("{raw_variable} contains ag", ("raw_variable", "contains", "ag")),
+        (
+            '{raw_description} contains "age in"',
+            ("raw_description", "contains", "age in"),
+        ),
+        (
+            '{raw_description} contains "adult w"',
+            ("raw_description", "contains", "adult w"),
+        ),
+        ("{raw_variable} contains ne", ("raw_variable", "contains", "ne")),
+        ("{raw_variable} contains eq", ("raw_variable", "contains", "eq")),
+        ("{raw_variable} contains <= x", ("raw_variable", "contains", "<= x")),
+        ("{similarity}>=0.5", ("similarity", "ge", 0.5)),
+        ("{raw_variable} unknown x", (None, None, None)),
+        ("{raw_variable} contains", (None, None, None)),
+        ("", (None, None, None)),
+    ],
+)
+def test_split_filter_part(part, expected):
+    assert split_filter_part(part) == expected
+
+
+def test_mapping_table_ids(table):
+    assert list(table.frame.id) == [0, 1, 2, 3, 4]
+
+
+def test_mapping_table_filter(table):
+    assert list(table.filter(f'{{status}} = "{OK}"')) == [1, 3]
+    assert list(table.filter('{raw_variable} = "sex" && {similarity} > 0.5')) == [2]
+    assert list(table.filter("{arc_variable} contains DEMOG")) == [0, 2]
+    assert list(table.filter('{unknown} = "x"')) == [0, 1, 2, 3, 4]
+
+
+def test_mapping_table_set_updates_index(table):
+    assert list(table.filter(f'{{status}} = "{OK}"')) == [1, 3]
+    table.set(0, "status", OK)
+    assert list(table.filter(f'{{status}} = "{OK}"')) == [0, 1, 3]
+
+
+def test_mapping_table_page(table):
+    records, page_count = table.page(
+        1, 2, sort_by=[{"column_id": "similarity", "direction": "desc"}]
+    )
+    assert page_count == 3
+    assert [r["id"] for r in records] == [4, 1]
+    records, page_count = table.page(0, 2, filter_query='{raw_variable} = "weight"')
+    assert (page_count, [r["id"] for r in records]) == (1, [4])
+
+
+def test_mapping_table_responses():
+    table = MappingTable(
+        pd.DataFrame(
+            {
+                "status": ["-", "-"],
+                "raw_response": ["[('1', 'Yes')]", [("1", "Yes")]],
+                "arc_response": [[("1", "Yes")], None],
+            }
+        )
+    )
+    assert table.frame.raw_response.tolist() == [[("1", "Yes")], [("1", "Yes")]]
+    records, _ = table.page(0, 10)
+    assert records[0]["raw_response"] == '[["1", "Yes"]]'
+    assert records[1]["arc_response"] is None
+    table.set(1, "arc_response", '[["0", "No"]]')
+    assert table.get(1, "arc_response") == [("0", "No")]
+
+
+def test_mapping_table_free_text_responses():
+    table = MappingTable(
+        pd.DataFrame(
+            {
+                "status": ["-", "-"],
+                "raw_response": ["Yes", "[1,2]"],
+                "arc_response": [None, None],
+            }
+        )
+    )
+    assert table.frame.raw_response.tolist() == ["Yes", "[1,2]"]
+    table.set(0, "arc_response", "1, Yes | 0, No")
+    assert table.get(0, "arc_response") == [("1", "Yes"), ("0", "No")]
+    table.set(1, "arc_response", '"Yes"')
+    assert table.get(1, "arc_response") == '"Yes"'
+    records, _ = table.page(0, 10)
+    assert records[0]["raw_response"] == "Yes"
+
+
+def test_mapping_table_parquet_roundtrip(tmp_path):
+    pytest.importorskip("pyarrow")
+    table = MappingTable(
+        pd.DataFrame(
+            {
+                "status": ["-", OK],
+                "raw_variable": ["sex", "age"],
+                "raw_response": [[("1", "Male"), ("2", "Female")], None],
+                "similarity": [0.8, 0.5],
+            }
+        ),
+        metadata={"arc_version": "1.0.0", "method": "tf-idf"},
+    )
+    table.to_parquet(str(tmp_path / "mapping.parquet"))
+    loaded = MappingTable.read_parquet(str(tmp_path / "mapping.parquet"))
+    assert loaded.metadata == {"arc_version": "1.0.0", "method": "tf-idf"}
+    assert loaded.frame.raw_response.tolist() == [
+        [("1", "Male"), ("2", "Female")],
+        None,
+    ]
+    assert loaded.frame.similarity.tolist() == [0.8, 0.5]
+    assert list(loaded.frame.columns) == list(table.frame.columns)
+
+
+def test_mapping_table_parquet_free_text_responses(tmp_path):
+    pytest.importorskip("pyarrow")
+    table = MappingTable(
+        pd.DataFrame(
+            {
+                "status": ["-", "-", "-"],
+                "raw_response": [[("1", "Yes")], None, None],
+                "arc_response": [None, None, None],
+            }
+        )
+    )
+    table.set(1, "raw_response", "yes if present, see notes")
+    table.to_parquet(str(tmp_path / "mapping.parquet"))
+    loaded = MappingTable.read_parquet(str(tmp_path / "mapping.parquet"))
+    assert loaded.frame.raw_response.tolist() == [
+        [("1", "Yes")],
+        "yes if present, see notes",
+        None,
+    ]
+    assert loaded.frame.arc_response.tolist() == [None, None, None]
+    assert list(loaded.frame.columns) == list(table.frame.columns)
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from arcmapper import tfidf
+from arcmapper.tfidf import TfidfModel, arc_tfidf, tfidf_arc_text
+
+
+@pytest.fixture(autouse=True)
+def models(monkeypatch):
+    "Empties the in-memory models for each test"
+    monkeypatch.setattr(tfidf, "_models", OrderedDict())
+
+
+def test_tfidf_transform_matches_fit(arc_schema):
+    texts = tfidf_arc_text(arc_schema)
+    model = TfidfModel.fit(texts)
+    np.testing.assert_allclose(
+        model.transform(texts).toarray(), model.arc_matrix.toarray(), atol=1e-12
+    )
+
+
+def test_arc_tfidf_cached(arc_schema, cache_dir, monkeypatch):
+    first = arc_tfidf(arc_schema)
+    assert len(list((cache_dir / "tfidf").glob("*.npz"))) == 1
+    assert arc_tfidf(arc_schema) is first
+
+    monkeypatch.setattr(tfidf, "_models", OrderedDict())
+
+    def fit(texts):
+        raise AssertionError("cached model should not be fitted again")
+
+    monkeypatch.setattr(TfidfModel, "fit", fit)
+    loaded = arc_tfidf(arc_schema)
+    np.testing.assert_array_equal(loaded.terms, first.terms)
+    assert (loaded.arc_matrix != first.arc_matrix).nnz == 0
+
+
+def test_arc_tfidf_keyed_by_content(arc_schema, cache_dir):
+    arc_tfidf(arc_schema)
+    arc_tfidf(arc_schema.iloc[:10])
+    assert len(list((cache_dir / "tfidf").glob("*.npz"))) == 2
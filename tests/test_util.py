@@ -7,8 +7,15 @@ import pandas as pd
 
 from arcmapper.util import (
     read_data,
+    detect_encoding,
     read_csv_with_encoding_detection,
+    read_csv_bytes_with_encoding_detection,
     parse_redcap_response,
+    parse_redcap_responses,
+    format_responses,
+    parse_responses_text,
+    parse_response_columns,
+    read_data_chunks,
     read_upload_data,
 )
 
@@ -28,6 +35,24 @@ def test_read_csv_with_encoding_detection():
     assert isinstance(read_csv_with_encoding_detection(arc_path), pd.DataFrame)
 
 
+@pytest.mark.parametrize("encoding", ["utf-8", "utf-8-sig", "latin-1", "utf-16"])
+def test_read_csv_bytes_with_encoding_detection(encoding):
+    # non-ASCII characters only after the first encoding sample
+    expected = pd.DataFrame(
+        {
+            "variable": [f"var{i}" for i in range(5000)] + ["fièvre"],
+            "description": ["Description"] * 5000 + ["Fièvre élevée"],
+        }
+    )
+    data = expected.to_csv(index=False).encode(encoding)
+    assert read_csv_bytes_with_encoding_detection(data).equals(expected)
+
+
+def test_detect_encoding():
+    assert detect_encoding(b"subjid,Subject ID") == "ascii"
+    assert detect_encoding("Fièvre,Fièvre élevée".encode("utf-8")) == "utf-8"
+
+
 @pytest.mark.parametrize(
     "contents,filename,expected",
     [
@@ -59,3 +84,82 @@ def test_parse_redcap_response():
         ("1", "male"),
         ("2", "female"),
     ]
+    assert parse_redcap_response("5, Fibrinogen, human | 88, Other") == [
+        ("5", "Fibrinogen, human"),
+        ("88", "Other"),
+    ]
+
+
+def test_parse_redcap_responses():
+    values = pd.Series(
+        ["1, male | 2, female", None, " 1 ,Yes,  definitely|0, No ", "", 5, "a, ,b"],
+        index=[3, 3, 1, 7, 8, 9],
+    )
+    parsed = parse_redcap_responses(values)
+    assert list(parsed.index) == [3, 3, 1, 7, 8, 9]
+    assert parsed.tolist() == [
+        parse_redcap_response(x) if isinstance(x, str) else None for x in values
+    ]
+
+
+def test_read_data_chunks(tmp_path):
+    df = pd.DataFrame({"variable": [f"var{i}" for i in range(25)], "n": range(25)})
+    df.to_csv(tmp_path / "data.csv", index=False)
+    df.to_excel(tmp_path / "data.xlsx", index=False)
+    for file in ["data.csv", "data.xlsx"]:
+        chunks = list(read_data_chunks(str(tmp_path / file), chunksize=10))
+        assert [len(c) for c in chunks] == [10, 10, 5]
+        assert pd.concat(chunks, ignore_index=True).equals(df)
+
+
+def test_format_responses_roundtrip():
+    responses = [("1", "Yes"), ("0", "No, never")]
+    text = format_responses(responses)
+    assert text == '[["1", "Yes"], ["0", "No, never"]]'
+    assert parse_responses_text(text) == responses
+    assert format_responses(None) is None
+
+
+def test_parse_responses_text_legacy():
+    assert parse_responses_text("[('1', 'Yes'), ('0', 'No')]") == [
+        ("1", "Yes"),
+        ("0", "No"),
+    ]
+    assert parse_responses_text("  ") is None
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("1, Yes | 0, No", [("1", "Yes"), ("0", "No")]),
+        ("1, Yes, always", [("1", "Yes, always")]),
+        ("y, Yes | n, No", [("y", "Yes"), ("n", "No")]),
+        ("yes if present, see notes", "yes if present, see notes"),
+        ("Yes, please", "Yes, please"),
+        ("1, Yes | see notes", "1, Yes | see notes"),
+        ("Yes", "Yes"),
+        ('"Yes"', '"Yes"'),
+        ("[1,2]", "[1,2]"),
+        ("[('1', 'Yes'", "[('1', 'Yes'"),
+        ("[]", []),
+    ],
+)
+def test_parse_responses_text_edited(text, expected):
+    assert parse_responses_text(text) == expected
+
+
+def test_parse_response_columns():
+    yes_no = '[["1", "Yes"], ["0", "No"]]'
+    df = pd.DataFrame(
+        {
+            "raw_response": [yes_no, yes_no, None, [("1", "A")]],
+            "arc_response": [yes_no, float("nan"), None, None],
+        }
+    )
+    parse_response_columns(df)
+    assert df.raw_response[0] == [("1", "Yes"), ("0", "No")]
+    # distinct strings are parsed once and shared
+    assert df.raw_response[0] is df.raw_response[1]
+    assert df.raw_response[2] is None
+    assert df.raw_response[3] == [("1", "A")]
+    assert pd.isna(df.arc_response[1])